@@ -0,0 +1,170 @@
+"""End-to-end UI latency benchmark: replay a recorded interaction session.
+
+Record a session in the app with `View > Record Interactions` (uncheck to
+save it), or let this script generate a synthetic one: slider sweeps, a hue
+drag on the color wheel, wheel zooms, panning and a measurement. The
+session is replayed against a real HSVThresholdAdjuster and the per-event
+latency percentiles (p50/p95/p99) and dropped frames are reported, overall
+and per handler. The report is written as JSON, so it can be kept per
+release and compared with --baseline.
+
+Needs a display; in CI run it under a virtual X server:
+
+Usage:
+    xvfb-run -a python benchmarks/bench_interaction_replay.py [SCRIPT] [--image IMAGE]
+        [--output report.json] [--baseline previous.json] [--tolerance 0.2] [--label v1.1]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+import hsv_wizard  # noqa: E402
+
+# Spacing of synthetic events (about one per frame) and size of the synthetic image
+EVENT_INTERVAL = 0.016
+IMAGE_SIZE = (4000, 3000)
+LOAD_TIMEOUT = 120
+# Metrics compared against a baseline report
+COMPARED_METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def synthetic_image(path, size=IMAGE_SIZE):
+    """Write a test image with hue and saturation gradients and noisy value."""
+    width, height = size
+    rng = np.random.default_rng(0)
+    hsv = np.empty((height, width, 3), dtype=np.uint8)
+    hsv[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)[np.newaxis, :]
+    hsv[..., 1] = np.linspace(40, 255, height, dtype=np.uint8)[:, np.newaxis]
+    hsv[..., 2] = rng.integers(60, 256, (height, width), dtype=np.uint8)
+    Image.fromarray(hsv, 'HSV').convert('RGB').save(path)
+
+
+def synthetic_script():
+    """Return an interaction script exercising sliders, the wheel, zoom, panning and measuring."""
+    events = []
+    t = 0.0
+
+    def add(handler, pause=EVENT_INTERVAL, **fields):
+        nonlocal t
+        t += pause
+        entry = {'t': round(t, 6), 'handler': handler}
+        entry.update(fields)
+        events.append(entry)
+
+    for i in range(60):
+        add('update_saturation', scales={'sat_low_scale': i * 0.6, 'sat_high_scale': 100})
+    for i in range(60):
+        add('update_value', scales={'val_low_scale': 10, 'val_high_scale': 100 - i * 0.5})
+    for i in range(60):
+        add('update_hue', scales={'hue_low_scale': i, 'hue_high_scale': 240})
+    # Drag the lower hue line on the color wheel from 60° to 120°
+    radius = 100
+    for i in range(61):
+        angle = np.radians(60 + i)
+        add('on_click' if i == 0 else 'on_drag', pause=0.3 if i == 0 else EVENT_INTERVAL,
+            event={'x': 150 + radius * np.cos(angle), 'y': 150 + radius * np.sin(angle)})
+    # Fast wheel zooms in and out around the canvas centre
+    for direction, delta in (('in', 120), ('out', -120)):
+        for i in range(10):
+            add('on_mousewheel', pause=0.3 if i == 0 else 0.01, event={'x': 400, 'y': 300, 'delta': delta})
+    add('on_canvas_click', pause=0.5, event={'x': 400, 'y': 300})
+    for i in range(60):
+        add('on_canvas_drag', event={'x': 400 - 3 * i, 'y': 300 - 2 * i})
+    add('start_measure_line', pause=0.3, event={'x': 100, 'y': 100})
+    for i in range(30):
+        add('draw_measure_line', event={'x': 100 + 5 * i, 'y': 100 + 3 * i})
+    add('end_measure_line', event={'x': 250, 'y': 190})
+    initial = {'thresholds': [60, 240, 0, 100, 0, 100], 'zoom': 0.5, 'view': [0.0, 0.0],
+               'calibration': [1.0, 'px'], 'image_size': list(IMAGE_SIZE)}
+    return {'version': hsv_wizard.INTERACTION_SCRIPT_VERSION, 'initial': initial, 'events': events}
+
+
+def compare_reports(report, baseline, tolerance):
+    """Return (name, metric, old, new) for every metric slower than baseline by more than tolerance."""
+    regressions = []
+    sections = [('all', report, baseline)]
+    for name, section in report.get('handlers', {}).items():
+        if name in baseline.get('handlers', {}):
+            sections.append((name, section, baseline['handlers'][name]))
+    for name, new, old in sections:
+        for metric in COMPARED_METRICS:
+            if metric in new and metric in old and new[metric] > old[metric] * (1 + tolerance):
+                regressions.append((name, metric, old[metric], new[metric]))
+    if report['dropped_frames'] > baseline['dropped_frames'] * (1 + tolerance):
+        regressions.append(('all', 'dropped_frames', baseline['dropped_frames'], report['dropped_frames']))
+    return regressions
+
+
+def print_report(report):
+    rows = [('all', report)] + sorted(report.get('handlers', {}).items())
+    print(f"{'Handler':<20} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in rows:
+        if row['count']:
+            print(f"{name:<20} {row['count']:>5} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+                  f"{row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}")
+    print(f"Dropped frames ({report['frame_ms']:.1f} ms each): {report['dropped_frames']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay an interaction script and report UI latency.')
+    parser.add_argument('script', nargs='?', help='recorded interaction script (default: synthetic session)')
+    parser.add_argument('--image', help='image to replay on (default: the recorded image, else a synthetic one)')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--baseline', help='report of a previous release to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown (default 0.2)')
+    parser.add_argument('--label', help='release label stored in the report')
+    parser.add_argument('--fast', action='store_true', help='dispatch events back to back instead of in real time')
+    args = parser.parse_args(argv)
+
+    script = hsv_wizard.read_interaction_script(args.script) if args.script else synthetic_script()
+    initial = script.get('initial', {})
+    image_path = args.image or initial.get('image_path')
+    with tempfile.TemporaryDirectory() as directory:
+        if not image_path or not os.path.exists(image_path):
+            image_path = os.path.join(directory, 'synthetic.png')
+            synthetic_image(image_path, tuple(initial.get('image_size') or IMAGE_SIZE))
+
+        import tkinter as tk
+        try:
+            app = hsv_wizard.HSVThresholdAdjuster(image_path)
+        except tk.TclError as e:
+            print(f"No display available ({e}); run under a virtual X server, e.g. xvfb-run -a.")
+            return 2
+        deadline = time.perf_counter() + LOAD_TIMEOUT
+        while app.rgb_array is None or app._loader is not None:
+            if time.perf_counter() > deadline:
+                print("Timed out loading the image.")
+                app.destroy()
+                return 2
+            app.update()
+            time.sleep(0.01)
+        report = hsv_wizard.replay_interactions(app, script, realtime=not args.fast)
+        app.destroy()
+
+    report['environment'] = {'label': args.label, 'python': platform.python_version(),
+                             'numpy': np.__version__, 'platform': platform.platform(),
+                             'image': os.path.basename(image_path), 'realtime': not args.fast}
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Benchmark of the kernel backends for HSV conversion, thresholding and compositing.
+
+Times the NumPy backend (PIL's conversion and NumPy array operations, one
+pass and temporary per step) against the Numba backend (one fused, parallel
+pass per pixel) on a synthetic image, and checks that both give the same
+masks. Without Numba installed (pip install hsv-wizard[jit]) only the NumPy
+backend is timed.
+
+Usage:
+    python benchmarks/bench_kernels.py [--size 4000x3000] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import time
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+import hsv_wizard  # noqa: E402
+
+# A window that wraps around red, in degrees and percent
+THRESHOLDS = (300, 40, 20, 100, 15, 95)
+
+
+def synthetic_rgb(width, height):
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    # Smooth gradients as well as noise, so all branches of the conversion are taken
+    rgb[:height // 2, :, 0] = np.linspace(0, 255, width, dtype=np.uint8)
+    return rgb
+
+
+def bench_backend(kernels, rgb, bounds, repeat):
+    """Return {step: best time in seconds} for one backend."""
+    hsv = kernels.rgb_to_hsv(rgb, out=np.empty_like(rgb))
+    steps = {
+        'convert': lambda: kernels.rgb_to_hsv(rgb, out=hsv),
+        'threshold': lambda: kernels.hsv_mask(hsv, bounds),
+    }
+    for mode, _ in hsv_wizard.DISPLAY_MODES:
+        steps[f'mask_rgb {mode}'] = lambda mode=mode: kernels.mask_rgb(rgb, bounds, mode)
+    return {name: min(timeit.repeat(step, number=1, repeat=repeat)) for name, step in steps.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the kernel backends.')
+    parser.add_argument('--size', default='4000x3000', help='image size WIDTHxHEIGHT (default 4000x3000)')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions; the best is reported (default 5)')
+    args = parser.parse_args(argv)
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    rgb = synthetic_rgb(width, height)
+    bounds = hsv_wizard.threshold_bounds(*THRESHOLDS)
+
+    backends = [hsv_wizard.NumpyKernels()]
+    try:
+        start = time.perf_counter()
+        backends.append(hsv_wizard.NumbaKernels())
+        print(f"Numba kernels compiled in {time.perf_counter() - start:.2f} s")
+    except ImportError:
+        print("Numba is not installed; timing the NumPy backend only.")
+
+    results = {kernels.name: bench_backend(kernels, rgb, bounds, args.repeat) for kernels in backends}
+    megapixels = width * height / 1e6
+    print(f"{'Step':<20}" + ''.join(f"{name + ' ms':>12}" for name in results) +
+          (f"{'speed-up':>10}" if len(results) > 1 else ''))
+    for step in results['numpy']:
+        times = [results[name][step] for name in results]
+        row = f"{step:<20}" + ''.join(f"{t * 1000:>12.1f}" for t in times)
+        if len(times) > 1:
+            row += f"{times[0] / times[1]:>9.1f}x"
+        print(row)
+    print(f"({megapixels:.1f} MP image)")
+
+    if len(backends) > 1:
+        for mode, _ in hsv_wizard.DISPLAY_MODES:
+            reference = backends[0].mask_rgb(rgb, bounds, mode)
+            fused = backends[1].mask_rgb(rgb, bounds, mode)
+            if not all(np.array_equal(a, b) for a, b in zip(reference, fused)):
+                print(f"MISMATCH in mode {mode}")
+                return 1
+        print("Masks and composites are identical.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Micro-benchmark for the color wheel sector and hue bar redraw during dragging.
+
+Compares the previous redraw (per-point trigonometry, delete and recreate the
+sector polygon and wrap-around rectangles on every event) with the current one
+(precomputed unit-circle table, items updated in place with coords/itemconfig).
+
+The canvas part needs a display; without one only point generation is timed.
+
+Usage:
+    python benchmarks/bench_wheel_redraw.py
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+import hsv_wizard  # noqa: E402
+
+RADIUS = 150
+EVENTS = 500
+# A drag sweep that repeatedly crosses the 0° wrap-around
+ANGLES = [(300 + 0.7 * i) % 360 for i in range(EVENTS)]
+
+
+def legacy_points(hue_low, hue_high, radius=RADIUS):
+    """Sector points as computed before: one np.cos/np.sin call pair per point."""
+    def coords(angle):
+        radians = np.radians(angle)
+        return radius + radius * np.cos(radians), radius + radius * np.sin(radians)
+
+    x1, y1 = coords(hue_low)
+    x2, y2 = coords(hue_high)
+    points = [radius, radius, x1, y1]
+    angle_end = hue_high + 360 if hue_low > hue_high else hue_high
+    for angle in np.linspace(hue_low, angle_end, int(abs(angle_end - hue_low))):
+        x, y = coords(angle % 360)
+        points.extend([x, y])
+    points.extend([x2, y2])
+    return points
+
+
+def bench_points():
+    table = hsv_wizard.unit_circle_table()
+    legacy = timeit.timeit(lambda: [legacy_points(a, 120) for a in ANGLES], number=1)
+    current = timeit.timeit(
+        lambda: [hsv_wizard.wheel_sector_points(a, 120, RADIUS, RADIUS, table) for a in ANGLES], number=1)
+    return legacy, current
+
+
+def bench_canvas():
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return None
+    canvas = tk.Canvas(root, width=2 * RADIUS, height=2 * RADIUS)
+    canvas.pack()
+    table = hsv_wizard.unit_circle_table()
+
+    state = {'sector': None, 'rects': None}
+
+    def legacy_event(angle):
+        if state['sector'] is not None:
+            canvas.delete(state['sector'])
+        state['sector'] = canvas.create_polygon(legacy_points(angle, 120), fill='gray', stipple='gray50', outline='')
+        if state['rects'] is not None:
+            canvas.delete(*state['rects'])
+        state['rects'] = (canvas.create_rectangle(0, 0, 50, 50, fill='gray', stipple='gray50', outline=''),
+                          canvas.create_rectangle(250, 0, 300, 50, fill='gray', stipple='gray50', outline=''))
+        root.update_idletasks()
+
+    sector = canvas.create_polygon(0, 0, 0, 0, 0, 0, fill='gray', stipple='gray50', outline='')
+    rects = (canvas.create_rectangle(0, 0, 0, 50, fill='gray', stipple='gray50', outline=''),
+             canvas.create_rectangle(0, 0, 0, 50, fill='gray', stipple='gray50', outline=''))
+
+    def current_event(angle):
+        canvas.coords(sector, hsv_wizard.wheel_sector_points(angle, 120, RADIUS, RADIUS, table))
+        canvas.coords(rects[0], 0, 0, 50, 50)
+        canvas.coords(rects[1], 250, 0, 300, 50)
+        canvas.itemconfig(rects[0], state='normal')
+        canvas.itemconfig(rects[1], state='normal')
+        root.update_idletasks()
+
+    legacy = timeit.timeit(lambda: [legacy_event(a) for a in ANGLES], number=1)
+    current = timeit.timeit(lambda: [current_event(a) for a in ANGLES], number=1)
+    root.destroy()
+    return legacy, current
+
+
+def report(name, timings):
+    legacy, current = timings
+    print(f"{name:<18} legacy {legacy / EVENTS * 1e6:8.1f} µs/event   "
+          f"current {current / EVENTS * 1e6:8.1f} µs/event   speed-up {legacy / current:5.1f}x")
+
+
+if __name__ == '__main__':
+    report("sector points", bench_points())
+    canvas_timings = bench_canvas()
+    if canvas_timings is None:
+        print("canvas redraw      skipped (no display available)")
+    else:
+        report("canvas redraw", canvas_timings)
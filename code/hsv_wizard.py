@@ -11,14 +11,34 @@ Repository: https://github.com/SeSam-MUL/HSV-Wizard
 """
 
 import tkinter as tk
-from tkinter import filedialog, messagebox, simpledialog
+from tkinter import filedialog, messagebox, simpledialog, colorchooser, ttk
 from tkinter import scrolledtext
 from PIL import Image, ImageTk, ImageDraw, ImageFont
 import numpy as np
 import colorsys
 import sys
+import argparse
+import functools
+import logging
+import multiprocessing
 import platform
 import csv
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def hsv_to_rgb(h, s, v):
@@ -132,6 +152,4045 @@ def hue_angle_to_x(hue_angle, width):
     """Map a hue angle (0-360 degrees) to an x pixel position on a gradient bar."""
     return (hue_angle % 360) / 360 * width
 
+
+# Resolution of the precomputed unit-circle table used for the wheel sector (points per degree)
+WHEEL_ARC_RESOLUTION = 1
+
+# Minimum interval between interactive redraws, about one frame at 60 Hz
+REDRAW_INTERVAL_MS = 16
+
+# Interval at which the Tk thread polls a background image loader
+LOAD_POLL_MS = 50
+
+# Edge length of rendered display tiles in screen pixels
+TILE_SIZE = 256
+
+# Time budget per event-loop slice for rendering sharp tiles in the background
+TILE_FILL_BUDGET_MS = 10
+
+# Recently rendered states that keep their tile version, so undo and redo reuse cached tiles
+RENDER_VERSIONS_KEPT = 32
+
+# Zoom factor per wheel notch or zoom button press
+ZOOM_STEP = 1.1
+
+# Wheel notches arriving within this window are applied as a single zoom step
+WHEEL_COALESCE_MS = 30
+
+# Sharp tiles are only rendered once zooming has paused for this long
+ZOOM_SETTLE_MS = 150
+
+# Coverage of the full-resolution selection is recomputed once thresholds have been still this long
+COVERAGE_DELAY_MS = 250
+
+
+def unit_circle_table(resolution=WHEEL_ARC_RESOLUTION):
+    """Precompute cos/sin for every arc step around the circle."""
+    angles = np.radians(np.arange(360 * resolution) / resolution)
+    return np.cos(angles), np.sin(angles)
+
+
+def wheel_sector_points(hue_low, hue_high, center, radius, table, resolution=WHEEL_ARC_RESOLUTION):
+    """Return the flat polygon coordinates of the wheel sector from hue_low to hue_high.
+
+    The arc uses the precomputed unit-circle table for all interior steps; only
+    the two exact end points are computed on the fly.
+    """
+    cos_table, sin_table = table
+    steps = len(cos_table)
+    end = hue_high if hue_low <= hue_high else hue_high + 360  # Handle wrap-around
+    first = int(np.floor(hue_low * resolution)) + 1
+    last = int(np.ceil(end * resolution)) - 1
+    index = np.arange(first, max(last + 1, first)) % steps
+
+    n = len(index) + 3
+    points = np.empty((n, 2))
+    points[0] = center, center
+    points[1] = center + radius * math.cos(math.radians(hue_low)), center + radius * math.sin(math.radians(hue_low))
+    points[2:-1, 0] = center + radius * cos_table[index]
+    points[2:-1, 1] = center + radius * sin_table[index]
+    points[-1] = center + radius * math.cos(math.radians(hue_high)), center + radius * math.sin(math.radians(hue_high))
+    return points.ravel().tolist()
+
+
+def threshold_bounds(hue_low, hue_high, sat_low, sat_high, val_low, val_high):
+    """Convert thresholds in degrees/percent to 8-bit HSV channel bounds."""
+    return (int((hue_low / 360) * 255), int((hue_high / 360) * 255),
+            int((sat_low / 100) * 255), int((sat_high / 100) * 255),
+            int((val_low / 100) * 255), int((val_high / 100) * 255))
+
+
+def level_to_threshold(level, scale):
+    """Convert an 8-bit HSV level to degrees (scale=360) or percent (scale=100).
+
+    The centre of the level's bin is used so threshold_bounds maps it back to
+    the same level despite floating-point rounding.
+    """
+    return min((level + 0.5) / 255 * scale, scale)
+
+
+def compute_hsv_mask(hsv_array, hue_low, hue_high, sat_low, sat_high, val_low, val_high):
+    """Return the boolean mask of pixels inside an HSV window.
+
+    Thresholds are given in degrees (hue) and percent (saturation, value).
+    Handles circular hue wrap-around when hue_low > hue_high.
+    """
+    bounds = threshold_bounds(hue_low, hue_high, sat_low, sat_high, val_low, val_high)
+    return get_kernels().hsv_mask(hsv_array, bounds)
+
+
+# Bins per channel of the coarse 3D HSV histogram (a power of two)
+HISTOGRAM_BINS = 64
+
+# Threshold bounds in the order of set_thresholds(): (name, channel, scale)
+THRESHOLD_BOUNDS = (('hue_low', 0, 360), ('hue_high', 0, 360), ('sat_low', 1, 100), ('sat_high', 1, 100),
+                    ('val_low', 2, 100), ('val_high', 2, 100))
+
+
+class HSVHistogram:
+    """Histograms of an HSV image for evaluating threshold windows without the image.
+
+    Holds the exact 256-level histogram of each channel and the summed-volume
+    table (3D cumulative sum) of a coarser 3D histogram. The coverage of any
+    window, including hue windows that wrap around, then costs a few table
+    lookups. Bounds that fall inside a coarse bin are interpolated along the
+    exact channel histogram, so windows that restrict a single channel are
+    exact, and others are exact at bin edges and close in between.
+    """
+
+    def __init__(self, hsv_array, bins=HISTOGRAM_BINS, strip_rows=512):
+        shift = 8 - int(math.log2(bins))
+        self.bins = bins
+        self.total = hsv_array.shape[0] * hsv_array.shape[1]
+        self.channels = np.zeros((3, 256), dtype=np.int64)
+        volume = np.zeros(bins ** 3, dtype=np.int64)
+        for top in range(0, hsv_array.shape[0], strip_rows):
+            strip = hsv_array[top:top + strip_rows].reshape(-1, 3)
+            for channel in range(3):
+                self.channels[channel] += np.bincount(strip[:, channel], minlength=256)
+            coarse = (strip >> shift).astype(np.intp)
+            volume += np.bincount((coarse[:, 0] * bins + coarse[:, 1]) * bins + coarse[:, 2], minlength=bins ** 3)
+        self.table = np.zeros((bins + 1,) * 3, dtype=np.int64)
+        self.table[1:, 1:, 1:] = volume.reshape(bins, bins, bins).cumsum(0).cumsum(1).cumsum(2)
+        # Fractional bin position of each level boundary 0..256, spaced by the pixels of the channel
+        per_bin = 256 // bins
+        cumulative = np.concatenate([np.zeros((3, 1), dtype=np.int64), self.channels.cumsum(axis=1)], axis=1)
+        edges = np.arange(257)
+        start = np.minimum(edges // per_bin, bins - 1) * per_bin
+        inside = cumulative[:, start + per_bin] - cumulative[:, start]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(inside > 0, (cumulative[:, edges] - cumulative[:, start]) / inside,
+                                (edges - start) / per_bin)
+        self.positions = start / per_bin + fraction
+
+    @property
+    def nbytes(self):
+        return self.channels.nbytes + self.table.nbytes
+
+    def _cumulative(self, h, s, v):
+        """Pixels below the fractional bin positions (h, s, v), interpolated trilinearly."""
+        axes = []
+        for position in (h, s, v):
+            position = np.clip(position, 0, self.bins)
+            index = np.minimum(np.floor(position).astype(np.intp), self.bins - 1)
+            weight = position - index
+            axes.append(((index, 1 - weight), (index + 1, weight)))
+        total = 0.0
+        for hi, hw in axes[0]:
+            for si, sw in axes[1]:
+                for vi, vw in axes[2]:
+                    total = total + self.table[hi, si, vi] * (hw * sw * vw)
+        return total
+
+    def _box(self, low, high):
+        """Pixels inside the box from `low` to `high` (fractional bin positions per channel)."""
+        (h0, s0, v0), (h1, s1, v1) = low, high
+        c = self._cumulative
+        return (c(h1, s1, v1) - c(h0, s1, v1) - c(h1, s0, v1) - c(h1, s1, v0)
+                + c(h0, s0, v1) + c(h0, s1, v0) + c(h1, s0, v0) - c(h0, s0, v0))
+
+    def coverage(self, hue_low, hue_high, sat_low, sat_high, val_low, val_high):
+        """Return the fraction of pixels inside an HSV window, as compute_hsv_mask() would select.
+
+        Bounds may be arrays (broadcast against each other) to evaluate many
+        windows at once.
+        """
+        levels = [np.floor(np.asarray(bound, dtype=float) / scale * 255).astype(np.intp)
+                  for bound, (_, _, scale) in zip((hue_low, hue_high, sat_low, sat_high, val_low, val_high),
+                                                  THRESHOLD_BOUNDS)]
+        h_low, h_high, s_low, s_high, v_low, v_high = np.broadcast_arrays(*[np.clip(l, 0, 255) for l in levels])
+        # Inclusive 8-bit bounds [low, high] cover the level interval [low, high + 1)
+        position = self.positions
+        low = (position[0][h_low], position[1][s_low], position[2][v_low])
+        high = (position[0][h_high + 1], position[1][s_high + 1], position[2][v_high + 1])
+        wraps = h_low > h_high
+        count = np.where(wraps, 0.0, self._box(low, high))
+        if np.any(wraps):
+            # A wrapping hue window is the union of [low, 255] and [0, high]
+            count = count + np.where(wraps, self._box(low, (self.bins,) + high[1:])
+                                     + self._box((0,) + low[1:], high), 0.0)
+        count = np.where((s_low <= s_high) & (v_low <= v_high), np.maximum(count, 0), 0.0)
+        fraction = count / self.total if self.total else count * 0
+        return fraction if fraction.ndim else float(fraction)
+
+    def coverage_curve(self, window, bound, values):
+        """Return the coverage of `window` with one bound (a THRESHOLD_BOUNDS name) swept over `values`."""
+        index = [name for name, _, _ in THRESHOLD_BOUNDS].index(bound)
+        bounds = list(window)
+        bounds[index] = np.asarray(values, dtype=float)
+        return self.coverage(*bounds)
+
+    def sensitivity(self, window, levels=2):
+        """Relative change in coverage when all bounds move outwards and inwards by `levels` levels.
+
+        Small values mark stable windows. Hue bounds of a full circle and
+        bounds at the end of their range are left alone.
+        """
+        steps = []
+        for sign in (1, -1):
+            bounds = []
+            for i, (value, (_, channel, scale)) in enumerate(zip(window, THRESHOLD_BOUNDS)):
+                outwards = -1 if i % 2 == 0 else 1
+                bounds.append(min(max(value + sign * outwards * levels * scale / 255, 0), scale))
+            steps.append(self.coverage(*bounds))
+        coverage = self.coverage(*window)
+        return (steps[0] - steps[1]) / coverage if coverage else math.inf
+
+
+def otsu_thresholds(histogram, classes=2):
+    """Multi-level Otsu thresholds of a 1D histogram.
+
+    Finds the classes - 1 thresholds that maximise the between-class
+    variance, by dynamic programming over the cumulative sums, so the cost
+    is O(classes * levels^2) regardless of the image size. A threshold t
+    puts levels <= t in the lower class.
+    """
+    histogram = np.asarray(histogram, dtype=float)
+    levels = len(histogram)
+    weights = np.concatenate([[0], np.cumsum(histogram)])
+    moments = np.concatenate([[0], np.cumsum(histogram * np.arange(levels))])
+    # score[i, j]: between-class term of the class spanning levels i..j - 1
+    w = weights[None, :] - weights[:, None]
+    m = moments[None, :] - moments[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(w > 0, m * m / w, 0.0)
+    score[np.tril_indices(levels + 1)] = -np.inf
+    best = score[0].copy()
+    choices = []
+    for _ in range(classes - 1):
+        # best[j]: optimum for levels 0..j - 1 split into one more class
+        candidates = best[:, None] + score
+        choices.append(np.argmax(candidates, axis=0))
+        best = candidates[choices[-1], np.arange(levels + 1)]
+    thresholds = []
+    end = levels
+    for choice in reversed(choices):
+        end = int(choice[end])
+        thresholds.append(end - 1)
+    return sorted(thresholds)
+
+
+def histogram_peaks(histogram, smoothing=7, circular=False, min_fraction=0.02, depth=0.5):
+    """Return (peak, low, high) level triples of the significant modes of a 1D histogram.
+
+    The histogram is smoothed with a box filter (wrapping around for hue)
+    and split at its valleys; minima less than `depth` below the lower of
+    the maxima on either side are ripples, not valleys. Each part holding
+    at least `min_fraction` of all pixels is a mode, trimmed to the levels
+    that contain pixels. For circular histograms `low` may exceed `high`.
+    """
+    histogram = np.asarray(histogram, dtype=float)
+    levels = len(histogram)
+    total = histogram.sum()
+    if not total:
+        return []
+    pad = smoothing // 2
+    padded = np.concatenate([histogram[-pad:], histogram, histogram[:pad]]) if circular else \
+        np.pad(histogram, pad, mode='edge')
+    smooth = np.convolve(padded, np.ones(smoothing) / smoothing, mode='valid')
+    if circular:
+        before, after = np.roll(smooth, 1), np.roll(smooth, -1)
+    else:
+        before, after = np.r_[np.inf, smooth[:-1]], np.r_[smooth[1:], np.inf]
+    # A flat bottom counts once, at its last level
+    minima = np.flatnonzero((smooth <= before) & (smooth < after))
+    valleys = []
+    for k, valley in enumerate(minima):
+        if circular:
+            left = minima[k - 1] - (levels if k == 0 else 0)
+            right = minima[(k + 1) % len(minima)] + (levels if k == len(minima) - 1 else 0)
+        else:
+            left = minima[k - 1] if k else 0
+            right = minima[k + 1] if k + 1 < len(minima) else levels - 1
+        left_max = smooth[np.arange(left, valley + 1) % levels].max()
+        right_max = smooth[np.arange(valley, right + 1) % levels].max()
+        if smooth[valley] <= (1 - depth) * min(left_max, right_max):
+            valleys.append(int(valley))
+    if circular:
+        if valleys:
+            spans = [np.arange(low, low + (high - low - 1) % levels + 1) % levels
+                     for low, high in zip(valleys, valleys[1:] + valleys[:1])]
+        else:
+            spans = [np.arange(levels)]
+    else:
+        bounds = [0] + valleys + [levels]
+        spans = [np.arange(low, high) for low, high in zip(bounds, bounds[1:]) if high > low]
+    modes = []
+    for span in spans:
+        counts = histogram[span]
+        if counts.sum() >= min_fraction * total:
+            occupied = span[counts > 0]
+            modes.append((int(span[np.argmax(counts)]), int(occupied[0]), int(occupied[-1])))
+    return modes
+
+
+def suggest_thresholds(histogram, window, hue_classes=3):
+    """Derive candidate threshold windows from an HSVHistogram.
+
+    Hue candidates (multi-Otsu classes and the modes between histogram
+    valleys) keep the saturation and value bounds of `window`; saturation
+    and value candidates (Otsu splits) keep its other bounds. Every
+    candidate is evaluated from the histogram alone.
+
+    Returns:
+        list of dict: 'name', 'window', 'coverage' and 'sensitivity',
+        ordered from the most to the least stable.
+    """
+    hue, sat, val = histogram.channels
+
+    def degrees(low, high):
+        return level_to_threshold(low, 360), level_to_threshold(high, 360)
+
+    def percent(low, high):
+        return level_to_threshold(low, 100), level_to_threshold(high, 100)
+
+    candidates = []
+    bounds = [-1] + otsu_thresholds(hue, hue_classes) + [255]
+    for i in range(hue_classes):
+        if bounds[i] + 1 <= bounds[i + 1]:
+            candidates.append((f"Hue Otsu class {i + 1}/{hue_classes}",
+                               degrees(bounds[i] + 1, bounds[i + 1]) + tuple(window[2:])))
+    for peak, low, high in histogram_peaks(hue, circular=True):
+        candidates.append((f"Hue mode at {level_to_threshold(peak, 360):.0f}°",
+                           degrees(low, high) + tuple(window[2:])))
+    for name, channel, offset in (('Saturation', sat, 2), ('Value', val, 4)):
+        threshold = otsu_thresholds(channel)[0]
+        for label, span in (('high', (threshold + 1, 255)), ('low', (0, threshold))):
+            bounds = list(window)
+            bounds[offset:offset + 2] = percent(*span)
+            candidates.append((f"{name} Otsu {label}", tuple(bounds)))
+    results = [{'name': name, 'window': tuple(float(b) for b in bounds), 'coverage': histogram.coverage(*bounds),
+                'sensitivity': histogram.sensitivity(bounds)} for name, bounds in candidates]
+    # Candidates that select nothing, or nothing less than the current window, do not help
+    current = histogram.coverage(*window)
+    unique = {}
+    for result in results:
+        if 0 < result['coverage'] < current - 1e-6:
+            unique.setdefault(result['window'], result)
+    return sorted(unique.values(), key=lambda result: result['sensitivity'])
+
+
+def stable_bound(values, coverage, margin=0.05, smoothing=5):
+    """Return the bound value where a coverage curve is flattest, or None.
+
+    The ends of the curve where (almost) nothing or everything possible is
+    selected are excluded, as they are trivially flat.
+    """
+    values = np.asarray(values, dtype=float)
+    coverage = np.asarray(coverage, dtype=float)
+    low, high = coverage.min(), coverage.max()
+    if high - low <= 0 or len(values) < 3:
+        return None
+    slope = np.abs(np.gradient(coverage, values))
+    slope = np.convolve(np.pad(slope, smoothing // 2, mode='edge'), np.ones(smoothing) / smoothing, mode='valid')
+    inside = (coverage > low + margin * (high - low)) & (coverage < high - margin * (high - low))
+    if not inside.any():
+        return None
+    return float(values[np.flatnonzero(inside)[np.argmin(slope[inside])]])
+
+
+# Maximum number of phase classes; each class owns one bit of a uint8 lookup table
+MAX_PHASE_CLASSES = 8
+
+# Default display colors for phase classes
+PHASE_CLASS_COLORS = [
+    (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200),
+    (245, 130, 48), (145, 30, 180), (70, 240, 240), (240, 50, 230),
+]
+
+
+class PhaseClass:
+    """A named HSV threshold window with its own display color."""
+
+    def __init__(self, name, hue_low, hue_high, sat_low, sat_high, val_low, val_high, color):
+        self.name = name
+        self.hue_low = hue_low
+        self.hue_high = hue_high
+        self.sat_low = sat_low
+        self.sat_high = sat_high
+        self.val_low = val_low
+        self.val_high = val_high
+        self.color = tuple(int(c) for c in color)
+
+    def window(self):
+        """Return the (hue_low, hue_high, sat_low, sat_high, val_low, val_high) window."""
+        return (self.hue_low, self.hue_high, self.sat_low, self.sat_high, self.val_low, self.val_high)
+
+    def key(self):
+        """Return (name, window, color) as a hashable value, e.g. for the undo history."""
+        return (self.name, self.window(), self.color)
+
+    @classmethod
+    def from_key(cls, key):
+        name, window, color = key
+        return cls(name, *window, color=color)
+
+    def to_dict(self):
+        return {'name': self.name, 'window': list(self.window()), 'color': list(self.color)}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], *data['window'], color=data['color'])
+
+
+def build_class_luts(classes):
+    """Build the combined lookup tables for single-pass multi-class labelling.
+
+    Every class owns one bit. For each HSV channel a 256-entry table holds the
+    bits of all classes whose window contains that channel level, so a pixel's
+    class membership is the AND of three table lookups no matter how many
+    classes are defined. A final table maps the combined bits to the label of
+    the first matching class (1-based; 0 means unclassified).
+
+    Returns:
+        tuple: (hue_bits, sat_bits, val_bits, label_lut), each a uint8 array of length 256.
+    """
+    if len(classes) > MAX_PHASE_CLASSES:
+        raise ValueError(f"At most {MAX_PHASE_CLASSES} phase classes are supported.")
+    levels = np.arange(256)
+    hue_bits = np.zeros(256, dtype=np.uint8)
+    sat_bits = np.zeros(256, dtype=np.uint8)
+    val_bits = np.zeros(256, dtype=np.uint8)
+    for index, phase in enumerate(classes):
+        h_low, h_high, s_low, s_high, v_low, v_high = threshold_bounds(*phase.window())
+        bit = np.uint8(1 << index)
+        if h_low <= h_high:
+            hue_bits[(levels >= h_low) & (levels <= h_high)] |= bit
+        else:
+            hue_bits[(levels >= h_low) | (levels <= h_high)] |= bit
+        sat_bits[(levels >= s_low) & (levels <= s_high)] |= bit
+        val_bits[(levels >= v_low) & (levels <= v_high)] |= bit
+
+    # Label of the lowest set bit, so earlier classes take precedence on overlap
+    label_lut = np.array([(b & -b).bit_length() for b in range(256)], dtype=np.uint8)
+    return hue_bits, sat_bits, val_bits, label_lut
+
+
+def classify_hsv(hsv_array, luts):
+    """Label every pixel of an HSV array with its phase class in a single pass.
+
+    Returns:
+        numpy.ndarray: uint8 label image, 0 for unclassified pixels and
+        i + 1 for pixels belonging to class i.
+    """
+    hue_bits, sat_bits, val_bits, label_lut = luts
+    bits = hue_bits[hsv_array[:, :, 0]]
+    bits &= sat_bits[hsv_array[:, :, 1]]
+    bits &= val_bits[hsv_array[:, :, 2]]
+    return label_lut[bits]
+
+
+def class_area_table(labels, classes, length_per_pixel=None):
+    """Return per-class (name, pixel count, area fraction, calibrated area) rows.
+
+    The calibrated area is None when no length_per_pixel is given.
+    """
+    counts = np.bincount(labels.ravel(), minlength=len(classes) + 1)
+    total = labels.size
+    rows = []
+    for index, phase in enumerate(classes):
+        count = int(counts[index + 1])
+        area = count * length_per_pixel ** 2 if length_per_pixel else None
+        rows.append((phase.name, count, count / total if total else 0.0, area))
+    return rows
+
+
+def false_color_overlay(rgb_array, labels, classes):
+    """Blend each class color at 50% over the pixels of that class."""
+    palette = np.zeros((len(classes) + 1, 3), dtype=np.uint16)
+    for index, phase in enumerate(classes):
+        palette[index + 1] = phase.color
+    overlay = rgb_array.copy()
+    classified = labels > 0
+    overlay[classified] = ((rgb_array[classified] + palette[labels[classified]]) >> 1).astype(np.uint8)
+    return overlay
+
+
+# Display modes for the thresholded image: (key, menu label)
+DISPLAY_MODES = [
+    ('mask', 'Mask (black background)'),
+    ('tint', 'Tinted overlay'),
+    ('outline', 'Outline only'),
+    ('dim', 'Dimmed background'),
+]
+
+# Overlay color and blend weights (out of 256) used by the display modes
+OVERLAY_COLOR = (255, 0, 255)
+TINT_ALPHA = 112
+DIM_FACTOR = 77
+
+
+def mask_outline(mask):
+    """Return the boundary pixels of a mask (selected pixels with an unselected 4-neighbour)."""
+    interior = mask.copy()
+    interior[1:, :] &= mask[:-1, :]
+    interior[:-1, :] &= mask[1:, :]
+    interior[:, 1:] &= mask[:, :-1]
+    interior[:, :-1] &= mask[:, 1:]
+    return mask & ~interior
+
+
+def composite_mask(rgb_array, mask, mode='mask', color=OVERLAY_COLOR):
+    """Composite an RGB crop with its threshold mask using integer arithmetic.
+
+    Modes:
+        'mask': rejected pixels are set to black.
+        'tint': selected pixels are blended with the overlay color.
+        'outline': the selection boundary is drawn over the original image.
+        'dim': rejected pixels are darkened, selected pixels stay untouched.
+
+    Only the output array is allocated; the inputs are never modified.
+    """
+    mask3 = mask[:, :, np.newaxis]
+    if mode == 'mask':
+        return rgb_array * mask3
+    if mode == 'tint':
+        tint = np.array(color, dtype=np.uint16) * TINT_ALPHA
+        blended = (np.multiply(rgb_array, 256 - TINT_ALPHA, dtype=np.uint16) + tint) >> 8
+        return np.where(mask3, blended, rgb_array).astype(np.uint8)
+    if mode == 'outline':
+        out = rgb_array.copy()
+        out[mask_outline(mask)] = color
+        return out
+    if mode == 'dim':
+        dimmed = np.multiply(rgb_array, DIM_FACTOR, dtype=np.uint16) >> 8
+        return np.where(mask3, rgb_array, dimmed).astype(np.uint8)
+    raise ValueError(f"Unknown display mode: {mode}")
+
+
+# Kernel backend for HSV conversion, thresholding and compositing: 'auto' uses
+# Numba when it is installed and NumPy otherwise; $HSV_WIZARD_KERNELS overrides it
+DEFAULT_KERNEL_BACKEND = 'auto'
+# Display modes the fused kernel composites per pixel (the outline needs neighbours)
+FUSED_MODES = ('mask', 'tint', 'dim')
+
+
+class NumpyKernels:
+    """Reference kernels: PIL's HSV conversion and NumPy array operations.
+
+    Every kernel backend produces exactly the same HSV values, masks and
+    composites as this one.
+    """
+
+    name = 'numpy'
+
+    def rgb_to_hsv(self, rgb_array, out=None):
+        """Convert an RGB uint8 array to 8-bit HSV, as PIL's convert('HSV') does."""
+        hsv = np.asarray(Image.fromarray(np.ascontiguousarray(rgb_array), 'RGB').convert('HSV'))
+        if out is None:
+            return hsv
+        out[...] = hsv
+        return out
+
+    def hsv_mask(self, hsv_array, bounds):
+        """Return the mask of an HSV array inside 8-bit bounds (from threshold_bounds())."""
+        h_low, h_high, s_low, s_high, v_low, v_high = bounds
+        if h_low <= h_high:
+            hue_mask = (hsv_array[:, :, 0] >= h_low) & (hsv_array[:, :, 0] <= h_high)
+        else:
+            hue_mask = (hsv_array[:, :, 0] >= h_low) | (hsv_array[:, :, 0] <= h_high)
+        sat_mask = (hsv_array[:, :, 1] >= s_low) & (hsv_array[:, :, 1] <= s_high)
+        val_mask = (hsv_array[:, :, 2] >= v_low) & (hsv_array[:, :, 2] <= v_high)
+        return hue_mask & sat_mask & val_mask
+
+    def mask_rgb(self, rgb_array, bounds, mode='mask'):
+        """Convert, threshold and composite an RGB array; return (composite, mask)."""
+        mask = self.hsv_mask(self.rgb_to_hsv(rgb_array), bounds)
+        return composite_mask(rgb_array, mask, mode), mask
+
+
+def _compile_numba_kernels():
+    """Compile the Numba kernels; raises ImportError when Numba is not installed.
+
+    The kernels are compiled eagerly for any memory layout, and read-only
+    inputs such as memory-mapped cache files, so no call recompiles them.
+    """
+    import numba
+    from numba import types
+
+    image = types.Array(types.uint8, 3, 'A')
+    image_in = types.Array(types.uint8, 3, 'A', readonly=True)
+    mask_out = types.Array(types.boolean, 2, 'A')
+    params = types.Array(types.int32, 1, 'A', readonly=True)
+
+    @numba.njit(inline='always')
+    def pixel_hsv(r, g, b):
+        # PIL's rgb2hsv, including its mix of single and double precision, so the levels match exactly
+        maxc = max(r, g, b)
+        minc = min(r, g, b)
+        if maxc == minc:
+            return 0, 0, maxc
+        cr = np.float32(maxc - minc)
+        s = cr / np.float32(maxc)
+        rc = np.float32(maxc - r) / cr
+        gc = np.float32(maxc - g) / cr
+        bc = np.float32(maxc - b) / cr
+        if r == maxc:
+            h = np.float32(bc - gc)
+        elif g == maxc:
+            h = np.float32(2.0 + np.float64(rc) - np.float64(bc))
+        else:
+            h = np.float32(4.0 + np.float64(gc) - np.float64(rc))
+        h = np.float32(np.fmod(np.float64(h) / 6.0 + 1.0, 1.0))
+        return min(int(np.float64(h) * 255.0), 255), min(int(np.float64(s) * 255.0), 255), maxc
+
+    @numba.njit(inline='always')
+    def inside(h, s, v, bounds):
+        h_low, h_high, s_low, s_high, v_low, v_high = bounds
+        if h_low <= h_high:
+            hue = h_low <= h <= h_high
+        else:
+            hue = h >= h_low or h <= h_high
+        return hue and s_low <= s <= s_high and v_low <= v <= v_high
+
+    @numba.njit(types.void(image_in, image), parallel=True, nogil=True)
+    def convert(rgb, out):
+        for y in numba.prange(rgb.shape[0]):
+            for x in range(rgb.shape[1]):
+                h, s, v = pixel_hsv(np.int32(rgb[y, x, 0]), np.int32(rgb[y, x, 1]), np.int32(rgb[y, x, 2]))
+                out[y, x, 0] = h
+                out[y, x, 1] = s
+                out[y, x, 2] = v
+
+    @numba.njit(types.void(image_in, params, mask_out), parallel=True, nogil=True)
+    def threshold(hsv, bounds, mask):
+        for y in numba.prange(hsv.shape[0]):
+            for x in range(hsv.shape[1]):
+                mask[y, x] = inside(np.int32(hsv[y, x, 0]), np.int32(hsv[y, x, 1]), np.int32(hsv[y, x, 2]), bounds)
+
+    @numba.njit(types.void(image_in, params, types.int64, params, types.int64, types.int64, image, mask_out),
+                parallel=True, nogil=True)
+    def fused(rgb, bounds, mode, color, tint_alpha, dim_factor, out, mask):
+        # mode: 0 mask, 1 tint, 2 dim, -1 mask only
+        for y in numba.prange(rgb.shape[0]):
+            for x in range(rgb.shape[1]):
+                r, g, b = np.int32(rgb[y, x, 0]), np.int32(rgb[y, x, 1]), np.int32(rgb[y, x, 2])
+                h, s, v = pixel_hsv(r, g, b)
+                selected = inside(h, s, v, bounds)
+                mask[y, x] = selected
+                if mode < 0:
+                    continue
+                for c in range(3):
+                    value = np.int32(rgb[y, x, c])
+                    if mode == 0:
+                        out[y, x, c] = value if selected else 0
+                    elif mode == 1:
+                        out[y, x, c] = (value * (256 - tint_alpha) + color[c] * tint_alpha) >> 8 if selected else value
+                    else:
+                        out[y, x, c] = value if selected else (value * dim_factor) >> 8
+
+    return convert, threshold, fused
+
+
+class NumbaKernels(NumpyKernels):
+    """Fused, parallel kernels JIT-compiled with Numba (an optional dependency).
+
+    Each pixel is converted to HSV, thresholded and composited in one pass
+    over the image, spread across cores, without the temporaries of the
+    NumPy path. The conversion reproduces PIL's arithmetic, so masks are
+    identical to those of NumpyKernels. Compilation happens once, on
+    construction.
+    """
+
+    name = 'numba'
+
+    def __init__(self):
+        self._convert, self._threshold, self._fused = _compile_numba_kernels()
+        self._color = np.asarray(OVERLAY_COLOR, dtype=np.int32)
+
+    def rgb_to_hsv(self, rgb_array, out=None):
+        if out is None:
+            out = np.empty(rgb_array.shape, dtype=np.uint8)
+        # asarray() passes memory maps on as plain arrays
+        self._convert(np.asarray(rgb_array), out)
+        return out
+
+    def hsv_mask(self, hsv_array, bounds):
+        mask = np.empty(hsv_array.shape[:2], dtype=bool)
+        self._threshold(np.asarray(hsv_array), np.asarray(bounds, dtype=np.int32), mask)
+        return mask
+
+    def mask_rgb(self, rgb_array, bounds, mode='mask'):
+        rgb_array = np.asarray(rgb_array)
+        mask = np.empty(rgb_array.shape[:2], dtype=bool)
+        if mode in FUSED_MODES:
+            out = np.empty(rgb_array.shape, dtype=np.uint8)
+            code = FUSED_MODES.index(mode)
+        else:
+            # Only the mask is computed in the fused pass; `out` is not written
+            out = np.empty((1, 1, 3), dtype=np.uint8)
+            code = -1
+        self._fused(rgb_array, np.asarray(bounds, dtype=np.int32), code, self._color, TINT_ALPHA, DIM_FACTOR, out, mask)
+        if code < 0:
+            return composite_mask(rgb_array, mask, mode), mask
+        return out, mask
+
+
+KERNEL_BACKENDS = {'numpy': NumpyKernels, 'numba': NumbaKernels}
+_kernels = None
+
+
+def set_kernels(name=None):
+    """Select the kernel backend by name and return it.
+
+    'auto' (the default, or $HSV_WIZARD_KERNELS) prefers Numba and falls back
+    to NumPy when it is not installed; naming 'numba' explicitly raises
+    ImportError instead.
+    """
+    global _kernels
+    name = name or os.environ.get('HSV_WIZARD_KERNELS') or DEFAULT_KERNEL_BACKEND
+    if name == 'auto':
+        try:
+            _kernels = NumbaKernels()
+        except ImportError:
+            _kernels = NumpyKernels()
+    elif name in KERNEL_BACKENDS:
+        _kernels = KERNEL_BACKENDS[name]()
+    else:
+        raise ValueError(f"Unknown kernel backend: {name}")
+    return _kernels
+
+
+def get_kernels():
+    """Return the current kernel backend, selecting the default one on first use."""
+    return _kernels if _kernels is not None else set_kernels()
+
+
+# Color picker sampling: half-size of the local window the region may grow in,
+# radius of the plain neighbourhood sample, and similarity tolerances (8-bit HSV units)
+PICKER_WINDOW = 96
+PICKER_NEIGHBOURHOOD = 3
+PICKER_TOLERANCE = (10, 40, 40)
+# Percentiles of the sample distribution used as threshold bounds
+PICKER_PERCENTILES = (2.0, 98.0)
+# Cap on accumulated samples when extending the selection with shift-click
+PICKER_MAX_SAMPLES = 200000
+
+
+def hue_distance(hue, reference):
+    """Circular distance between 8-bit hue values (period 255, see thresholds_from_samples())."""
+    diff = np.abs(hue.astype(np.int16) - np.int16(reference))
+    return np.minimum(diff, 255 - diff)
+
+
+def grow_region(hsv_window, seed, tolerance=PICKER_TOLERANCE, max_iterations=None):
+    """Flood-fill the region of similar color around a seed inside a local window.
+
+    A pixel is similar when its hue, saturation and value are all within
+    tolerance of the seed color (the median of the seed's 3x3 neighbourhood).
+    The region grows breadth-first from the seed, adding the similar
+    8-connected neighbours of the last added pixels (the frontier) until no
+    new pixel is found. Each step costs only as much as its frontier, so the
+    total work is bounded by the window size, not the image size, however
+    winding the region is.
+
+    Args:
+        hsv_window: uint8 HSV array of the local window.
+        seed: (row, col) of the click inside the window.
+        tolerance: (hue, saturation, value) tolerances in 8-bit units.
+        max_iterations: Optional cap on growth steps (by default the region grows until it stops).
+
+    Returns:
+        numpy.ndarray: Boolean mask of the grown region.
+    """
+    rows, cols = hsv_window.shape[:2]
+    row, col = seed
+    patch = hsv_window[max(row - 1, 0):row + 2, max(col - 1, 0):col + 2].reshape(-1, 3)
+    seed_color = np.median(patch, axis=0)
+
+    similar = hue_distance(hsv_window[:, :, 0], int(seed_color[0])) <= tolerance[0]
+    similar &= np.abs(hsv_window[:, :, 1].astype(np.int16) - int(seed_color[1])) <= tolerance[1]
+    similar &= np.abs(hsv_window[:, :, 2].astype(np.int16) - int(seed_color[2])) <= tolerance[2]
+
+    region = np.zeros((rows, cols), dtype=bool)
+    region[row, col] = True
+    if not similar[row, col]:
+        return region
+
+    if max_iterations is None:
+        # Every step adds at least one pixel
+        max_iterations = rows * cols
+    offsets = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)])
+    flat_region = region.ravel()
+    flat_similar = similar.ravel()
+    frontier = np.array([[row, col]])
+    for _ in range(max_iterations):
+        neighbours = (frontier[:, np.newaxis, :] + offsets).reshape(-1, 2)
+        inside = ((neighbours[:, 0] >= 0) & (neighbours[:, 0] < rows)
+                  & (neighbours[:, 1] >= 0) & (neighbours[:, 1] < cols))
+        index = np.unique(neighbours[inside, 0] * cols + neighbours[inside, 1])
+        index = index[flat_similar[index] & ~flat_region[index]]
+        if not len(index):
+            break
+        flat_region[index] = True
+        frontier = np.column_stack(np.divmod(index, cols))
+    return region
+
+
+def thresholds_from_samples(hsv_samples, percentiles=PICKER_PERCENTILES):
+    """Derive an HSV threshold window from sampled HSV pixels.
+
+    Saturation and value bounds are the given percentiles of the samples. Hue is
+    circular, so the samples are rotated to centre their circular mean before
+    taking percentiles; the resulting window may wrap around 0°.
+
+    Args:
+        hsv_samples: (N, 3) uint8 array of HSV samples.
+        percentiles: (lower, upper) percentiles used as bounds.
+
+    Returns:
+        tuple: (hue_low, hue_high, sat_low, sat_high, val_low, val_high) in degrees and percent.
+    """
+    hsv_samples = np.asarray(hsv_samples).reshape(-1, 3)
+    lower, upper = percentiles
+
+    # 8-bit hue levels have a period of 255 (level 255 is 360°, the same hue as level 0)
+    angles = hsv_samples[:, 0] * (2 * np.pi / 255)
+    mean_angle = np.arctan2(np.sin(angles).mean(), np.cos(angles).mean())
+    centre = int(round(mean_angle * 255 / (2 * np.pi))) % 255
+    rotated = (hsv_samples[:, 0].astype(np.int16) - centre + 127) % 255
+    hue_low_8, hue_high_8 = np.percentile(rotated, [lower, upper])
+    hue_low = level_to_threshold((int(np.floor(hue_low_8)) + centre - 127) % 255, 360)
+    hue_high = level_to_threshold((int(np.ceil(hue_high_8)) + centre - 127) % 255, 360)
+
+    sat_low, sat_high = np.percentile(hsv_samples[:, 1], [lower, upper])
+    val_low, val_high = np.percentile(hsv_samples[:, 2], [lower, upper])
+    return (hue_low, hue_high,
+            level_to_threshold(int(np.floor(sat_low)), 100), level_to_threshold(int(np.ceil(sat_high)), 100),
+            level_to_threshold(int(np.floor(val_low)), 100), level_to_threshold(int(np.ceil(val_high)), 100))
+
+class MeasurementStore:
+    """Columnar, NumPy-backed store of line measurements.
+
+    End points are kept in image pixel coordinates so measurements are
+    independent of the zoom level. Rows live in a preallocated float64 array
+    that doubles in size when full, so appends are amortized O(1). The mean
+    and standard deviation are computed from the stored length column, so
+    they stay exact however many rows are added and removed.
+
+    Rows created by automatic feature measurement also carry the minimum
+    Feret diameter, skeleton length and area of their object; these columns
+    are NaN for manually drawn lines.
+    """
+
+    COLUMNS = ('x0', 'y0', 'x1', 'y1', 'length', 'angle', 'timestamp',
+               'feret_min', 'skeleton_length', 'area')
+
+    def __init__(self, capacity=64):
+        self._data = np.zeros((capacity, len(self.COLUMNS)))
+        self.labels = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, x0, y0, x1, y1, length, label='', timestamp=None,
+               feret_min=math.nan, skeleton_length=math.nan, area=math.nan):
+        """Add a measurement and return its index.
+
+        Args:
+            x0, y0, x1, y1: End points in image pixel coordinates.
+            length: Measured length in calibrated units.
+            label: Optional free-text label.
+            timestamp: Seconds since the epoch (defaults to now).
+            feret_min, skeleton_length, area: Object metrics from feature measurement.
+        """
+        if self._count == len(self._data):
+            grown = np.zeros((2 * len(self._data), len(self.COLUMNS)))
+            grown[:self._count] = self._data[:self._count]
+            self._data = grown
+        # Angle in degrees counter-clockwise from the +x axis (image y points down)
+        angle = math.degrees(math.atan2(y0 - y1, x1 - x0))
+        if timestamp is None:
+            timestamp = time.time()
+        self._data[self._count] = (x0, y0, x1, y1, length, angle, timestamp,
+                                   feret_min, skeleton_length, area)
+        self.labels.append(label)
+        self._count += 1
+        return self._count - 1
+
+    def pop(self):
+        """Remove the last measurement and return it as a dict."""
+        if not self._count:
+            raise IndexError("pop from empty measurement store")
+        row = self.row(self._count - 1)
+        self._count -= 1
+        self.labels.pop()
+        return row
+
+    def clear(self):
+        self._count = 0
+        self.labels.clear()
+
+    def column(self, name):
+        """Return a read-only view of one column for the stored rows."""
+        view = self._data[:self._count, self.COLUMNS.index(name)]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def lengths(self):
+        return self.column('length')
+
+    def row(self, index):
+        """Return measurement `index` as a dict including its label."""
+        if not -self._count <= index < self._count:
+            raise IndexError("measurement index out of range")
+        index %= self._count
+        row = dict(zip(self.COLUMNS, self._data[index].tolist()))
+        row['label'] = self.labels[index]
+        return row
+
+    def summary(self):
+        """Return (count, mean, standard deviation) of the lengths."""
+        if not self._count:
+            return 0, None, None
+        lengths = self.lengths
+        mean = float(lengths.mean())
+        if self._count < 2:
+            return self._count, mean, 0.0
+        return self._count, mean, float(lengths.std(ddof=1))
+
+    def histogram(self, bins=10):
+        """Return (counts, bin_edges) of the lengths."""
+        return np.histogram(self.lengths, bins=bins)
+
+    def rows(self):
+        """Return all measurements as a tuple of (values, label), e.g. for the undo history.
+
+        NaN metrics are returned as None, so equal rows compare equal.
+        """
+        values = [tuple(None if v != v else v for v in row) for row in self._data[:self._count].tolist()]
+        return tuple(zip(values, self.labels))
+
+    def set_rows(self, rows):
+        """Replace the measurements by `rows` (as returned by rows()); return the number of rows kept."""
+        current = self.rows()
+        prefix = 0
+        limit = min(len(current), len(rows))
+        while prefix < limit and current[prefix] == rows[prefix]:
+            prefix += 1
+        while self._count > prefix:
+            self.pop()
+        for values, label in rows[prefix:]:
+            x0, y0, x1, y1, length, _, timestamp, feret_min, skeleton_length, area = (
+                math.nan if v is None else v for v in values)
+            self.append(x0, y0, x1, y1, length, label=label, timestamp=timestamp,
+                        feret_min=feret_min, skeleton_length=skeleton_length, area=area)
+        return prefix
+
+
+# Bounds of the undo history (entries, and values held in their deltas) and the
+# pause after which consecutive changes of the same kind are no longer merged
+HISTORY_MAX_ENTRIES = 1000
+HISTORY_MAX_VALUES = 100000
+HISTORY_COALESCE_SECONDS = 1.0
+
+
+def _field_delta(old, new):
+    """Return a compact change of one state field: tuples keep only what follows their common prefix."""
+    if isinstance(old, tuple) and isinstance(new, tuple):
+        prefix = 0
+        limit = min(len(old), len(new))
+        while prefix < limit and old[prefix] == new[prefix]:
+            prefix += 1
+        return ('tail', prefix, old[prefix:], new[prefix:])
+    return ('value', old, new)
+
+
+def _apply_field_delta(value, delta, forward):
+    if delta[0] == 'tail':
+        _, prefix, old_tail, new_tail = delta
+        return value[:prefix] + (new_tail if forward else old_tail)
+    return delta[2] if forward else delta[1]
+
+
+def _delta_size(delta):
+    return sum(len(d[2]) + len(d[3]) + 1 if d[0] == 'tail' else 2 for d in delta.values())
+
+
+class HistoryManager:
+    """Undo/redo history of the app state, stored as compact deltas.
+
+    The state is a dict of fields with comparable values. Each recorded
+    change keeps only the fields that changed, and of tuple fields (e.g. the
+    list of measurements) only the part after their common prefix, so adding
+    one measurement costs one row. Changes recorded with the same coalesce
+    key in quick succession (a slider drag) are merged into one entry.
+
+    undo() and redo() move any number of steps and return the resulting
+    state, which the caller applies once. The history is bounded by the
+    number of entries and of values held in deltas; the oldest entries are
+    dropped first.
+    """
+
+    def __init__(self, state=None, max_entries=HISTORY_MAX_ENTRIES, max_values=HISTORY_MAX_VALUES,
+                 coalesce_seconds=HISTORY_COALESCE_SECONDS, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_values = max_values
+        self.coalesce_seconds = coalesce_seconds
+        self.clock = clock
+        self.reset(state or {})
+
+    def reset(self, state):
+        """Forget all entries and start from `state`."""
+        self.current = dict(state)
+        self.entries = []
+        self.position = 0
+        self.size = 0
+        self._coalesce = None
+        self._last_time = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.entries)
+
+    def labels(self):
+        """Return the labels of all entries, oldest first; the first `position` are undoable."""
+        return [entry['label'] for entry in self.entries]
+
+    def record(self, label, changes, coalesce=None):
+        """Record new values of some fields; return True if the history changed.
+
+        With a coalesce key equal to that of the previous change, recorded
+        within coalesce_seconds of it, the previous entry is extended instead.
+        """
+        now = self.clock()
+        merge = (coalesce is not None and coalesce == self._coalesce and self.position == len(self.entries)
+                 and self.position > 0 and now - self._last_time <= self.coalesce_seconds)
+        self._last_time = now
+        self._coalesce = coalesce
+        if merge:
+            entry = self.entries[-1]
+            # The state before the previous entry; fields it did not change still have their current value
+            before = {field: _apply_field_delta(self.current.get(field), delta, False)
+                      for field, delta in entry['delta'].items()}
+            after = dict(self.current, **changes)
+            self.size -= _delta_size(entry['delta'])
+            delta = {}
+            for field in set(before) | set(changes):
+                old = before[field] if field in before else self.current.get(field)
+                if old != after.get(field):
+                    delta[field] = _field_delta(old, after.get(field))
+            self.current = after
+            if delta:
+                entry['delta'] = delta
+                self.size += _delta_size(delta)
+            else:
+                # The drag ended where it started
+                self.entries.pop()
+                self.position -= 1
+                self._coalesce = None
+            return True
+        delta = {field: _field_delta(self.current.get(field), value) for field, value in changes.items()
+                 if self.current.get(field) != value}
+        if not delta:
+            return False
+        for entry in self.entries[self.position:]:
+            self.size -= _delta_size(entry['delta'])
+        del self.entries[self.position:]
+        self.current.update(changes)
+        self.entries.append({'label': label, 'delta': delta})
+        self.position += 1
+        self.size += _delta_size(delta)
+        self._trim()
+        return True
+
+    def _trim(self):
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_values):
+            if self.position > 0:
+                entry = self.entries.pop(0)
+                self.position -= 1
+            else:
+                entry = self.entries.pop()
+            self.size -= _delta_size(entry['delta'])
+
+    def undo(self, steps=1):
+        """Step back up to `steps` entries; return the resulting state, or None if there is nothing to undo."""
+        steps = min(steps, self.position)
+        if steps <= 0:
+            return None
+        state = dict(self.current)
+        for entry in reversed(self.entries[self.position - steps:self.position]):
+            for field, delta in entry['delta'].items():
+                state[field] = _apply_field_delta(state[field], delta, False)
+        self.position -= steps
+        self.current = state
+        self._coalesce = None
+        return dict(state)
+
+    def redo(self, steps=1):
+        """Step forward up to `steps` undone entries; return the resulting state, or None."""
+        steps = min(steps, len(self.entries) - self.position)
+        if steps <= 0:
+            return None
+        state = dict(self.current)
+        for entry in self.entries[self.position:self.position + steps]:
+            for field, delta in entry['delta'].items():
+                state[field] = _apply_field_delta(state.get(field), delta, True)
+        self.position += steps
+        self.current = state
+        self._coalesce = None
+        return dict(state)
+
+
+def mask_runs(mask, row_offset=0):
+    """Run-length encode a boolean mask row by row.
+
+    Returns:
+        tuple: (rows, starts, ends) int64 arrays in row-major order; ends are exclusive.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=bool)
+    padded[:, 1:-1] = mask
+    # Value changes alternate between run starts and run ends within each row
+    rows, cols = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    return rows[0::2].astype(np.int64) + row_offset, cols[0::2].astype(np.int64), cols[1::2].astype(np.int64)
+
+
+def label_runs(rows, starts, ends, connectivity=8):
+    """Group runs into connected components.
+
+    Runs of adjacent rows that overlap (or touch diagonally, for 8-connectivity)
+    are linked. Candidate neighbours of every run are found with binary searches
+    and components are resolved by vectorized root hooking with pointer
+    jumping, which needs only a logarithmic number of rounds.
+
+    Args:
+        rows, starts, ends: Runs in row-major order, as returned by mask_runs.
+        connectivity: 4 or 8.
+
+    Returns:
+        tuple: (labels, count) with a 0-based component label per run.
+    """
+    n = len(rows)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    stride = int(ends.max()) + 2
+    start_key = rows * stride + starts
+    end_key = rows * stride + ends
+    previous = (rows - 1) * stride
+    if connectivity == 8:
+        lo = np.searchsorted(end_key, previous + starts, side='left')
+        hi = np.searchsorted(start_key, previous + ends, side='right')
+    else:
+        lo = np.searchsorted(end_key, previous + starts, side='right')
+        hi = np.searchsorted(start_key, previous + ends, side='left')
+    counts = np.maximum(hi - lo, 0)
+    current = np.repeat(np.arange(n), counts)
+    first = np.repeat(lo - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    neighbour = first + np.arange(len(current))
+
+    # Shiloach-Vishkin style: hook roots onto smaller roots, then compress paths
+    parent = np.arange(n)
+    while len(current):
+        root_a, root_b = parent[current], parent[neighbour]
+        active = root_a != root_b
+        if not active.any():
+            break
+        current, neighbour = current[active], neighbour[active]
+        root_a, root_b = root_a[active], root_b[active]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    labels = parent
+    unique, compact = np.unique(labels, return_inverse=True)
+    return compact.ravel(), len(unique)
+
+
+def paint_runs(shape, rows, starts, ends):
+    """Rasterize non-overlapping runs into a boolean mask."""
+    edges = np.zeros((shape[0], shape[1] + 1), dtype=np.int8)
+    edges[rows, starts] += 1
+    edges[rows, ends] -= 1
+    return np.cumsum(edges, axis=1, dtype=np.int8)[:, :-1] > 0
+
+
+class RunLengthMask:
+    """Boolean mask stored as the runs of selected pixels of each row.
+
+    Runs are kept in row-major order as int32 (row, start, end) arrays with
+    exclusive ends, so a sparse selection of a large image costs 12 bytes per
+    run instead of one byte per pixel. Set operations work on the runs
+    flattened to intervals of a single axis (rows are separated by a gap so
+    runs never merge across rows), and rasterization paints only the runs
+    inside the requested box.
+    """
+
+    def __init__(self, shape, rows, starts, ends):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.ends = np.asarray(ends, dtype=np.int32)
+
+    @classmethod
+    def from_mask(cls, mask, row_offset=0, shape=None):
+        """Encode a dense mask; row_offset and shape place a strip within a larger mask."""
+        return cls(mask.shape if shape is None else shape, *mask_runs(mask, row_offset))
+
+    @classmethod
+    def concatenate(cls, shape, parts):
+        """Join masks of consecutive, non-overlapping row strips."""
+        if not parts:
+            return cls(shape, [], [], [])
+        return cls(shape, np.concatenate([p.rows for p in parts]),
+                   np.concatenate([p.starts for p in parts]), np.concatenate([p.ends for p in parts]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def area(self):
+        """Number of selected pixels."""
+        return int(np.sum(self.ends - self.starts, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.starts.nbytes + self.ends.nbytes
+
+    def bbox(self):
+        """Return the bounding box (x0, y0, x1, y1) of the selection, or None if empty."""
+        if not len(self.rows):
+            return None
+        return int(self.starts.min()), int(self.rows[0]), int(self.ends.max()), int(self.rows[-1]) + 1
+
+    def _intervals(self):
+        stride = self.shape[1] + 1
+        base = self.rows.astype(np.int64) * stride
+        return base + self.starts, base + self.ends
+
+    def _from_intervals(self, starts, ends):
+        stride = self.shape[1] + 1
+        rows = starts // stride
+        return RunLengthMask(self.shape, rows, starts - rows * stride, ends - rows * stride)
+
+    def _sweep(self, parts, minimum):
+        """Combine (starts, ends, weight) interval sets; keep where the weighted cover >= minimum."""
+        positions = np.concatenate([p for starts, ends, _ in parts for p in (starts, ends)])
+        deltas = np.concatenate([np.full(len(starts), weight) for starts, ends, weight in parts for _ in (0, 1)])
+        signs = np.concatenate([s for starts, ends, _ in parts
+                                for s in (np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64))])
+        if not len(positions):
+            return RunLengthMask(self.shape, [], [], [])
+        unique, inverse = np.unique(positions, return_inverse=True)
+        cover = np.cumsum(np.bincount(inverse.ravel(), weights=deltas * signs, minlength=len(unique)))
+        inside = np.round(cover).astype(np.int64) >= minimum
+        before = np.r_[False, inside[:-1]]
+        return self._from_intervals(unique[inside & ~before], unique[~inside & before])
+
+    def union(self, other):
+        return self._sweep([(*self._intervals(), 1), (*other._intervals(), 1)], 1)
+
+    def intersection(self, other):
+        return self._sweep([(*self._intervals(), 1), (*other._intervals(), 1)], 2)
+
+    __or__ = union
+    __and__ = intersection
+
+    def complement(self):
+        height, width = self.shape
+        stride = width + 1
+        row_starts = np.arange(height, dtype=np.int64) * stride
+        return self._sweep([(row_starts, row_starts + width, 1), (*self._intervals(), -1)], 1)
+
+    def select(self, keep):
+        """Return the mask made of the runs where the boolean array `keep` is True."""
+        return RunLengthMask(self.shape, self.rows[keep], self.starts[keep], self.ends[keep])
+
+    def shifted(self, dx, dy, shape):
+        """Return this mask moved by (dx, dy) into a mask of the given (larger) shape."""
+        return RunLengthMask(shape, self.rows + dy, self.starts + dx, self.ends + dx)
+
+    def label(self, connectivity=8):
+        """Return (labels, count): a connected-component label for every run."""
+        return label_runs(self.rows.astype(np.int64), self.starts.astype(np.int64),
+                          self.ends.astype(np.int64), connectivity)
+
+    def _on_border(self):
+        height, width = self.shape
+        return (self.rows == 0) | (self.rows == height - 1) | (self.starts == 0) | (self.ends == width)
+
+    def fill_holes(self):
+        """Fill background regions that do not touch the border.
+
+        Background components are 4-connected, the complement of the
+        8-connected foreground used for objects.
+        """
+        background = self.complement()
+        labels, count = background.label(connectivity=4)
+        outside = np.zeros(count, dtype=bool)
+        outside[labels[background._on_border()]] = True
+        return self.union(background.select(~outside[labels]))
+
+    def remove_small_objects(self, min_size, keep_border_objects=False, connectivity=8):
+        """Drop objects smaller than `min_size` pixels, optionally sparing those touching the border."""
+        labels, count = self.label(connectivity)
+        areas = np.bincount(labels, weights=self.ends - self.starts, minlength=count)
+        small = areas < min_size
+        if keep_border_objects:
+            small[labels[self._on_border()]] = False
+        return self.select(~small[labels])
+
+    def rasterize(self, box=None, step=1):
+        """Paint the selection inside box (x0, y0, x1, y1) into a dense boolean array.
+
+        With step > 1 only every step-th row and column is sampled, giving an
+        array of ceil(height / step) x ceil(width / step).
+        """
+        x0, y0, x1, y1 = box if box is not None else (0, 0, self.shape[1], self.shape[0])
+        lo, hi = np.searchsorted(self.rows, (y0, y1))
+        rows = self.rows[lo:hi] - y0
+        starts = np.clip(self.starts[lo:hi] - x0, 0, x1 - x0)
+        ends = np.clip(self.ends[lo:hi] - x0, 0, x1 - x0)
+        if step > 1:
+            sampled = rows % step == 0
+            rows, starts, ends = rows[sampled] // step, starts[sampled], ends[sampled]
+            # Sample columns c * step that fall inside [start, end)
+            starts, ends = -(-starts // step), -(-ends // step)
+        keep = ends > starts
+        shape = (-(-(y1 - y0) // step), -(-(x1 - x0) // step))
+        return paint_runs(shape, rows[keep], starts[keep], ends[keep])
+
+    def to_mask(self):
+        return self.rasterize()
+
+
+def compute_hsv_runs(hsv_array, hue_low, hue_high, sat_low, sat_high, val_low, val_high,
+                     strip_rows=512):
+    """Threshold an HSV image into a RunLengthMask, a strip at a time.
+
+    Only one strip of the dense mask exists at any time.
+    """
+    height = hsv_array.shape[0]
+    strips = [RunLengthMask.from_mask(
+        compute_hsv_mask(hsv_array[top:top + strip_rows], hue_low, hue_high, sat_low, sat_high, val_low, val_high),
+        row_offset=top, shape=hsv_array.shape[:2]) for top in range(0, height, strip_rows)]
+    return RunLengthMask.concatenate(hsv_array.shape[:2], strips)
+
+
+def composite_runs(rgb_array, mask, mode='mask', strip_rows=512):
+    """Composite a full image with a RunLengthMask, rasterizing one strip at a time.
+
+    Strips carry a one-row halo so outlines match composite_mask() on the
+    whole image.
+    """
+    height = mask.shape[0]
+    out = np.empty_like(rgb_array)
+    for top in range(0, height, strip_rows):
+        bottom = min(top + strip_rows, height)
+        out[top:bottom] = composite_runs_strip(rgb_array, mask, top, bottom, mode)
+    return out
+
+
+def composite_runs_strip(rgb_array, mask, top, bottom, mode='mask'):
+    """Composite rows top:bottom of an image with a RunLengthMask, as composite_runs() does."""
+    height, width = mask.shape
+    h0, h1 = max(top - 1, 0), min(bottom + 1, height)
+    strip = composite_mask(rgb_array[h0:h1], mask.rasterize((0, h0, width, h1)), mode)
+    return strip[top - h0:bottom - h0]
+
+
+# Edge length of the tiles of exported pyramids, and zlib level of TIFF tiles
+PYRAMID_TILE_SIZE = 256
+PYRAMID_DEFLATE_LEVEL = 6
+# Encoded strips per level that may wait for the encoder threads
+PYRAMID_PENDING_STRIPS = 2
+
+
+def pyramid_sizes(size, min_size=1):
+    """Return the (width, height) of each pyramid level, halving (rounding up) until both fit in min_size."""
+    sizes = [tuple(size)]
+    while max(sizes[-1]) > min_size:
+        width, height = sizes[-1]
+        sizes.append(((width + 1) // 2, (height + 1) // 2))
+    return sizes
+
+
+def downsample_half(rows):
+    """Halve an RGB strip in both directions by 2x2 box averaging; odd edges are repeated."""
+    if rows.shape[0] % 2:
+        rows = np.concatenate([rows, rows[-1:]])
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+    total = rows[0::2, 0::2].astype(np.uint16) + rows[1::2, 0::2] + rows[0::2, 1::2] + rows[1::2, 1::2]
+    return ((total + 2) >> 2).astype(np.uint8)
+
+
+def pyramid_strips(read_strip, size, levels, strip_rows=PYRAMID_TILE_SIZE):
+    """Stream all levels of an image pyramid, strip by strip.
+
+    read_strip(top, bottom) returns rows top:bottom of the full-resolution
+    RGB image; it is called once per strip, in order. Every strip is halved
+    into the next level as soon as it is complete, so only about one strip
+    per level is held at a time, however large the image.
+
+    Yields:
+        tuple: (level, top, strip) with level 0 at full resolution. The
+        strips of a level arrive in order and are strip_rows high, except
+        the last one.
+    """
+    heights = [height for _, height in pyramid_sizes(size)[:levels]]
+    # Rows waiting to be emitted per level, the next row to emit, and an odd row left over for halving
+    buffers = [[] for _ in range(levels)]
+    tops = [0] * levels
+    carries = [None] * levels
+
+    def buffered(level):
+        return sum(len(rows) for rows in buffers[level])
+
+    def emit(level):
+        """Yield the complete strips of a level and halve them into the next."""
+        while buffers[level]:
+            available = buffered(level)
+            last = tops[level] + available >= heights[level]
+            if available < strip_rows and not last:
+                return
+            rows = np.concatenate(buffers[level]) if len(buffers[level]) > 1 else buffers[level][0]
+            strip, rest = rows[:strip_rows], rows[strip_rows:]
+            buffers[level] = [rest] if len(rest) else []
+            yield level, tops[level], strip
+            tops[level] += len(strip)
+            if level + 1 < levels:
+                if carries[level] is not None:
+                    strip = np.concatenate([carries[level], strip])
+                    carries[level] = None
+                if len(strip) % 2 and tops[level] < heights[level]:
+                    carries[level] = strip[-1:]
+                    strip = strip[:-1]
+                if len(strip):
+                    buffers[level + 1].append(downsample_half(strip))
+                    yield from emit(level + 1)
+
+    for top in range(0, size[1], strip_rows):
+        buffers[0].append(np.asarray(read_strip(top, min(top + strip_rows, size[1]))))
+        yield from emit(0)
+
+
+def _tile_grid(strip, tile_size):
+    """Cut a strip into tile_size x tile_size tiles, left to right; edge tiles are zero-padded."""
+    height, width = strip.shape[:2]
+    for left in range(0, width, tile_size):
+        tile = strip[:, left:left + tile_size]
+        if tile.shape[:2] != (tile_size, tile_size):
+            padded = np.zeros((tile_size, tile_size) + strip.shape[2:], dtype=strip.dtype)
+            padded[:height, :tile.shape[1]] = tile
+            tile = padded
+        yield tile
+
+
+def _deflate_tile(tile, level=PYRAMID_DEFLATE_LEVEL):
+    # zlib releases the GIL, so tiles compress in parallel on the encoder threads
+    return zlib.compress(np.ascontiguousarray(tile).data, level)
+
+
+def tiff_resolution(length_per_pixel, units):
+    """Return the pixels per centimetre of a calibration, or None if its unit is not a length unit."""
+    scale = LENGTH_UNITS.get(units) if units else None
+    if not length_per_pixel or scale is None:
+        return None
+    return 1e-2 / (length_per_pixel * scale)
+
+
+class _TileWriter(ABC):
+    """Base of the pyramid writers: encodes the tiles of each strip on a thread pool.
+
+    Subclasses submit the encoding of a strip's tiles in submit_tiles() and
+    store the results, in order, in store_tiles(). At most
+    PYRAMID_PENDING_STRIPS strips per level wait for the encoder threads, which
+    bounds the memory held by queued tiles. If the export fails, abort()
+    removes the partial output.
+    """
+
+    def __init__(self, sizes, tile_size, workers):
+        self.sizes = sizes
+        self.tile_size = tile_size
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count())
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                self.close()
+                return
+            except BaseException:
+                # E.g. the disk filled up while the last tiles were stored
+                self._discard()
+                raise
+        self._discard()
+
+    def _discard(self):
+        for _, futures in self.pending:
+            for future in futures:
+                future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        self.abort()
+
+    def write_strip(self, level, top, strip):
+        """Encode the tiles of a strip (as yielded by pyramid_strips()); top is a multiple of the tile size."""
+        self.pending.append((level, self.submit_tiles(level, top, strip)))
+        while len(self.pending) > PYRAMID_PENDING_STRIPS * len(self.sizes):
+            self._store_pending()
+
+    def _store_pending(self):
+        level, futures = self.pending.popleft()
+        self.store_tiles(level, [future.result() for future in futures])
+
+    def close(self):
+        """Store the remaining tiles and finish the output."""
+        while self.pending:
+            self._store_pending()
+        self.executor.shutdown()
+        self.finish()
+
+    @abstractmethod
+    def submit_tiles(self, level, top, strip):
+        """Submit the encoding of a strip's tiles to the executor; return the futures in tile order."""
+
+    def store_tiles(self, level, results):
+        pass
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class PyramidTiffWriter(_TileWriter):
+    """Write a tiled, deflate-compressed, pyramidal BigTIFF strip by strip.
+
+    Level 0 is the main image; the other levels follow as reduced-resolution
+    pages (NewSubfileType 1), as whole-slide viewers and open_preview()
+    expect. Tiles are written as soon as they are compressed; the
+    directories follow at the end of the file.
+    """
+
+    def __init__(self, path, sizes, tile_size=PYRAMID_TILE_SIZE, resolution=None, workers=None):
+        super().__init__(sizes, tile_size, workers)
+        self.path = path
+        self.resolution = resolution
+        self.tiles = [[] for _ in sizes]
+        self.file = open(path, 'wb')
+        # BigTIFF header; the offset of the first directory is filled in by finish()
+        self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+
+    def submit_tiles(self, level, top, strip):
+        return [self.executor.submit(_deflate_tile, tile) for tile in _tile_grid(strip, self.tile_size)]
+
+    def store_tiles(self, level, results):
+        for data in results:
+            self.tiles[level].append((self.file.tell(), len(data)))
+            self.file.write(data)
+
+    def finish(self):
+        if self.file.tell() % 2:
+            self.file.write(b'\0')
+        first = self.file.tell()
+        for level, (width, height) in enumerate(self.sizes):
+            self._write_directory(level, width, height, last=level == len(self.sizes) - 1)
+        self.file.seek(8)
+        self.file.write(struct.pack('<Q', first))
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _write_directory(self, level, width, height, last):
+        offsets = [offset for offset, _ in self.tiles[level]]
+        counts = [count for _, count in self.tiles[level]]
+        # (tag, type, values): types 3 SHORT, 4 LONG, 5 RATIONAL, 16 LONG8
+        entries = [(254, 4, [1 if level else 0]), (256, 4, [width]), (257, 4, [height]), (258, 3, [8, 8, 8]),
+                   (259, 3, [8]), (262, 3, [2]), (277, 3, [3]), (284, 3, [1]),
+                   (322, 4, [self.tile_size]), (323, 4, [self.tile_size]), (324, 16, offsets), (325, 16, counts)]
+        if self.resolution:
+            # Pixels per centimetre of this level, as a rational
+            ratio = self.resolution * width / self.sizes[0][0]
+            denominator = 1000 if ratio < 4e6 else 1
+            rational = [round(ratio * denominator), denominator]
+            if rational[0] < 2 ** 32:
+                entries += [(282, 5, rational), (283, 5, rational), (296, 3, [3])]
+        entries.sort()
+        formats = {3: 'H', 4: 'I', 5: 'I', 16: 'Q'}
+        # Values that do not fit into the 8 bytes of an entry follow the directory
+        data_offset = self.file.tell() + 8 + 20 * len(entries) + 8
+        directory = [struct.pack('<Q', len(entries))]
+        overflow = []
+        for tag, kind, values in entries:
+            packed = struct.pack(f'<{len(values)}{formats[kind]}', *values)
+            count = len(values) // 2 if kind == 5 else len(values)
+            if len(packed) <= 8:
+                field = packed.ljust(8, b'\0')
+            else:
+                field = struct.pack('<Q', data_offset)
+                overflow.append(packed)
+                data_offset += len(packed)
+            directory.append(struct.pack('<HHQ', tag, kind, count) + field)
+        directory.append(struct.pack('<Q', 0 if last else data_offset))
+        self.file.write(b''.join(directory + overflow))
+
+
+class DeepZoomWriter(_TileWriter):
+    """Write a DeepZoom image (a .dzi descriptor and a _files tile directory) strip by strip.
+
+    DeepZoom levels run from 1x1 pixel (level 0) to full resolution, so the
+    writer expects all levels of pyramid_sizes(size). Tiles have no overlap
+    and are saved as PNG (lossless, for masks) or JPEG files.
+    """
+
+    def __init__(self, path, sizes, tile_size=PYRAMID_TILE_SIZE, tile_format='png', workers=None):
+        super().__init__(sizes, tile_size, workers)
+        self.path = path
+        self.tile_format = tile_format
+        self.directory = os.path.splitext(path)[0] + '_files'
+        for level in range(len(sizes)):
+            os.makedirs(self.level_directory(level), exist_ok=True)
+
+    def level_directory(self, level):
+        """Return the tile directory of a pyramid level (0 = full resolution)."""
+        return os.path.join(self.directory, str(len(self.sizes) - 1 - level))
+
+    def submit_tiles(self, level, top, strip):
+        row = top // self.tile_size
+        futures = []
+        for column, left in enumerate(range(0, strip.shape[1], self.tile_size)):
+            tile = Image.fromarray(np.ascontiguousarray(strip[:, left:left + self.tile_size]))
+            path = os.path.join(self.level_directory(level), f"{column}_{row}.{self.tile_format}")
+            futures.append(self.executor.submit(tile.save, path))
+        return futures
+
+    def finish(self):
+        width, height = self.sizes[0]
+        with open(self.path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tile_size}" '
+                    f'Overlap="0" Format="{self.tile_format}">\n'
+                    f'  <Size Width="{width}" Height="{height}"/>\n'
+                    '</Image>\n')
+
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def export_pyramid(path, read_strip, size, tile_size=PYRAMID_TILE_SIZE, resolution=None, workers=None):
+    """Export an image as a pyramidal tiled TIFF, or as DeepZoom when path ends in .dzi.
+
+    The image is never held in full: read_strip(top, bottom) supplies
+    full-resolution rows (e.g. composite_runs_strip() of a mask), which are
+    streamed through pyramid_strips(). The TIFF pyramid ends at the first
+    level that fits in one tile; DeepZoom goes down to one pixel.
+
+    Args:
+        resolution: Pixels per centimetre stored in the TIFF, see tiff_resolution().
+        workers: Encoder threads (default: one per core).
+    """
+    if path.lower().endswith('.dzi'):
+        sizes = pyramid_sizes(size)
+        writer = DeepZoomWriter(path, sizes, tile_size, workers=workers)
+    else:
+        sizes = pyramid_sizes(size, tile_size)
+        writer = PyramidTiffWriter(path, sizes, tile_size, resolution, workers)
+    with writer:
+        for level, top, strip in pyramid_strips(read_strip, size, len(sizes), tile_size):
+            writer.write_strip(level, top, strip)
+
+
+def zhang_suen_skeleton(mask):
+    """Thin a boolean mask to a one-pixel-wide 8-connected skeleton (Zhang-Suen).
+
+    Both sub-iterations are evaluated for the whole image with shifted views,
+    so each pass costs a fixed number of array operations.
+    """
+    image = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
+    image[1:-1, 1:-1] = mask
+    while True:
+        changed = False
+        for step in (0, 1):
+            c = image[1:-1, 1:-1]
+            p2, p3 = image[:-2, 1:-1], image[:-2, 2:]
+            p4, p5 = image[1:-1, 2:], image[2:, 2:]
+            p6, p7 = image[2:, 1:-1], image[2:, :-2]
+            p8, p9 = image[1:-1, :-2], image[:-2, :-2]
+            neighbours = [p2, p3, p4, p5, p6, p7, p8, p9]
+            count = sum(p.astype(np.uint8) for p in neighbours)
+            transitions = sum(((a == 0) & (b == 1)).astype(np.uint8)
+                              for a, b in zip(neighbours, neighbours[1:] + neighbours[:1]))
+            if step == 0:
+                cond = (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+            else:
+                cond = (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+            remove = (c == 1) & (count >= 2) & (count <= 6) & (transitions == 1) & cond
+            if remove.any():
+                image[1:-1, 1:-1][remove] = 0
+                changed = True
+        if not changed:
+            return image[1:-1, 1:-1].astype(bool)
+
+
+def skeleton_link_lengths(skeleton):
+    """Return per-pixel skeleton path length contributions.
+
+    Each pixel contributes 1 per right/down neighbour and sqrt(2) per diagonal
+    down neighbour that is not already connected through an orthogonal step,
+    so every link of the 8-connected skeleton is counted once.
+    """
+    sk = np.zeros((skeleton.shape[0] + 1, skeleton.shape[1] + 2), dtype=bool)
+    sk[:-1, 1:-1] = skeleton
+    c = sk[:-1, 1:-1]
+    right, down = sk[:-1, 2:], sk[1:, 1:-1]
+    down_right, down_left = sk[1:, 2:], sk[1:, :-2]
+    left = sk[:-1, :-2]
+    lengths = (c & right).astype(float) + (c & down)
+    lengths += np.sqrt(2) * (c & down_right & ~right & ~down)
+    lengths += np.sqrt(2) * (c & down_left & ~left & ~down)
+    return lengths
+
+
+def convex_hull(points):
+    """Return the convex hull of (N, 2) points in counter-clockwise order (monotone chain)."""
+    points = np.unique(np.asarray(points, dtype=float), axis=0)
+    if len(points) <= 2:
+        return points
+
+    def half(pts):
+        hull = []
+        for p in pts:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1])
+                                      - (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    lower = half(points)
+    upper = half(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def feret_diameters(hull):
+    """Return (max_feret, max_chord, min_feret, min_chord) for a convex hull.
+
+    The maximum Feret diameter is the largest distance between hull vertices.
+    The minimum width of a convex polygon is attained with one side flush
+    against an edge, so every hull edge direction is tried and the width
+    along it is the largest distance of any vertex from the edge line. Both
+    searches compare all vertex pairs as one array operation, O(h²) for h
+    hull vertices, which is cheap for the hulls of pixel objects. Chords are
+    ((x0, y0), (x1, y1)) end points.
+    """
+    if len(hull) == 1:
+        p = tuple(hull[0])
+        return 0.0, (p, p), 0.0, (p, p)
+    diff = hull[:, np.newaxis, :] - hull[np.newaxis, :, :]
+    distances = np.hypot(diff[..., 0], diff[..., 1])
+    i, j = np.unravel_index(np.argmax(distances), distances.shape)
+    max_feret = float(distances[i, j])
+    max_chord = (tuple(hull[i]), tuple(hull[j]))
+    if len(hull) == 2:
+        p = tuple(hull[0])
+        return max_feret, max_chord, 0.0, (p, p)
+
+    edges = np.roll(hull, -1, axis=0) - hull
+    edge_lengths = np.hypot(edges[:, 0], edges[:, 1])
+    rel = hull[np.newaxis, :, :] - hull[:, np.newaxis, :]
+    widths = np.abs(edges[:, np.newaxis, 0] * rel[..., 1] - edges[:, np.newaxis, 1] * rel[..., 0])
+    widths /= edge_lengths[:, np.newaxis]
+    farthest = np.argmax(widths, axis=1)
+    edge = int(np.argmin(widths[np.arange(len(hull)), farthest]))
+    min_feret = float(widths[edge, farthest[edge]])
+    q = hull[farthest[edge]]
+    direction = edges[edge] / edge_lengths[edge]
+    foot = hull[edge] + np.dot(q - hull[edge], direction) * direction
+    return max_feret, max_chord, min_feret, (tuple(q), tuple(foot))
+
+
+def measure_features(mask, length_per_pixel=None, min_area=1, connectivity=8):
+    """Measure every connected object of a mask.
+
+    Runs headless (no GUI needed) for batch use. Objects are found by
+    run-length labelling; per object the skeleton length, maximum and minimum
+    Feret diameters (with their chords) and the orientation of the maximum
+    Feret chord are computed. Feret diameters use pixel corners, so a single
+    pixel has a maximum Feret diameter of sqrt(2).
+
+    Args:
+        mask: 2D boolean array or RunLengthMask.
+        length_per_pixel: Optional calibration; lengths and areas are converted when given.
+        min_area: Objects smaller than this many pixels are skipped.
+        connectivity: 4 or 8.
+
+    Returns:
+        dict: Column name -> numpy array, one entry per object. Coordinates are
+        in image pixels; 'area', 'skeleton_length', 'feret_max' and 'feret_min'
+        are calibrated when length_per_pixel is given. 'orientation' is in
+        degrees counter-clockwise from the +x axis, in [0, 180).
+    """
+    if not isinstance(mask, RunLengthMask):
+        mask = RunLengthMask.from_mask(np.asarray(mask, dtype=bool))
+    rows, starts, ends = (a.astype(np.int64) for a in (mask.rows, mask.starts, mask.ends))
+    run_labels, count = label_runs(rows, starts, ends, connectivity)
+    widths = ends - starts
+    areas = np.bincount(run_labels, weights=widths, minlength=count)
+    sum_x = np.bincount(run_labels, weights=(starts + ends - 1) * widths / 2, minlength=count)
+    sum_y = np.bincount(run_labels, weights=rows * widths, minlength=count)
+
+    # Skeletonize the bounding box of the selection and assign each skeleton
+    # pixel to the object whose run contains it
+    skeleton_lengths = np.zeros(count)
+    box = mask.bbox()
+    if box is not None:
+        link_lengths = skeleton_link_lengths(zhang_suen_skeleton(mask.rasterize(box)))
+        sk_y, sk_x = np.nonzero(link_lengths)
+        stride = mask.shape[1] + 1
+        run_index = np.searchsorted(rows * stride + starts, (sk_y + box[1]) * stride + sk_x + box[0],
+                                    side='right') - 1
+        skeleton_lengths = np.bincount(run_labels[run_index], weights=link_lengths[sk_y, sk_x],
+                                       minlength=count)
+
+    keep = np.flatnonzero(areas >= min_area)
+    columns = {name: np.zeros(len(keep)) for name in (
+        'area', 'centroid_x', 'centroid_y', 'skeleton_length', 'feret_max', 'feret_min',
+        'orientation', 'feret_x0', 'feret_y0', 'feret_x1', 'feret_y1',
+        'min_x0', 'min_y0', 'min_x1', 'min_y1')}
+    columns['label'] = keep + 1
+    if not len(keep):
+        return columns
+
+    # Hull candidates: left and right pixel corners of each object's rows
+    order = np.lexsort((rows, run_labels))
+    group_key = run_labels[order] * (mask.shape[0] + 1) + rows[order]
+    group_start = np.flatnonzero(np.r_[True, group_key[1:] != group_key[:-1]])
+    group_label = run_labels[order][group_start]
+    group_row = rows[order][group_start]
+    group_left = np.minimum.reduceat(starts[order], group_start)
+    group_right = np.maximum.reduceat(ends[order], group_start)
+    object_start = np.searchsorted(group_label, np.arange(count + 1))
+
+    scale = length_per_pixel if length_per_pixel else 1.0
+    for out, obj in enumerate(keep):
+        group = slice(object_start[obj], object_start[obj + 1])
+        r, left, right = group_row[group], group_left[group], group_right[group]
+        corners = np.concatenate([
+            np.column_stack([left, r]), np.column_stack([left, r + 1]),
+            np.column_stack([right, r]), np.column_stack([right, r + 1])])
+        max_feret, max_chord, min_feret, min_chord = feret_diameters(convex_hull(corners))
+        (fx0, fy0), (fx1, fy1) = max_chord
+        (mx0, my0), (mx1, my1) = min_chord
+        columns['area'][out] = areas[obj] * scale * scale
+        columns['centroid_x'][out] = sum_x[obj] / areas[obj] + 0.5
+        columns['centroid_y'][out] = sum_y[obj] / areas[obj] + 0.5
+        columns['skeleton_length'][out] = skeleton_lengths[obj] * scale
+        columns['feret_max'][out] = max_feret * scale
+        columns['feret_min'][out] = min_feret * scale
+        columns['orientation'][out] = math.degrees(math.atan2(fy0 - fy1, fx1 - fx0)) % 180
+        columns['feret_x0'][out], columns['feret_y0'][out] = fx0, fy0
+        columns['feret_x1'][out], columns['feret_y1'][out] = fx1, fy1
+        columns['min_x0'][out], columns['min_y0'][out] = mx0, my0
+        columns['min_x1'][out], columns['min_y1'][out] = mx1, my1
+    return columns
+
+
+FEATURE_CSV_COLUMNS = [
+    ('label', 'Object'), ('area', 'Area'), ('centroid_x', 'Centroid X (px)'), ('centroid_y', 'Centroid Y (px)'),
+    ('skeleton_length', 'Skeleton Length'), ('feret_max', 'Feret Max'), ('feret_min', 'Feret Min'),
+    ('orientation', 'Orientation (deg)'),
+]
+
+
+def write_features_csv(path, features, units=None):
+    """Write a measure_features() table to CSV; units label the calibrated columns."""
+    suffix = {'area': f' ({units}²)' if units else ' (px²)'}
+    length_suffix = f' ({units})' if units else ' (px)'
+    for key in ('skeleton_length', 'feret_max', 'feret_min'):
+        suffix[key] = length_suffix
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([title + suffix.get(key, '') for key, title in FEATURE_CSV_COLUMNS])
+        for i in range(len(features['label'])):
+            writer.writerow([int(features['label'][i])] +
+                            [f"{features[key][i]:.6g}" for key, _ in FEATURE_CSV_COLUMNS[1:]])
+
+def _window_counts(mask, radius, axis, border):
+    """Count the True pixels in a (2 * radius + 1)-long window along one axis.
+
+    Uses a running sum, so the cost is independent of the radius. Pixels
+    outside the array count as `border`.
+    """
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (radius + 1, radius)
+    sums = np.cumsum(np.pad(mask, pad, constant_values=border), axis=axis, dtype=np.int32)
+    n = mask.shape[axis]
+    upper = np.take(sums, np.arange(2 * radius + 1, 2 * radius + 1 + n), axis=axis)
+    lower = np.take(sums, np.arange(n), axis=axis)
+    return upper - lower
+
+
+def erode_mask(mask, radius):
+    """Erode a boolean mask with a (2r+1) x (2r+1) square, separably.
+
+    Pixels outside the image count as foreground, so objects touching the
+    image border are not eaten away from outside.
+    """
+    if radius <= 0:
+        return mask.copy()
+    size = 2 * radius + 1
+    rows = _window_counts(mask, radius, 1, True) == size
+    return _window_counts(rows, radius, 0, True) == size
+
+
+def dilate_mask(mask, radius):
+    """Dilate a boolean mask with a (2r+1) x (2r+1) square, separably."""
+    if radius <= 0:
+        return mask.copy()
+    rows = _window_counts(mask, radius, 1, False) > 0
+    return _window_counts(rows, radius, 0, False) > 0
+
+
+def fill_holes(mask):
+    """Fill background regions that do not touch the border of the array."""
+    return RunLengthMask.from_mask(mask).fill_holes().to_mask()
+
+
+def remove_small_objects(mask, min_size, keep_border_objects=False, connectivity=8):
+    """Remove objects smaller than `min_size` pixels.
+
+    With keep_border_objects, objects touching the array border are kept
+    regardless of size, since they may continue outside (e.g. in a viewport).
+    """
+    rle = RunLengthMask.from_mask(mask)
+    return rle.remove_small_objects(min_size, keep_border_objects, connectivity).to_mask()
+
+
+class PostProcessing:
+    """Morphological clean-up applied to the threshold mask before display and export.
+
+    Steps, in order: opening (removes specks), closing (bridges gaps), hole
+    filling and removal of objects below a minimum size. Radii are those of
+    square structuring elements; a radius of 0 disables a step.
+    """
+
+    def __init__(self, open_radius=0, close_radius=0, fill_holes=False, min_size=0):
+        self.open_radius = int(open_radius)
+        self.close_radius = int(close_radius)
+        self.fill_holes = bool(fill_holes)
+        self.min_size = int(min_size)
+
+    def key(self):
+        return (self.open_radius, self.close_radius, self.fill_holes, self.min_size)
+
+    def is_active(self):
+        return bool(self.open_radius or self.close_radius or self.fill_holes or self.min_size > 1)
+
+    def halo(self):
+        """Return the context (in pixels) the opening and closing need around a region."""
+        return 2 * (self.open_radius + self.close_radius)
+
+    def morphology(self, mask):
+        if self.open_radius:
+            mask = dilate_mask(erode_mask(mask, self.open_radius), self.open_radius)
+        if self.close_radius:
+            mask = erode_mask(dilate_mask(mask, self.close_radius), self.close_radius)
+        return mask
+
+    def apply(self, mask, local=False):
+        """Post-process a mask in one piece.
+
+        With local=True the mask is a crop (e.g. the viewport): holes and
+        small objects touching its border are left alone, as they may
+        continue outside it.
+        """
+        mask = self.morphology(mask)
+        if self.fill_holes:
+            mask = fill_holes(mask)
+        if self.min_size > 1:
+            mask = remove_small_objects(mask, self.min_size, keep_border_objects=local)
+        return mask
+
+    def apply_in_strips(self, mask, strip_rows=1024):
+        """Post-process a full-resolution RunLengthMask, doing the morphology in strips.
+
+        Each strip is rasterized and processed with a halo of halo() rows,
+        which gives the same result as processing the whole mask while
+        bounding the size of the temporary arrays. Hole filling and size
+        filtering are global and work on the runs directly.
+
+        Returns:
+            RunLengthMask: The processed mask.
+        """
+        if self.open_radius or self.close_radius:
+            halo = self.halo()
+            height, width = mask.shape
+            strips = []
+            for top in range(0, height, strip_rows):
+                bottom = min(top + strip_rows, height)
+                h0, h1 = max(top - halo, 0), min(bottom + halo, height)
+                processed = self.morphology(mask.rasterize((0, h0, width, h1)))[top - h0:bottom - h0]
+                strips.append(RunLengthMask.from_mask(processed, row_offset=top, shape=mask.shape))
+            mask = RunLengthMask.concatenate(mask.shape, strips)
+        if self.fill_holes:
+            mask = mask.fill_holes()
+        if self.min_size > 1:
+            mask = mask.remove_small_objects(self.min_size)
+        return mask
+
+    def to_dict(self):
+        return {'open_radius': self.open_radius, 'close_radius': self.close_radius,
+                'fill_holes': self.fill_holes, 'min_size': self.min_size}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def _squared_distance_1d(f):
+    """Return d[i, q] = min_p (q - p)^2 + f[i, p] for every row i of f.
+
+    Builds the lower envelope of parabolas (Felzenszwalb & Huttenlocher) in
+    linear time per row. All rows are processed together, so the Python
+    loop only runs over the row length, and the envelope is evaluated with
+    a single searchsorted.
+    """
+    lines, n = f.shape
+    rows = np.arange(lines)
+    base = rows * n
+    values = f.ravel()
+    # Envelope per row: parabola vertices v and the boundaries z between them
+    v = np.zeros(lines * n, dtype=np.intp)
+    z = np.full((lines, n + 1), np.inf)
+    z[:, 0] = -np.inf
+    boundaries = z.ravel()
+    z_base = rows * (n + 1)
+    k = np.zeros(lines, dtype=np.intp)
+    for q in range(1, n):
+        fq = values[base + q] + q * q
+        while True:
+            vk = v[base + k]
+            s = (fq - (values[base + vk] + vk * vk)) / (2.0 * (q - vk))
+            hidden = s <= boundaries[z_base + k]
+            if not hidden.any():
+                break
+            k -= hidden
+        k += 1
+        v[base + k] = q
+        boundaries[z_base + k] = s
+        boundaries[z_base + k + 1] = np.inf
+    # The parabola covering q is the last one whose left boundary lies below q;
+    # offset each row's (clipped) boundaries so that one sorted search finds it
+    offsets = (rows * (n + 2))[:, np.newaxis]
+    stale = np.arange(n + 1) > (k + 1)[:, np.newaxis]
+    keys = np.where(stale, n, np.clip(z, -1, n)) + offsets
+    found = np.searchsorted(keys.ravel(), (offsets + np.arange(n)).ravel()).reshape(lines, n) - 1
+    vk = v[found - (rows * (n + 1))[:, np.newaxis] + base[:, np.newaxis]]
+    return (np.arange(n) - vk) ** 2 + values[vk + base[:, np.newaxis]]
+
+
+def distance_transform(mask):
+    """Exact Euclidean distance of each selected pixel to the nearest unselected one.
+
+    Separable: the distance along each column is found with running
+    maxima/minima of the unselected row indices, then a 1D squared-distance
+    transform runs along the rows. Unselected pixels get 0. Pixels outside
+    the array count as selected, so objects are not thinned by the array
+    border; pixels with no unselected pixel in the array get inf.
+
+    Returns:
+        np.ndarray: float32 distances in pixels.
+    """
+    return np.sqrt(_squared_distance_transform(mask)).astype(np.float32)
+
+
+def _squared_distance_transform(mask):
+    """Squared distances of distance_transform() as exact float64 integers (inf where unreachable)."""
+    height, width = mask.shape
+    far = height + width + 1
+    rows = np.arange(height)[:, np.newaxis]
+    above = np.maximum.accumulate(np.where(mask, -far, rows), axis=0)
+    below = np.minimum.accumulate(np.where(mask, 2 * far, rows)[::-1], axis=0)[::-1]
+    column = np.minimum(rows - above, below - rows)
+    unreachable = float(height * height + width * width + 1)
+    squared = np.where(column >= far, unreachable, np.square(column, dtype=np.float64))
+    squared = _squared_distance_1d(squared)
+    squared[squared >= unreachable] = np.inf
+    return squared
+
+
+def distance_ridge(distance):
+    """Return the centres of maximal inscribed discs of a distance map.
+
+    A pixel is a centre unless the disc of an 8-neighbour contains its disc,
+    i.e. unless the neighbour's distance exceeds its own by the step between them.
+    """
+    height, width = distance.shape
+    padded = np.pad(distance, 1)
+    ridge = distance > 0
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                neighbour = padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+                ridge &= neighbour < distance + math.hypot(dy, dx)
+    return ridge
+
+
+def local_thickness(mask, max_radius=None, chunk_size=1 << 20):
+    """Return the local thickness of a boolean mask (Hildebrand & Rüegsegger).
+
+    The thickness of a pixel is the diameter of the largest disc that fits
+    inside the mask and contains it. A disc whose centre is r pixels from
+    the background spans 2r - 1 pixels, so a band w pixels wide (w odd)
+    measures w. Discs are painted from the distance ridge, smallest first.
+
+    Distances are capped at max_radius (default: the larger array side), so
+    thicker regions measure 2 * max_radius - 1; they are filled with a second
+    distance transform instead of painting a disc per pixel. Disc membership
+    is decided on the exact integer squared distances, so no disc reaches
+    the background pixel that bounds it.
+
+    Returns:
+        np.ndarray: float32 thickness in pixels, 0 outside the mask.
+    """
+    height, width = mask.shape
+    cap = float(max(height, width) if max_radius is None else max_radius)
+    squared = _squared_distance_transform(mask)
+    plateau = squared >= cap * cap
+    distance = np.sqrt(np.minimum(squared, cap * cap)).astype(np.float32)
+    thickness = np.zeros(mask.shape, dtype=np.float32)
+    flat = thickness.ravel()
+    if plateau.any():
+        thickness[_squared_distance_transform(~plateau) < cap * cap] = 2 * cap - 1
+    ys, xs = np.nonzero(distance_ridge(distance) & ~plateau)
+    radii_squared = squared[ys, xs]
+    order = np.argsort(radii_squared, kind='stable')
+    ys, xs, radii_squared = ys[order], xs[order], radii_squared[order]
+    radii = np.sqrt(radii_squared).astype(np.float32)
+    extents = np.ceil(np.sqrt(radii_squared)).astype(np.intp)
+    for extent in np.unique(extents):
+        lo, hi = np.searchsorted(extents, (extent, extent + 1))
+        oy, ox = np.mgrid[1 - extent:extent, 1 - extent:extent]
+        inside = oy ** 2 + ox ** 2 < extent ** 2
+        oy, ox = oy[inside], ox[inside]
+        offset_squared = oy ** 2 + ox ** 2
+        step = max(chunk_size // len(oy), 1)
+        for start in range(lo, hi, step):
+            end = min(start + step, hi)
+            y = ys[start:end, None] + oy
+            x = xs[start:end, None] + ox
+            keep = ((offset_squared < radii_squared[start:end, None])
+                    & (y >= 0) & (y < height) & (x >= 0) & (x < width))
+            values = np.broadcast_to(2 * radii[start:end, None] - 1, keep.shape)[keep]
+            np.maximum.at(flat, y[keep] * width + x[keep], values)
+    return thickness
+
+
+def local_thickness_tiled(mask, max_radius, tile_size=1024, out=None):
+    """Return the local thickness of a full-resolution RunLengthMask, a tile at a time.
+
+    Each tile is rasterized with a halo of 2 * max_radius + 1 pixels, which
+    holds every disc centre that can reach the tile together with its
+    nearest background, so the result equals local_thickness() of the whole
+    mask. Only one tile and its halo are dense at a time; pass a memory-mapped
+    array as out so that the map itself need not fit in memory either.
+    """
+    height, width = mask.shape
+    if out is None:
+        out = np.zeros(mask.shape, dtype=np.float32)
+    halo = 2 * int(math.ceil(max_radius)) + 1
+    for top in range(0, height, tile_size):
+        bottom = min(top + tile_size, height)
+        for left in range(0, width, tile_size):
+            right = min(left + tile_size, width)
+            x0, y0 = max(left - halo, 0), max(top - halo, 0)
+            x1, y1 = min(right + halo, width), min(bottom + halo, height)
+            local = mask.rasterize((x0, y0, x1, y1))
+            if local[top - y0:bottom - y0, left - x0:right - x0].any():
+                out[top:bottom, left:right] = local_thickness(local, max_radius)[top - y0:bottom - y0,
+                                                                                 left - x0:right - x0]
+            else:
+                out[top:bottom, left:right] = 0
+    return out
+
+
+def thickness_histogram(thickness, bins=50, length_per_pixel=None, strip_rows=1024):
+    """Histogram and moments of the local thickness over the selected pixels.
+
+    The map is read in strips, so a memory-mapped map is never loaded whole.
+    Thicknesses are converted to calibrated units with length_per_pixel.
+
+    Returns:
+        dict: counts, edges, pixels, mean, std, median and max.
+    """
+    height = thickness.shape[0]
+    maximum, pixels, total, total_squared = 0.0, 0, 0.0, 0.0
+    for top in range(0, height, strip_rows):
+        values = thickness[top:top + strip_rows]
+        values = values[values > 0].astype(np.float64)
+        if values.size:
+            maximum = max(maximum, float(values.max()))
+            pixels += values.size
+            total += values.sum()
+            total_squared += np.square(values).sum()
+    counts = np.zeros(bins, dtype=np.int64)
+    edges = np.linspace(0, maximum if maximum > 0 else 1, bins + 1)
+    for top in range(0, height, strip_rows):
+        values = thickness[top:top + strip_rows]
+        counts += np.histogram(values[values > 0], bins=edges)[0]
+    scale = length_per_pixel or 1.0
+    mean = total / pixels if pixels else 0.0
+    std = math.sqrt(max(total_squared / pixels - mean * mean, 0.0)) if pixels else 0.0
+    median = 0.0
+    if pixels:
+        index = int(np.searchsorted(np.cumsum(counts), pixels / 2))
+        median = (edges[index] + edges[index + 1]) / 2
+    return {'counts': counts, 'edges': edges * scale, 'pixels': pixels, 'mean': mean * scale,
+            'std': std * scale, 'median': median * scale, 'max': maximum * scale}
+
+
+def write_thickness_csv(path, histogram, units=None):
+    """Write a thickness histogram from thickness_histogram() as CSV."""
+    suffix = f" ({units})" if units else " (px)"
+    pixels = max(histogram['pixels'], 1)
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([f'Thickness From{suffix}', f'Thickness To{suffix}', 'Pixels', 'Fraction'])
+        edges = histogram['edges']
+        for i, count in enumerate(histogram['counts']):
+            writer.writerow([f"{edges[i]:.6g}", f"{edges[i + 1]:.6g}", int(count), f"{count / pixels:.6g}"])
+
+
+# Default cap on the inscribed disc radius (pixels) for local thickness; it also sets the tile halo
+THICKNESS_MAX_RADIUS = 64
+
+# Heat map colors (from thin to thick) for the local thickness display
+THICKNESS_COLORS = ((68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37))
+
+
+def thickness_colors(levels):
+    """Map levels in [0, 1] to heat map colors, as uint8 RGB."""
+    anchors = np.linspace(0, 1, len(THICKNESS_COLORS))
+    levels = np.clip(levels, 0, 1)
+    return np.stack([np.interp(levels, anchors, [color[i] for color in THICKNESS_COLORS])
+                     for i in range(3)], axis=-1).astype(np.uint8)
+
+
+def thickness_overlay(rgb_array, thickness, max_thickness):
+    """Show a thickness crop as a heat map over the dimmed image.
+
+    Pixels with zero thickness (outside the phase) show the dimmed image.
+    """
+    heat = thickness_colors(thickness / max(max_thickness, 1e-9))
+    dimmed = np.multiply(rgb_array, DIM_FACTOR, dtype=np.uint16) >> 8
+    return np.where((thickness > 0)[:, :, np.newaxis], heat, dimmed).astype(np.uint8)
+
+
+# Region of interest shapes and the version of ROI files
+ROI_KINDS = ('rectangle', 'polygon', 'freehand')
+ROI_FILE_VERSION = 1
+ROI_COLOR = '#00ffff'
+
+
+class ROI:
+    """A named region of interest in image pixel coordinates.
+
+    Rectangles are stored as two opposite corners, polygons and freehand
+    outlines as their vertices. The region is rasterized once per image
+    size into a RunLengthMask covering only its bounding box.
+    """
+
+    def __init__(self, kind, points, name=''):
+        if kind not in ROI_KINDS:
+            raise ValueError(f"Unknown ROI kind: {kind}")
+        self.kind = kind
+        self.points = [(float(x), float(y)) for x, y in points]
+        if len(self.points) < (2 if kind == 'rectangle' else 3):
+            raise ValueError(f"Too few points for a {kind} ROI")
+        self.name = name
+        self._runs = (None, None)
+
+    def key(self):
+        return (self.kind, tuple(self.points))
+
+    def outline(self):
+        """Return the vertices of the ROI outline."""
+        if self.kind == 'rectangle':
+            (x0, y0), (x1, y1) = self.points[:2]
+            return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        return self.points
+
+    def bbox(self, image_size):
+        """Return the pixel bounding box (x0, y0, x1, y1), clipped to an image of (width, height)."""
+        width, height = image_size
+        xs = [x for x, _ in self.points]
+        ys = [y for _, y in self.points]
+        x0 = min(max(int(math.floor(min(xs))), 0), width)
+        y0 = min(max(int(math.floor(min(ys))), 0), height)
+        x1 = max(min(int(math.ceil(max(xs))), width), x0)
+        y1 = max(min(int(math.ceil(max(ys))), height), y0)
+        return x0, y0, x1, y1
+
+    def runs(self, image_size):
+        """Return the ROI as a RunLengthMask of an image of (width, height), rasterized once."""
+        cached_size, runs = self._runs
+        if cached_size != image_size:
+            width, height = image_size
+            x0, y0, x1, y1 = self.bbox(image_size)
+            if self.kind == 'rectangle':
+                crop = np.ones((y1 - y0, x1 - x0), dtype=bool)
+            else:
+                canvas = Image.new('1', (max(x1 - x0, 1), max(y1 - y0, 1)), 0)
+                ImageDraw.Draw(canvas).polygon([(x - x0, y - y0) for x, y in self.points], fill=1, outline=1)
+                crop = np.asarray(canvas)[:y1 - y0, :x1 - x0]
+            runs = RunLengthMask.from_mask(crop).shifted(x0, y0, (height, width))
+            self._runs = (image_size, runs)
+        return runs
+
+    def to_dict(self):
+        return {'kind': self.kind, 'name': self.name, 'points': [list(p) for p in self.points]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['kind'], data['points'], data.get('name', ''))
+
+
+def roi_union(rois, image_size):
+    """Return the union of ROIs as a RunLengthMask, or None (the whole image) without ROIs."""
+    if not rois:
+        return None
+    width, height = image_size
+    mask = RunLengthMask((height, width), [], [], [])
+    for roi in rois:
+        mask = mask | roi.runs(image_size)
+    return mask
+
+
+def compute_roi_runs(hsv_array, rois, hue_low, hue_high, sat_low, sat_high, val_low, val_high):
+    """Threshold an HSV image inside ROIs only.
+
+    Each ROI's bounding box is thresholded and the result is clipped to the
+    ROI, so the cost scales with the ROI area rather than the image size.
+
+    Returns:
+        RunLengthMask: The selection within the union of the ROIs.
+    """
+    height, width = hsv_array.shape[:2]
+    mask = RunLengthMask((height, width), [], [], [])
+    for roi in rois:
+        x0, y0, x1, y1 = roi.bbox((width, height))
+        if x1 <= x0 or y1 <= y0:
+            continue
+        local = compute_hsv_runs(hsv_array[y0:y1, x0:x1], hue_low, hue_high, sat_low, sat_high, val_low, val_high)
+        mask = mask | (local.shifted(x0, y0, (height, width)) & roi.runs((width, height)))
+    return mask
+
+
+def roi_statistics(mask, rois, length_per_pixel=None):
+    """Return the selected area inside each ROI of a RunLengthMask.
+
+    Returns:
+        list of dict: 'name', 'kind', 'roi_pixels', 'pixels', 'fraction' and,
+        with a calibration, 'area' in squared units.
+    """
+    image_size = (mask.shape[1], mask.shape[0])
+    results = []
+    for i, roi in enumerate(rois):
+        region = roi.runs(image_size)
+        pixels = (mask & region).area
+        row = {'name': roi.name or f"ROI {i + 1}", 'kind': roi.kind, 'roi_pixels': region.area,
+               'pixels': pixels, 'fraction': pixels / region.area if region.area else 0.0}
+        if length_per_pixel is not None:
+            row['area'] = pixels * length_per_pixel ** 2
+        results.append(row)
+    return results
+
+
+def write_roi_statistics_csv(path, statistics, units=None):
+    """Write the rows of roi_statistics() to a CSV file."""
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        header = ['ROI', 'Shape', 'ROI Pixels', 'Selected Pixels', 'Area Fraction']
+        if units:
+            header.append(f'Area ({units}²)')
+        writer.writerow(header)
+        for row in statistics:
+            values = [row['name'], row['kind'], row['roi_pixels'], row['pixels'], f"{row['fraction']:.6f}"]
+            if units:
+                values.append(f"{row['area']:.6g}")
+            writer.writerow(values)
+
+
+def write_roi_file(path, rois):
+    """Save ROIs as JSON, for reuse on other images or in batch runs."""
+    with open(path, 'w') as f:
+        json.dump({'version': ROI_FILE_VERSION, 'rois': [roi.to_dict() for roi in rois]}, f, indent=2)
+
+
+def read_roi_file(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version', 0) > ROI_FILE_VERSION:
+        raise ValueError(f"ROI file version {data['version']} is newer than supported")
+    return [ROI.from_dict(d) for d in data['rois']]
+
+
+# Schema of the results database; user_version tracks RESULTS_SCHEMA_VERSION
+RESULTS_SCHEMA_VERSION = 2
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    sample TEXT,
+    preset TEXT,
+    timestamp REAL NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    hue_low REAL, hue_high REAL, sat_low REAL, sat_high REAL, val_low REAL, val_high REAL,
+    length_per_pixel REAL,
+    units TEXT,
+    selected_pixels INTEGER,
+    coverage REAL,
+    area REAL
+);
+CREATE INDEX IF NOT EXISTS images_path ON images (path);
+CREATE INDEX IF NOT EXISTS images_sample ON images (sample);
+CREATE INDEX IF NOT EXISTS images_preset ON images (preset, timestamp);
+CREATE INDEX IF NOT EXISTS images_timestamp ON images (timestamp);
+CREATE TABLE IF NOT EXISTS phases (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    pixels INTEGER,
+    fraction REAL,
+    area REAL
+);
+CREATE INDEX IF NOT EXISTS phases_name_fraction ON phases (name, fraction);
+CREATE INDEX IF NOT EXISTS phases_image ON phases (image_id);
+CREATE TABLE IF NOT EXISTS rois (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    kind TEXT,
+    roi_pixels INTEGER,
+    pixels INTEGER,
+    fraction REAL,
+    area REAL
+);
+CREATE INDEX IF NOT EXISTS rois_image ON rois (image_id);
+CREATE TABLE IF NOT EXISTS measurements (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    label TEXT,
+    x0 REAL, y0 REAL, x1 REAL, y1 REAL,
+    length REAL,
+    angle REAL,
+    timestamp REAL,
+    feret_min REAL,
+    skeleton_length REAL,
+    area REAL
+);
+CREATE INDEX IF NOT EXISTS measurements_image ON measurements (image_id);
+CREATE TABLE IF NOT EXISTS features (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    label INTEGER,
+    area REAL,
+    centroid_x REAL,
+    centroid_y REAL,
+    skeleton_length REAL,
+    feret_max REAL,
+    feret_min REAL,
+    orientation REAL
+);
+CREATE INDEX IF NOT EXISTS features_image ON features (image_id);
+CREATE TABLE IF NOT EXISTS sample_stats (
+    sample TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    minimum REAL,
+    maximum REAL,
+    PRIMARY KEY (sample, metric)
+) WITHOUT ROWID;
+"""
+
+# Columns of `images` that sample_summary() may aggregate
+RESULTS_SUMMARY_COLUMNS = ('coverage', 'area', 'selected_pixels')
+
+
+def results_record(path, thresholds, mask, length_per_pixel=None, units=None, phases=(), measurements=(),
+                   features=None, sample=None, preset='', timestamp=None, rois=()):
+    """Collect the results of one image for a ResultsDatabase.
+
+    Args:
+        path: Image file path.
+        thresholds: (hue_low, hue_high, sat_low, sat_high, val_low, val_high).
+        mask: The final RunLengthMask; its area gives the coverage.
+        phases: class_area_table() rows.
+        measurements: MeasurementStore.row() dicts.
+        features: A measure_features() table, or None.
+        sample: Sample name; defaults to the name of the image's directory.
+        preset: Name of the settings used, e.g. the session file.
+        rois: roi_statistics() rows, one per ROI.
+
+    Returns:
+        dict: A record that can be pickled to a writer in another process.
+    """
+    height, width = mask.shape
+    selected = mask.area
+    return {
+        'path': os.path.abspath(path),
+        'sample': sample if sample is not None else os.path.basename(os.path.dirname(os.path.abspath(path))),
+        'preset': preset,
+        'timestamp': time.time() if timestamp is None else timestamp,
+        'width': width,
+        'height': height,
+        'thresholds': tuple(thresholds),
+        'length_per_pixel': length_per_pixel,
+        'units': units,
+        'selected_pixels': selected,
+        'coverage': selected / (width * height) if width * height else 0.0,
+        'phases': [tuple(row) for row in phases],
+        'measurements': [dict(row) for row in measurements],
+        'rois': [dict(row) for row in rois],
+        'features': ({key: np.asarray(features[key]).tolist() for key, _ in FEATURE_CSV_COLUMNS}
+                     if features is not None else None),
+    }
+
+
+class ResultsDatabase:
+    """SQLite store of per-image results, for batch runs over many images.
+
+    One row per image holds the thresholds, calibration and coverage; the
+    phase areas, per-ROI areas, measurements and measured features go to
+    child tables.
+    Image path, sample, preset and timestamp are indexed, as is the phase
+    fraction per phase name, so selections stay fast with millions of rows.
+    Per-sample counts, sums and extremes are updated with every insert, so
+    sample summaries do not scan the images at all.
+
+    SQLite allows only one writer at a time: from several threads or
+    processes, send records to a ResultsWriter instead of opening the
+    database in each of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # WAL lets queries run while the writer commits
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > RESULTS_SCHEMA_VERSION:
+            self.connection.close()
+            raise ValueError(f"Results database version {version} is newer than supported")
+        with self.connection:
+            self.connection.executescript(RESULTS_SCHEMA)
+            self.connection.execute(f'PRAGMA user_version={RESULTS_SCHEMA_VERSION}')
+
+    def close(self):
+        self.connection.close()
+
+    def add_results(self, records):
+        """Insert results_record() dicts in a single transaction.
+
+        Returns:
+            list: The image ids of the inserted records.
+        """
+        ids = []
+        phases, rois, measurements, features = [], [], [], []
+        stats = {}
+        with self.connection:
+            for record in records:
+                length_per_pixel = record['length_per_pixel']
+                area = record['selected_pixels'] * length_per_pixel ** 2 if length_per_pixel else None
+                cursor = self.connection.execute(
+                    'INSERT INTO images (path, sample, preset, timestamp, width, height, hue_low, hue_high, '
+                    'sat_low, sat_high, val_low, val_high, length_per_pixel, units, selected_pixels, coverage, area) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (record['path'], record['sample'], record['preset'], record['timestamp'], record['width'],
+                     record['height'], *record['thresholds'], length_per_pixel, record['units'],
+                     record['selected_pixels'], record['coverage'], area))
+                image_id = cursor.lastrowid
+                ids.append(image_id)
+                phases.extend((image_id, *row) for row in record['phases'])
+                rois.extend((image_id, row['name'], row['kind'], row['roi_pixels'], row['pixels'],
+                             row['fraction'], row.get('area')) for row in record['rois'])
+                # Keep the per-sample aggregates up to date
+                metrics = [(column, record[column]) for column in ('coverage', 'selected_pixels')]
+                metrics += [('area', area)] + [('phase:' + row[0], row[2]) for row in record['phases']]
+                for metric, value in metrics:
+                    if value is None:
+                        continue
+                    key = (record['sample'] or '', metric)
+                    count, total, low, high = stats.get(key, (0, 0.0, value, value))
+                    stats[key] = (count + 1, total + value, min(low, value), max(high, value))
+                for row in record['measurements']:
+                    # NaN marks metrics that manual measurements do not have
+                    values = [None if isinstance(row.get(key), float) and math.isnan(row[key]) else row.get(key)
+                              for key in ('x0', 'y0', 'x1', 'y1', 'length', 'angle', 'timestamp',
+                                          'feret_min', 'skeleton_length', 'area')]
+                    measurements.append((image_id, row.get('label', ''), *values))
+                table = record['features']
+                if table:
+                    features.extend((image_id, *values) for values in
+                                    zip(*(table[key] for key, _ in FEATURE_CSV_COLUMNS)))
+            self.connection.executemany('INSERT INTO phases VALUES (?, ?, ?, ?, ?)', phases)
+            self.connection.executemany('INSERT INTO rois VALUES (?, ?, ?, ?, ?, ?, ?)', rois)
+            self.connection.executemany(
+                'INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', measurements)
+            self.connection.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', features)
+            self.connection.executemany(
+                'INSERT INTO sample_stats VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (sample, metric) DO UPDATE SET '
+                'count = count + excluded.count, total = total + excluded.total, '
+                'minimum = MIN(minimum, excluded.minimum), maximum = MAX(maximum, excluded.maximum)',
+                [(*key, *values) for key, values in stats.items()])
+        return ids
+
+    def query(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def images_with_phase_fraction(self, name, minimum):
+        """Return (path, fraction) of all images where phase `name` covers more than `minimum`."""
+        return self.query('SELECT images.path, phases.fraction FROM phases JOIN images ON images.id = phases.image_id '
+                          'WHERE phases.name = ? AND phases.fraction > ?', (name, minimum))
+
+    def sample_summary(self, column='coverage', phase=None):
+        """Return (sample, images, mean, min, max) rows of an image column, or of a phase fraction.
+
+        Images without a value (e.g. an uncalibrated area) are not counted.
+        """
+        if phase is not None:
+            metric = 'phase:' + phase
+        elif column in RESULTS_SUMMARY_COLUMNS:
+            metric = column
+        else:
+            raise ValueError(f"Cannot summarise column {column!r}")
+        return self.query('SELECT sample, count, total / count, minimum, maximum FROM sample_stats '
+                          'WHERE metric = ? ORDER BY sample', (metric,))
+
+
+class ResultsWriter(threading.Thread):
+    """Single writer that drains result records from a queue into a ResultsDatabase.
+
+    Workers put results_record() dicts on `messages`, which may be a
+    multiprocessing queue shared with worker processes. Records are
+    committed in batches of up to `batch_size`, or whatever arrived within
+    `flush_interval` seconds of the first record of a batch. close() (or
+    putting None) flushes the remaining records and stops the writer. If
+    a batch cannot be written, the writer stops and `error` holds the
+    exception.
+    """
+
+    def __init__(self, path, messages=None, batch_size=500, flush_interval=0.5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.messages = messages if messages is not None else queue.Queue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.error = None
+
+    def put(self, record):
+        self.messages.put(record)
+
+    def close(self):
+        self.messages.put(None)
+        self.join()
+
+    def run(self):
+        try:
+            # The connection belongs to this thread
+            database = ResultsDatabase(self.path)
+        except (sqlite3.Error, ValueError) as e:
+            self.error = e
+            return
+        try:
+            done = False
+            while not done:
+                batch = []
+                deadline = None
+                while len(batch) < self.batch_size:
+                    try:
+                        record = self.messages.get(timeout=None if deadline is None else
+                                                   max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        done = True
+                        break
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append(record)
+                if batch:
+                    database.add_results(batch)
+                    self.written += len(batch)
+        except Exception as e:
+            # Any failure, e.g. a malformed record, stops the writer; callers check `error`
+            self.error = e
+        finally:
+            database.close()
+
+
+# Session files: JSON state plus an optional sidecar directory of derived arrays
+SESSION_VERSION = 1
+SESSION_EXTENSION = '.hsvw'
+SESSION_CACHE_SUFFIX = '.cache'
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """Return {'size', 'mtime_ns', 'blake2b'} identifying the contents of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blake2b': digest.hexdigest()}
+
+
+def fingerprint_matches(path, fingerprint):
+    """Check whether a file still matches a stored fingerprint.
+
+    An unchanged size and modification time are trusted without reading the
+    file; otherwise (e.g. after copying) the contents are hashed again.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != fingerprint.get('size'):
+        return False
+    if stat.st_mtime_ns == fingerprint.get('mtime_ns'):
+        return True
+    return file_fingerprint(path)['blake2b'] == fingerprint.get('blake2b')
+
+
+def write_session(path, state, arrays=None):
+    """Write a session file and, optionally, its sidecar cache of derived arrays.
+
+    Arrays are stored uncompressed as .npy files in '<path>.cache/' so they can
+    be memory-mapped on load. The cache manifest records the image hash the
+    arrays were derived from.
+    """
+    state = dict(state, version=SESSION_VERSION, cache=None)
+    if arrays:
+        cache_dir = path + SESSION_CACHE_SUFFIX
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(cache_dir, name + '.npy'), np.ascontiguousarray(array))
+        manifest = {'blake2b': state['image']['fingerprint']['blake2b'],
+                    'arrays': {name: [list(array.shape), str(array.dtype)] for name, array in arrays.items()}}
+        with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        state['cache'] = os.path.basename(cache_dir)
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def read_session(path):
+    """Read a session file and return its state dict."""
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('version', 0) > SESSION_VERSION:
+        raise ValueError(f"Session version {state['version']} is newer than supported ({SESSION_VERSION}).")
+    return state
+
+
+def session_image_path(session_path, state):
+    """Locate a session's image: the stored path, else next to the session file."""
+    image = state['image']
+    if os.path.exists(image['path']):
+        return image['path']
+    relative = os.path.join(os.path.dirname(os.path.abspath(session_path)), image.get('relative_path', ''))
+    if image.get('relative_path') and os.path.exists(relative):
+        return relative
+    return image['path']
+
+
+def load_session_cache(session_path, state):
+    """Memory-map a session's cached arrays, or return None if missing or stale."""
+    if not state.get('cache'):
+        return None
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(session_path)), state['cache'])
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['blake2b'] != state['image']['fingerprint']['blake2b']:
+            return None
+        arrays = {}
+        for name, (shape, dtype) in manifest['arrays'].items():
+            array = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+            if list(array.shape) != shape or str(array.dtype) != dtype:
+                return None
+            arrays[name] = array
+        return arrays
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class ImageCache:
+    """Content-addressed on-disk cache of decoded RGB and HSV image arrays.
+
+    Entries are keyed by the BLAKE2b hash of the image file and stored as
+    uncompressed .npy files, so a cache hit is a memory map instead of a
+    decode. The hash of each path is remembered together with its size and
+    modification time, so reopening an unchanged file does not read it
+    again. When the cache grows beyond `max_bytes`, the least recently used
+    entries are evicted.
+
+    The location defaults to $HSV_WIZARD_CACHE or ~/.cache/hsv-wizard.
+    """
+
+    DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory is None:
+            directory = os.environ.get('HSV_WIZARD_CACHE') or os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'hsv-wizard')
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The cache is shared between the Tk thread and image loader threads
+        self._lock = threading.RLock()
+        self._index = {'max_bytes': self.DEFAULT_MAX_BYTES, 'entries': {}, 'files': {}}
+        try:
+            with open(os.path.join(directory, self.INDEX_NAME)) as f:
+                self._index.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        if max_bytes is not None:
+            self._index['max_bytes'] = max_bytes
+
+    @property
+    def max_bytes(self):
+        return self._index['max_bytes']
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._index['max_bytes'] = int(value)
+            self._evict()
+            self._save_index()
+
+    @property
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self._index['entries'].values())
+
+    def fingerprint(self, path):
+        """Return the fingerprint of `path`, hashing it only if it changed since last seen."""
+        with self._lock:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            known = self._index['files'].get(path)
+            if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                return known
+            fingerprint = file_fingerprint(path)
+            self._index['files'][path] = fingerprint
+            self._save_index()
+            return fingerprint
+
+    def get(self, path):
+        """Return the cached arrays of an image file as read-only memory maps, or None."""
+        with self._lock:
+            key = self.fingerprint(path)['blake2b']
+            entry = self._index['entries'].get(key)
+            if entry is not None:
+                try:
+                    arrays = {name: np.load(os.path.join(self.directory, key, name + '.npy'), mmap_mode='r')
+                              for name in entry['arrays']}
+                except (OSError, ValueError):
+                    self._remove(key)
+                else:
+                    entry['last_used'] = time.time()
+                    self._save_index()
+                    self.hits += 1
+                    return arrays
+            self.misses += 1
+            return None
+
+    def put(self, path, arrays):
+        """Store the arrays derived from an image file, evicting old entries if needed."""
+        with self._lock:
+            size = sum(array.nbytes for array in arrays.values())
+            if size > self.max_bytes:
+                return
+            key = self.fingerprint(path)['blake2b']
+            entry_dir = os.path.join(self.directory, key)
+            # Write into a temporary directory first so a crash never leaves a half-written entry
+            staging = entry_dir + '.tmp'
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, name + '.npy'), np.ascontiguousarray(array))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(staging, entry_dir)
+            self._index['entries'][key] = {'bytes': size, 'arrays': list(arrays), 'last_used': time.time()}
+            self._evict(keep=key)
+            self._save_index()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index['entries']):
+                self._remove(key)
+            self._save_index()
+
+    def stats(self):
+        """Return hit/miss/eviction counters and the current size of the cache."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._index['entries']), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self, keep=None):
+        entries = self._index['entries']
+        total = self.total_bytes
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                total -= entries[key]['bytes']
+                self._remove(key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._index['entries'].pop(key, None)
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.INDEX_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(path + '.tmp', path)
+
+# Length units recognised in image metadata, in metres
+LENGTH_UNITS = {
+    'm': 1.0, 'cm': 1e-2, 'mm': 1e-3, 'µm': 1e-6, 'μm': 1e-6, 'um': 1e-6, 'micron': 1e-6, 'microns': 1e-6,
+    'nm': 1e-9, 'pm': 1e-12, 'Å': 1e-10, 'angstrom': 1e-10,
+}
+
+# Parsed metadata cache entries from another parser version are ignored
+METADATA_VERSION = 1
+
+
+def normalize_length(value, unit):
+    """Express a length given in `unit` in nm, µm or mm, whichever reads best.
+
+    Returns:
+        tuple: (value, unit), or None if the unit is not a known length unit.
+    """
+    unit = unit.strip().replace('\\u00B5', 'µ').replace('\\u00b5', 'µ')
+    scale = LENGTH_UNITS.get(unit, LENGTH_UNITS.get(unit.lower()))
+    if scale is None or not value > 0:
+        return None
+    metres = value * scale
+    for name, size in (('mm', 1e-3), ('µm', 1e-6)):
+        # Tolerate rounding, e.g. 1/25400 inch is one micrometre
+        if metres / size > 1 - 1e-9:
+            return metres / size, name
+    return metres / 1e-9, 'nm'
+
+
+def _parse_length(number, unit):
+    """normalize_length() of a number read from a header; None if the number is malformed."""
+    try:
+        return normalize_length(float(number), unit)
+    except ValueError:
+        return None
+
+
+def _description_pixel_size(description, x_resolution):
+    """Pixel size from an OME-XML or ImageJ ImageDescription."""
+    if '<OME' in description:
+        size = re.search(r'PhysicalSizeX="([^"]+)"', description)
+        unit = re.search(r'PhysicalSizeXUnit="([^"]+)"', description)
+        if size:
+            # OME defaults to micrometres when no unit is given
+            return _parse_length(size.group(1), unit.group(1) if unit else 'µm'), 'OME-XML'
+    if description.startswith('ImageJ=') and x_resolution:
+        unit = re.search(r'^unit=(.+)$', description, re.MULTILINE)
+        if unit:
+            # ImageJ stores the number of pixels per unit as the resolution
+            return normalize_length(1.0 / x_resolution, unit.group(1)), 'ImageJ'
+    return None, None
+
+
+def read_pixel_size(path):
+    """Read the pixel size an image file declares in its header.
+
+    Only the header is parsed; no pixel data is decoded. The sources are
+    tried from the most to the least specific: the FEI and Zeiss SEM
+    vendor tags, an OME-XML or ImageJ ImageDescription, and finally the
+    XResolution tag (or JPEG/PNG density). A resolution in pixels per inch
+    is only trusted above 1000 dpi, since screen and print defaults such as
+    72 or 300 dpi say nothing about the specimen. A source with a malformed
+    number is skipped.
+
+    Returns:
+        dict: {'length_per_pixel', 'units', 'source'}, or None if the file
+        declares no usable pixel size.
+    """
+    with Image.open(path) as image:
+        tags = image.tag_v2 if hasattr(image, 'tag_v2') else {}
+        x_resolution = tags.get(282)
+        x_resolution = float(x_resolution) if x_resolution else None
+        candidates = []
+        fei = tags.get(34682)
+        if isinstance(fei, str):
+            # INI-style text; PixelWidth is in metres
+            match = re.search(r'^PixelWidth=([0-9.eE+-]+)', fei, re.MULTILINE)
+            if match:
+                candidates.append((_parse_length(match.group(1), 'm'), 'FEI'))
+        zeiss = tags.get(34118)
+        if isinstance(zeiss, str):
+            match = re.search(r'Pixel Size\s*=\s*([0-9.eE+-]+)\s*(\S+)', zeiss)
+            if match:
+                candidates.append((_parse_length(match.group(1), match.group(2)), 'Zeiss'))
+        description = tags.get(270)
+        if isinstance(description, str):
+            candidates.append(_description_pixel_size(description, x_resolution))
+        resolution_unit = tags.get(296, 2)
+        if not x_resolution and image.info.get('dpi'):
+            x_resolution, resolution_unit = float(image.info['dpi'][0]), 2
+        if x_resolution and resolution_unit == 3:
+            candidates.append((normalize_length(1.0 / x_resolution, 'cm'), 'Resolution'))
+        elif x_resolution and resolution_unit == 2 and x_resolution > 1000:
+            candidates.append((normalize_length(0.0254 / x_resolution, 'm'), 'Resolution'))
+    for size, source in candidates:
+        if size is not None:
+            return {'length_per_pixel': size[0], 'units': size[1], 'source': source}
+    return None
+
+
+class MetadataCache:
+    """JSON cache of the pixel size parsed from image headers.
+
+    Entries are keyed by absolute path and validated against the file's
+    size and modification time, so calibrating thousands of unchanged files
+    again opens none of them. Changes are written by save(), which batch
+    callers invoke once at the end.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == METADATA_VERSION:
+                self._entries = data['files']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, path):
+        """Return the pixel size of an image file (see read_pixel_size), parsing its header on a miss."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry['calibration']
+        calibration = read_pixel_size(path)
+        with self._lock:
+            self._entries[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'calibration': calibration}
+            self._dirty = True
+        return calibration
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'version': METADATA_VERSION, 'files': self._entries}, f)
+            os.replace(self.path + '.tmp', self.path)
+            self._dirty = False
+
+
+def calibrate_files(paths, cache=None):
+    """Read the pixel size of many image files without decoding them.
+
+    Files that cannot be opened map to None, like files without a usable
+    pixel size. With a MetadataCache, unchanged files are not reopened.
+
+    Returns:
+        dict: path -> {'length_per_pixel', 'units', 'source'} or None.
+    """
+    results = {}
+    for path in paths:
+        try:
+            results[path] = cache.get(path) if cache is not None else read_pixel_size(path)
+        except (OSError, ValueError):
+            results[path] = None
+    if cache is not None:
+        cache.save()
+    return results
+
+
+class LoadCancelled(Exception):
+    """Raised on a loader thread when the user cancels loading an image."""
+
+
+def open_preview(path, max_size=1024):
+    """Decode a cheap low-resolution preview of an image file.
+
+    JPEGs are decoded at a reduced scale with draft(); multi-page TIFFs use
+    their smallest reduced-resolution page that is still at least
+    `max_size` pixels wide (or the largest one otherwise). Other files
+    offer no cheap preview.
+
+    Returns:
+        tuple: (preview RGB image or None, full (width, height)).
+    """
+    with Image.open(path) as image:
+        full_size = image.size
+        if image.format == 'JPEG':
+            image.draft('RGB', (max_size, max_size))
+            return image.convert('RGB'), full_size
+        if image.format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+            pages = []
+            for page in range(1, image.n_frames):
+                image.seek(page)
+                # NewSubfileType bit 0 marks a reduced-resolution version of the main image
+                if image.tag_v2.get(254, 0) & 1 and image.size[0] < full_size[0]:
+                    pages.append((image.size[0], page))
+            if pages:
+                large_enough = [p for p in pages if p[0] >= max_size]
+                image.seek(min(large_enough)[1] if large_enough else max(pages)[1])
+                return image.convert('RGB'), full_size
+    return None, full_size
+
+
+def convert_image_arrays(image, cancel=None, progress=None, strip_bytes=4 * 1024 ** 2):
+    """Convert a decoded image to RGB and HSV arrays strip by strip.
+
+    Working in strips bounds the temporary memory and lets a long
+    conversion be cancelled or report progress between strips.
+
+    Args:
+        image: PIL image of any mode.
+        cancel: Optional threading.Event; LoadCancelled is raised once it is set.
+        progress: Optional callable receiving the completed fraction.
+
+    Returns:
+        tuple: (rgb, hsv) uint8 arrays of shape (height, width, 3).
+    """
+    width, height = image.size
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    hsv = np.empty((height, width, 3), dtype=np.uint8)
+    strip_rows = max(1, strip_bytes // (3 * max(width, 1)))
+    for top in range(0, height, strip_rows):
+        if cancel is not None and cancel.is_set():
+            raise LoadCancelled()
+        bottom = min(top + strip_rows, height)
+        strip = image.crop((0, top, width, bottom))
+        if strip.mode != 'RGB':
+            strip = strip.convert('RGB')
+        rgb[top:bottom] = np.asarray(strip)
+        get_kernels().rgb_to_hsv(rgb[top:bottom], out=hsv[top:bottom])
+        if progress is not None:
+            progress(bottom / height)
+    return rgb, hsv
+
+
+class ImageLoader(threading.Thread):
+    """Decode an image file on a worker thread.
+
+    The Tk thread polls `messages`, a queue of tuples:
+        ('calibration', calibration)   pixel size from the file header, or None
+        ('preview', image, full_size)  low-resolution preview, if available
+        ('progress', fraction, stage)  fraction is None while it is unknown
+        ('done', rgb, hsv, fingerprint)
+        ('cancelled',)
+        ('error', exception)
+
+    A cache hit skips decoding; otherwise the decoded arrays are added to
+    the cache after 'done' has been posted. Cancellation is checked between
+    stages and between conversion strips; PIL cannot interrupt the decode
+    of the file itself.
+    """
+
+    def __init__(self, path, cache=None, preview_size=1024, metadata=None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.cache = cache
+        self.metadata = metadata
+        self.preview_size = preview_size
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise LoadCancelled()
+
+    def run(self):
+        try:
+            fingerprint = None
+            if self.metadata is not None:
+                # Calibration is best-effort; a header that cannot be parsed must not block loading
+                try:
+                    calibration = self.metadata.get(self.path)
+                except (OSError, ValueError):
+                    calibration = None
+                self.messages.put(('calibration', calibration))
+                try:
+                    self.metadata.save()
+                except OSError:
+                    pass
+            if self.cache is not None:
+                self.messages.put(('progress', None, 'Checking cache'))
+                arrays = self.cache.get(self.path)
+                fingerprint = self.cache.fingerprint(self.path)
+                if arrays is not None:
+                    self.messages.put(('done', arrays['rgb'], arrays['hsv'], fingerprint))
+                    return
+            self.check_cancelled()
+
+            preview, full_size = open_preview(self.path, self.preview_size)
+            if preview is not None:
+                self.messages.put(('preview', preview, full_size))
+            self.check_cancelled()
+
+            self.messages.put(('progress', None, 'Decoding'))
+            image = Image.open(self.path)
+            image.load()
+            self.check_cancelled()
+
+            rgb, hsv = convert_image_arrays(
+                image, self.cancel_event, lambda fraction: self.messages.put(('progress', fraction, 'Converting')))
+            self.messages.put(('done', rgb, hsv, fingerprint))
+            if self.cache is not None:
+                try:
+                    self.cache.put(self.path, {'rgb': rgb, 'hsv': hsv})
+                except OSError:
+                    # A full or read-only cache directory must not prevent working with the image
+                    pass
+        except LoadCancelled:
+            self.messages.put(('cancelled',))
+        except (IOError, OSError, ValueError, MemoryError) as e:
+            self.messages.put(('error', e))
+
+# File types opened by the GUI and picked up in watch mode
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp')
+
+logger = logging.getLogger('hsv_wizard')
+
+
+class FolderWatcher:
+    """Poll a directory for new image files that have been written completely.
+
+    A file is reported once its size and modification time have not changed
+    for `settle_time` seconds, so images are not read while the acquisition
+    software is still writing them. Polling works on every file system,
+    including network shares that deliver no change notifications. Files
+    present when watching starts are skipped unless `include_existing`.
+    """
+
+    def __init__(self, directory, settle_time=2.0, include_existing=False, extensions=IMAGE_EXTENSIONS,
+                 clock=time.monotonic):
+        self.directory = directory
+        self.settle_time = settle_time
+        self.extensions = tuple(extensions)
+        self.clock = clock
+        self._changing = {}
+        self._done = set() if include_existing else set(self._scan())
+
+    def _scan(self):
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(self.extensions):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # Deleted or renamed since the listing
+                        continue
+                    if entry.is_file():
+                        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def poll(self):
+        """Return the files that became complete since the last poll, sorted by name."""
+        now = self.clock()
+        ready = []
+        for path, state in self._scan().items():
+            if path in self._done:
+                continue
+            changing = self._changing.get(path)
+            if changing is None or changing[0] != state:
+                self._changing[path] = (state, now)
+            elif state[0] and now - changing[1] >= self.settle_time:
+                ready.append(path)
+                self._done.add(path)
+                del self._changing[path]
+        return sorted(ready)
+
+
+def watch_settings(session_path):
+    """Read the analysis settings (the preset) for watch mode from a session file."""
+    state = read_session(session_path)
+    thresholds = state['thresholds']
+    return {
+        'preset': os.path.basename(session_path),
+        'thresholds': (*thresholds['hue'], *thresholds['saturation'], *thresholds['value']),
+        'postprocessing': state.get('postprocessing', {}),
+        'rois': state.get('rois', []),
+        'phase_classes': state.get('phase_classes', []),
+        'calibration': state.get('calibration'),
+        'display_mode': state.get('display_mode', 'mask'),
+    }
+
+
+# Settings of a watch-mode worker process, prepared once by _init_watch_worker()
+_watch_worker = {}
+
+
+def _init_watch_worker(settings):
+    """Pool initializer: build the objects every image needs once per worker process."""
+    phase_classes = [PhaseClass.from_dict(d) for d in settings['phase_classes']]
+    # Compile JIT kernels now rather than on the first image
+    get_kernels()
+    _watch_worker.update(settings)
+    _watch_worker.update(
+        postprocessing=PostProcessing.from_dict(settings['postprocessing']),
+        rois=[ROI.from_dict(d) for d in settings['rois']],
+        phase_classes=phase_classes,
+        luts=build_class_luts(phase_classes) if phase_classes else None)
+
+
+def _watch_worker_ready(_):
+    return os.getpid()
+
+
+def process_image_file(path, output_dir=None):
+    """Threshold one image with the worker's settings; the headless counterpart of _apply_hsv_mask().
+
+    The calibration of the preset is used if it has one, otherwise the
+    pixel size from the image's metadata. With an output directory, the
+    composited image is saved there as <name>_mask.png.
+
+    Returns:
+        tuple: (results_record() dict, processing time in seconds).
+    """
+    start = time.perf_counter()
+    settings = _watch_worker
+    with Image.open(path) as image:
+        rgb, hsv = convert_image_arrays(image)
+    thresholds = settings['thresholds']
+    rois = settings['rois']
+    mask = compute_roi_runs(hsv, rois, *thresholds) if rois else compute_hsv_runs(hsv, *thresholds)
+    if settings['postprocessing'].is_active():
+        mask = settings['postprocessing'].apply_in_strips(mask)
+        if rois:
+            mask = mask & roi_union(rois, (mask.shape[1], mask.shape[0]))
+    calibration = settings['calibration']
+    if not calibration:
+        try:
+            calibration = read_pixel_size(path)
+        except (OSError, ValueError):
+            calibration = None
+    length_per_pixel = calibration['length_per_pixel'] if calibration else None
+    phases = []
+    if settings['luts'] is not None:
+        phases = class_area_table(classify_hsv(hsv, settings['luts']), settings['phase_classes'], length_per_pixel)
+    record = results_record(path, thresholds, mask, length_per_pixel, calibration['units'] if calibration else None,
+                            phases=phases, preset=settings['preset'],
+                            rois=roi_statistics(mask, rois, length_per_pixel))
+    if output_dir is not None:
+        name = os.path.splitext(os.path.basename(path))[0] + '_mask.png'
+        Image.fromarray(composite_runs(rgb, mask, settings['display_mode'])).save(os.path.join(output_dir, name))
+    return record, time.perf_counter() - start
+
+
+def watch_folder(directory, settings, results_path, output_dir=None, workers=None, poll_interval=1.0,
+                 settle_time=2.0, include_existing=False, stop=None):
+    """Process new images in a folder as they arrive, until `stop` is set.
+
+    Complete files are dispatched to a process pool that is started, and
+    initialized with the settings, before the first image arrives. Results
+    go to the database through a ResultsWriter as each image finishes. The
+    latency (from detection to result), processing time and number of
+    images still queued are logged for every file.
+
+    Returns:
+        dict: Counts of 'processed' and 'failed' images.
+
+    Raises:
+        RuntimeError: If the results writer fails, e.g. because the database
+            cannot be opened or written; watching stops at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    watcher = FolderWatcher(directory, settle_time, include_existing)
+    # Start the worker processes before any thread of this process
+    pool = multiprocessing.Pool(workers, initializer=_init_watch_worker, initargs=(settings,))
+    writer = ResultsWriter(results_path, flush_interval=0.2)
+    writer.start()
+    queued = {}
+    counts = {'processed': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    # Pool callbacks run on the pool's result thread
+    def finished(path, result):
+        record, seconds = result
+        writer.put(record)
+        with lock:
+            latency = time.monotonic() - queued.pop(path)
+            counts['processed'] += 1
+            depth = len(queued)
+        logger.info("%s: latency %.3f s (processing %.3f s), queue depth %d",
+                    os.path.basename(path), latency, seconds, depth)
+
+    def failed(path, error):
+        with lock:
+            queued.pop(path)
+            counts['failed'] += 1
+            depth = len(queued)
+        logger.error("%s: failed: %s, queue depth %d", os.path.basename(path), error, depth)
+
+    try:
+        # Wait until every worker has started, so the first image does not pay for it
+        pool.map(_watch_worker_ready, range(workers), chunksize=1)
+        logger.info("Watching %s with %d workers", directory, workers)
+        while stop is None or not stop.is_set():
+            if not writer.is_alive():
+                raise RuntimeError(f"Results writer stopped: {writer.error}")
+            for path in watcher.poll():
+                with lock:
+                    queued[path] = time.monotonic()
+                    depth = len(queued)
+                logger.debug("%s: queued, queue depth %d", os.path.basename(path), depth)
+                pool.apply_async(process_image_file, (path, output_dir),
+                                 callback=functools.partial(finished, path),
+                                 error_callback=functools.partial(failed, path))
+            if stop is None:
+                time.sleep(poll_interval)
+            else:
+                stop.wait(poll_interval)
+        # Let the queued images finish
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        writer.close()
+    if writer.error is not None:
+        raise RuntimeError(f"Failed to write results: {writer.error}")
+    return counts
+
+
+# Version of interaction scripts, and the frame interval latencies are judged against
+INTERACTION_SCRIPT_VERSION = 1
+FRAME_INTERVAL_MS = 1000 / 60
+
+# Scales whose values a recorded slider event restores before it is replayed
+RECORDED_SCALES = {
+    'update_hue': ('hue_low_scale', 'hue_high_scale'),
+    'update_saturation': ('sat_low_scale', 'sat_high_scale'),
+    'update_value': ('val_low_scale', 'val_high_scale'),
+}
+
+# Event attributes kept in a recording
+RECORDED_EVENT_FIELDS = ('x', 'y', 'delta', 'num', 'state')
+
+# Timers of the app that defer the render an event causes; a replayed event is
+# not done while one of them is pending
+REPLAY_RENDER_JOBS = ('_redraw_job', '_wheel_job')
+
+
+class InteractionRecorder:
+    """Records calls of the interaction handlers of the app for later replay.
+
+    Handlers decorated with @recorded report each call while a recorder is
+    set as the app's `recorder`. Slider events store the values of their
+    scales, everything else the position and wheel fields of the Tk event,
+    each with its time since recording started. The initial view and
+    thresholds are stored too, so a replay starts from the same state.
+    """
+
+    def __init__(self, app, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock()
+        self.events = []
+        self.initial = {
+            'image_path': app.image_path,
+            'image_size': [app.image_width, app.image_height] if app.rgb_array is not None else None,
+            'thresholds': list(app.thresholds()),
+            'zoom': app.zoom_level,
+            'view': [app.image_canvas.xview()[0], app.image_canvas.yview()[0]],
+            'calibration': [app.length_per_pixel, app.length_units] if app.scale_calibrated else None,
+        }
+
+    def record(self, app, handler, args):
+        entry = {'t': round(self.clock() - self.start, 6), 'handler': handler}
+        if handler in RECORDED_SCALES:
+            entry['scales'] = {name: getattr(app, name).get() for name in RECORDED_SCALES[handler]}
+        elif args:
+            entry['event'] = {field: getattr(args[0], field) for field in RECORDED_EVENT_FIELDS
+                              if isinstance(getattr(args[0], field, None), (int, float))}
+        self.events.append(entry)
+
+    def to_dict(self):
+        return {'version': INTERACTION_SCRIPT_VERSION, 'initial': self.initial, 'events': self.events}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+def recorded(handler):
+    """Decorate an interaction handler so its calls are recorded while the app has a recorder."""
+    @functools.wraps(handler)
+    def wrapper(self, *args):
+        recorder = getattr(self, 'recorder', None)
+        if recorder is not None:
+            recorder.record(self, handler.__name__, args)
+        return handler(self, *args)
+    return wrapper
+
+
+def read_interaction_script(path):
+    with open(path) as f:
+        script = json.load(f)
+    if script.get('version', 0) > INTERACTION_SCRIPT_VERSION:
+        raise ValueError(f"Interaction script version {script['version']} is not supported")
+    return script
+
+
+class ReplayEvent:
+    """Stand-in for a Tk event carrying the recorded fields."""
+
+    def __init__(self, x=0, y=0, delta=0, num=0, state=0, widget=None):
+        self.x, self.y, self.delta, self.num, self.state, self.widget = x, y, delta, num, state, widget
+
+
+def replay_interactions(app, script, realtime=True, settle=0.5, clock=time.perf_counter):
+    """Replay a recorded interaction script against a running app and time it.
+
+    The recorded initial state is restored first. Each event is dispatched
+    the way Tk would: slider events set their scales and let Tk invoke the
+    command, other events call the handler. Its latency runs from dispatch
+    until the render it causes has run, including renders deferred to a
+    timer (coalesced redraws, wheel zoom steps) or to the next idle cycle.
+    With realtime, events keep their recorded spacing, so later timer-driven
+    work such as zoom settling runs as in the recording; every pass of the
+    event loop is timed to count dropped frames.
+
+    Returns:
+        dict: latency_report() of the replay.
+    """
+    initial = script.get('initial', {})
+    if initial.get('calibration'):
+        app.length_per_pixel, app.length_units = initial['calibration']
+        app.scale_calibrated = True
+    if initial.get('thresholds'):
+        app.set_thresholds(*initial['thresholds'])
+    if initial.get('zoom'):
+        app.zoom_level = initial['zoom']
+        app.update_image()
+        app.update_idletasks()
+        app.image_canvas.xview_moveto(initial['view'][0])
+        app.image_canvas.yview_moveto(initial['view'][1])
+        app.update_image()
+    app.update()
+
+    latencies, handlers, gaps = [], [], []
+    start = clock()
+    for entry in script['events']:
+        if realtime:
+            while clock() < start + entry['t']:
+                before = clock()
+                app.update()
+                gaps.append(clock() - before)
+                time.sleep(0.001)
+        before = clock()
+        if 'scales' in entry:
+            for name, value in entry['scales'].items():
+                getattr(app, name).set(value)
+        else:
+            getattr(app, entry['handler'])(ReplayEvent(**entry.get('event', {})))
+        app.update_idletasks()
+        while (getattr(app, '_render_pending', False)
+               or any(getattr(app, job, None) is not None for job in REPLAY_RENDER_JOBS)):
+            app.update()
+        latency = clock() - before
+        latencies.append(latency)
+        handlers.append(entry['handler'])
+        gaps.append(latency)
+    # Let timers started by the last events (coalesced redraws, zoom settling) run
+    end = clock() + settle
+    while clock() < end:
+        before = clock()
+        app.update()
+        gaps.append(clock() - before)
+        time.sleep(0.001)
+    return latency_report(latencies, handlers, gaps)
+
+
+def latency_report(latencies, handlers=None, gaps=None, frame_ms=FRAME_INTERVAL_MS):
+    """Summarize event latencies (seconds) as percentiles in milliseconds.
+
+    Frames are dropped while the event loop is busy: a pass of the loop
+    (dispatching an event, or processing timers and idle work) that takes
+    n frame intervals drops n - 1 frames. Without `gaps` the latencies alone
+    are used. The result is plain JSON, for comparing releases.
+    """
+    def summary(values):
+        values = np.asarray(values, dtype=np.float64) * 1000
+        if not values.size:
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'count': int(values.size), 'mean_ms': round(float(values.mean()), 3),
+                'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3),
+                'p99_ms': round(float(p99), 3), 'max_ms': round(float(values.max()), 3)}
+
+    report = summary(latencies)
+    busy = np.asarray(latencies if gaps is None else gaps, dtype=np.float64) * 1000
+    report['dropped_frames'] = int(np.maximum(np.ceil(busy / frame_ms) - 1, 0).sum())
+    report['frame_ms'] = round(frame_ms, 3)
+    if handlers is not None:
+        latencies = np.asarray(latencies)
+        handlers = np.asarray(handlers)
+        report['handlers'] = {name: summary(latencies[handlers == name]) for name in sorted(set(handlers.tolist()))}
+    return report
+
+
+def zoom_anchor_origin(canvas_pos, widget_pos, old_zoom, new_zoom):
+    """Return the canvas coordinate to scroll to so a zoom stays anchored.
+
+    `canvas_pos` is the canvas coordinate under the cursor and `widget_pos`
+    the cursor position in the widget, along one axis. After zooming, the
+    same image point is again under the cursor when the viewport starts at
+    the returned canvas coordinate.
+    """
+    return canvas_pos / old_zoom * new_zoom - widget_pos
+
+
+def visible_tiles(zoom, image_size, viewport, tile_size=TILE_SIZE):
+    """Return the (tx, ty) indices of the display tiles intersecting a viewport.
+
+    Args:
+        zoom: Display zoom level.
+        image_size: (width, height) of the image in pixels.
+        viewport: (left, top, width, height) of the visible canvas area in
+            zoomed (canvas) pixels.
+    """
+    zoomed_width = int(image_size[0] * zoom)
+    zoomed_height = int(image_size[1] * zoom)
+    left, top, width, height = viewport
+    tx0 = max(int(left // tile_size), 0)
+    ty0 = max(int(top // tile_size), 0)
+    tx1 = min(int(math.ceil((left + width) / tile_size)), math.ceil(zoomed_width / tile_size))
+    ty1 = min(int(math.ceil((top + height) / tile_size)), math.ceil(zoomed_height / tile_size))
+    return [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+
+def tile_geometry(tx, ty, zoom, image_size, tile_size=TILE_SIZE):
+    """Return the display size of a tile and the image region it shows.
+
+    Returns:
+        tuple: ((width, height) in screen pixels, (x0, y0, x1, y1) float box
+        in image coordinates). Tiles at the right and bottom edges are
+        clipped to the zoomed image size.
+    """
+    left, top = tx * tile_size, ty * tile_size
+    right = min(left + tile_size, int(image_size[0] * zoom))
+    bottom = min(top + tile_size, int(image_size[1] * zoom))
+    return (right - left, bottom - top), (left / zoom, top / zoom, right / zoom, bottom / zoom)
+
+
+class TileCache:
+    """LRU cache of rendered display tiles keyed by (zoom, tx, ty, version).
+
+    The version identifies the render state (image, thresholds, display
+    mode); a change bumps it, so stale tiles simply stop being hit and are
+    evicted in LRU order rather than cleared eagerly. Each entry holds the
+    PIL tile, which later zoom steps scale for a quick preview, and the Tk
+    photo image shown on the canvas.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        """Return the (image, photo) pair of a tile, or None."""
+        entry = self._tiles.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._tiles.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def peek(self, key):
+        """Return a tile without counting a lookup or refreshing its age."""
+        return self._tiles.get(key)
+
+    def put(self, key, image, photo=None):
+        if key in self._tiles:
+            self.nbytes -= self._tile_bytes(self._tiles.pop(key)[0])
+        self._tiles[key] = (image, photo)
+        self.nbytes += self._tile_bytes(image)
+        while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+            _, (old_image, _) = self._tiles.popitem(last=False)
+            self.nbytes -= self._tile_bytes(old_image)
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+    def retain(self, keys):
+        """Drop every tile except those in `keys`, e.g. the tiles on screen."""
+        for key in [key for key in self._tiles if key not in keys]:
+            self.nbytes -= self._tile_bytes(self._tiles.pop(key)[0])
+
+    @staticmethod
+    def _tile_bytes(image):
+        # RGB PIL tile plus the Tk photo image, which stores 4 bytes per pixel
+        return image.width * image.height * 7
+
+
+# Grid cell size (image pixels) of the overlay index, the number of measurements in
+# view above which they are drawn into one image, and the room (screen pixels) kept for labels
+OVERLAY_CELL_SIZE = 512
+OVERLAY_DENSE_LIMIT = 300
+OVERLAY_LABEL_MARGIN = 60
+MEASUREMENT_COLOR = 'yellow'
+
+
+class OverlayIndex:
+    """Uniform grid over image coordinates for finding the annotations inside a box.
+
+    Each annotation is entered in every cell its bounding box touches, so a
+    query only visits the cells the box covers, however many annotations
+    lie elsewhere.
+    """
+
+    def __init__(self, cell_size=OVERLAY_CELL_SIZE):
+        self.cell_size = cell_size
+        self.boxes = {}
+        self._cells = {}
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _cell_range(self, box):
+        x0, y0, x1, y1 = box
+        size = self.cell_size
+        for cy in range(int(y0 // size), int(y1 // size) + 1):
+            for cx in range(int(x0 // size), int(x1 // size) + 1):
+                yield cx, cy
+
+    def insert(self, key, box):
+        """Add or move annotation `key` with bounding box (x0, y0, x1, y1)."""
+        self.remove(key)
+        x0, y0, x1, y1 = box
+        box = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        self.boxes[key] = box
+        for cell in self._cell_range(box):
+            self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if box is None:
+            return
+        for cell in self._cell_range(box):
+            keys = self._cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def clear(self):
+        self.boxes.clear()
+        self._cells.clear()
+
+    def query(self, box):
+        """Return the keys of the annotations whose bounding box overlaps box."""
+        x0, y0, x1, y1 = box
+        candidates = set()
+        for cell in self._cell_range(box):
+            candidates.update(self._cells.get(cell, ()))
+        boxes = self.boxes
+        return {key for key in candidates
+                if boxes[key][0] <= x1 and boxes[key][2] >= x0 and boxes[key][1] <= y1 and boxes[key][3] >= y0}
+
+
+class MeasurementLayer:
+    """Draws the measurements of a MeasurementStore on the canvas, only inside the viewport.
+
+    Measurements are kept in an OverlayIndex in image coordinates. Canvas
+    items (a line and a label each) exist only for the measurements in view
+    and are placed from their image coordinates, so they follow the zoom.
+    With more than dense_limit measurements in view, the lines are drawn
+    into a single overlay image of the viewport instead, without labels.
+    The layer follows the store: measurements are only appended to or
+    popped from its end.
+    """
+
+    def __init__(self, canvas, measurements, dense_limit=OVERLAY_DENSE_LIMIT):
+        self.canvas = canvas
+        self.measurements = measurements
+        self.dense_limit = dense_limit
+        self.index = OverlayIndex()
+        self.items = {}
+        self.version = 0
+        self._zoom = None
+        self._raster = None
+
+    def sync(self):
+        """Index measurements appended to the store and drop those removed from it."""
+        count = len(self.measurements)
+        if len(self.index) == count:
+            return
+        self.truncate(count)
+        if len(self.index) < count:
+            x0, y0 = self.measurements.column('x0'), self.measurements.column('y0')
+            x1, y1 = self.measurements.column('x1'), self.measurements.column('y1')
+            for key in range(len(self.index), count):
+                self.index.insert(key, (x0[key], y0[key], x1[key], y1[key]))
+        self.version += 1
+
+    def truncate(self, count):
+        """Forget the measurements from index `count` on, e.g. after the store's rows were replaced."""
+        if len(self.index) <= count:
+            return
+        while len(self.index) > count:
+            key = len(self.index) - 1
+            self.index.remove(key)
+            for item_id in self.items.pop(key, ()):
+                self.canvas.delete(item_id)
+        self.version += 1
+
+    def refresh(self, zoom, viewport, units):
+        """Show the measurements inside viewport (image coordinates) at the given zoom."""
+        self.sync()
+        margin = OVERLAY_LABEL_MARGIN / zoom
+        x0, y0, x1, y1 = viewport
+        visible = self.index.query((x0 - margin, y0 - margin, x1 + margin, y1 + margin))
+        if len(visible) > self.dense_limit:
+            for key in list(self.items):
+                for item_id in self.items.pop(key):
+                    self.canvas.delete(item_id)
+            self.draw_raster(sorted(visible), zoom, viewport)
+        else:
+            self.drop_raster()
+            for key in [key for key in self.items if key not in visible]:
+                for item_id in self.items.pop(key):
+                    self.canvas.delete(item_id)
+            for key in visible:
+                if key not in self.items:
+                    self.items[key] = self.create_items(key, zoom, units)
+                elif zoom != self._zoom:
+                    self.place_items(key, zoom)
+        self._zoom = zoom
+
+    def create_items(self, key, zoom, units):
+        row = self.measurements.row(key)
+        line_id = self.canvas.create_line(row['x0'] * zoom, row['y0'] * zoom, row['x1'] * zoom, row['y1'] * zoom,
+                                          fill=MEASUREMENT_COLOR, width=2, tags='measurement')
+        text_id = self.canvas.create_text(
+            (row['x0'] + row['x1']) / 2 * zoom, (row['y0'] + row['y1']) / 2 * zoom - 10,
+            text=f"{row['length']:.2f} {units}", fill=MEASUREMENT_COLOR, font=('Arial', 12), tags='measurement')
+        return line_id, text_id
+
+    def place_items(self, key, zoom):
+        row = self.measurements.row(key)
+        line_id, text_id = self.items[key]
+        self.canvas.coords(line_id, row['x0'] * zoom, row['y0'] * zoom, row['x1'] * zoom, row['y1'] * zoom)
+        self.canvas.coords(text_id, (row['x0'] + row['x1']) / 2 * zoom, (row['y0'] + row['y1']) / 2 * zoom - 10)
+
+    def draw_raster(self, keys, zoom, viewport):
+        """Draw the lines of `keys` into one image covering the viewport, reused while nothing changes."""
+        left, top = int(viewport[0] * zoom), int(viewport[1] * zoom)
+        width = max(int(viewport[2] * zoom) - left, 1)
+        height = max(int(viewport[3] * zoom) - top, 1)
+        key = (zoom, left, top, width, height, self.version)
+        if self._raster is not None and self._raster[0] == key:
+            return
+        keys = np.asarray(keys)
+        lines = np.column_stack([self.measurements.column(name)[keys] for name in ('x0', 'y0', 'x1', 'y1')]) * zoom
+        lines -= (left, top, left, top)
+        image = Image.new('RGBA', (width, height))
+        draw = ImageDraw.Draw(image)
+        for line in lines.tolist():
+            draw.line(line, fill=MEASUREMENT_COLOR, width=2)
+        photo = ImageTk.PhotoImage(image)
+        if self._raster is None:
+            item_id = self.canvas.create_image(left, top, anchor='nw', image=photo, tags='measurement')
+        else:
+            item_id = self._raster[1]
+            self.canvas.coords(item_id, left, top)
+            self.canvas.itemconfig(item_id, image=photo)
+        self._raster = (key, item_id, photo)
+
+    def drop_raster(self):
+        if self._raster is not None:
+            self.canvas.delete(self._raster[1])
+            self._raster = None
+
+
+def array_footprint(*arrays):
+    """Return (resident, mapped) bytes of arrays; memory-mapped arrays count as mapped."""
+    resident = mapped = 0
+    for array in arrays:
+        if array is None:
+            continue
+        if isinstance(array, np.memmap):
+            mapped += array.nbytes
+        else:
+            resident += array.nbytes
+    return resident, mapped
+
+
+def default_memory_budget():
+    """Return the default memory budget: $HSV_WIZARD_MEMORY_BUDGET (MB), else half the RAM."""
+    if os.environ.get('HSV_WIZARD_MEMORY_BUDGET'):
+        return int(float(os.environ['HSV_WIZARD_MEMORY_BUDGET']) * 1024 ** 2)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB'):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {unit}" if unit == 'B' else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.2f} GB"
+
+
+class BufferRegistry:
+    """Central accounting of the large arrays and caches held by the app.
+
+    Each buffer is registered with a callable returning its current size,
+    either as bytes or as a (resident, mapped) tuple from array_footprint().
+    Buffers that can be rebuilt on demand also get an eviction callback;
+    when the resident total exceeds the budget, enforce() evicts them in
+    order of priority (lowest first) until the total fits. A buffer whose
+    `in_use` callable returns True backs what is shown right now and is
+    skipped, as evicting it would only force a rebuild on the next render.
+    Memory-mapped arrays are reported but not counted against the budget,
+    as the OS can drop their pages at any time.
+
+    enforce() does nothing while the budget and the buffer sizes are as they
+    were after its last run, so calling it after every render is cheap and
+    cannot evict the same caches over and over. If the buffers that cannot
+    be evicted exceed the budget on their own, over_budget stays True.
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = default_memory_budget() if budget_bytes is None else budget_bytes
+        self.evictions = 0
+        self.over_budget = False
+        self._entries = {}
+        self._enforced_state = None
+
+    def register(self, name, size, evict=None, priority=0, in_use=None):
+        self._entries[name] = (size, evict, priority, in_use)
+
+    def unregister(self, name):
+        self._entries.pop(name, None)
+
+    def footprint(self):
+        """Return {name: (resident, mapped)} for all registered buffers."""
+        sizes = {}
+        for name, (size, _, _, _) in self._entries.items():
+            value = size()
+            sizes[name] = value if isinstance(value, tuple) else (value, 0)
+        return sizes
+
+    def total(self):
+        """Return the (resident, mapped) totals in bytes."""
+        sizes = self.footprint().values()
+        return sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+
+    def _state(self):
+        return self.budget_bytes, tuple(self.footprint().items())
+
+    def enforce(self):
+        """Evict caches until the resident total fits the budget; return the evicted names."""
+        if self._state() == self._enforced_state:
+            return []
+        resident = self.total()[0]
+        evicted = []
+        candidates = sorted((entry[2], name) for name, entry in self._entries.items() if entry[1] is not None)
+        for _, name in candidates:
+            if resident <= self.budget_bytes:
+                break
+            size, evict, _, in_use = self._entries[name]
+            if in_use is not None and in_use():
+                continue
+            before = self.footprint()[name][0]
+            if before:
+                evict()
+                freed = before - self.footprint()[name][0]
+                if freed:
+                    resident -= freed
+                    evicted.append(name)
+                    self.evictions += 1
+        self.over_budget = resident > self.budget_bytes
+        self._enforced_state = self._state()
+        return evicted
+
+    def dump(self):
+        """Return a plain-text table of all buffers, for the UI and bug reports."""
+        sizes = self.footprint()
+        width = max([len(name) for name in sizes] + [6])
+        lines = [f"{'Buffer':<{width}}  {'Resident':>10}  {'Mapped':>10}  Evictable"]
+        for name, (resident, mapped) in sizes.items():
+            entry = self._entries[name]
+            evictable = 'no' if entry[1] is None else 'in use' if entry[3] is not None and entry[3]() else 'yes'
+            lines.append(f"{name:<{width}}  {format_bytes(resident):>10}  {format_bytes(mapped):>10}  {evictable}")
+        resident, mapped = self.total()
+        lines.append(f"{'Total':<{width}}  {format_bytes(resident):>10}  {format_bytes(mapped):>10}")
+        lines.append(f"Budget: {format_bytes(self.budget_bytes)}, evictions so far: {self.evictions}")
+        return '\n'.join(lines)
+
 class CalibrationDialog(tk.Toplevel):
     """Modal dialog for entering calibration parameters (length and units)."""
 
@@ -172,18 +4231,160 @@ class CalibrationDialog(tk.Toplevel):
         self.units = None
         self.destroy()
 
+class ImageCacheDialog(tk.Toplevel):
+    """Dialog showing image cache statistics, with controls for the size cap."""
+
+    def __init__(self, parent, cache):
+        super().__init__(parent)
+        self.title("Image Cache")
+        self.resizable(False, False)
+        self.cache = cache
+
+        tk.Label(self, text=f"Location: {cache.directory}", anchor='w').pack(padx=10, pady=(10, 0), fill='x')
+        self.stats_label = tk.Label(self, anchor='w', justify='left')
+        self.stats_label.pack(padx=10, pady=5, fill='x')
+
+        size_frame = tk.Frame(self)
+        size_frame.pack(padx=10, pady=5, fill='x')
+        tk.Label(size_frame, text="Size limit (GB):").pack(side='left')
+        self.size_entry = tk.Entry(size_frame, width=8)
+        self.size_entry.insert(0, f"{cache.max_bytes / 1024 ** 3:g}")
+        self.size_entry.pack(side='left', padx=5)
+        tk.Button(size_frame, text="Apply", command=self.on_apply).pack(side='left')
+
+        tk.Button(self, text="Clear Cache", command=self.on_clear).pack(pady=10)
+        self.update_stats()
+
+    def update_stats(self):
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = f"{100 * stats['hits'] / lookups:.0f}%" if lookups else "n/a"
+        self.stats_label.config(text=(
+            f"Entries: {stats['entries']}\n"
+            f"Used: {stats['bytes'] / 1024 ** 2:.1f} MB of {stats['max_bytes'] / 1024 ** 2:.0f} MB\n"
+            f"Hits: {stats['hits']}  Misses: {stats['misses']}  (hit rate {hit_rate})\n"
+            f"Evictions: {stats['evictions']}"))
+
+    def on_apply(self):
+        try:
+            size = float(self.size_entry.get())
+            if size <= 0:
+                raise ValueError("The size limit must be positive.")
+            self.cache.max_bytes = size * 1024 ** 3
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to update the cache:\n{e}")
+        self.update_stats()
+
+    def on_clear(self):
+        try:
+            self.cache.clear()
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to clear the cache:\n{e}")
+        self.update_stats()
+
+class MemoryDialog(tk.Toplevel):
+    """Dialog listing the memory footprint of all buffers, with the budget setting."""
+
+    def __init__(self, parent, registry):
+        super().__init__(parent)
+        self.title("Memory Usage")
+        self.parent = parent
+        self.registry = registry
+
+        self.text_widget = scrolledtext.ScrolledText(self, width=64, height=12, font=('Courier', 10))
+        self.text_widget.pack(padx=10, pady=10, fill='both', expand=True)
+
+        budget_frame = tk.Frame(self)
+        budget_frame.pack(padx=10, pady=5, fill='x')
+        tk.Label(budget_frame, text="Memory budget (GB):").pack(side='left')
+        self.budget_entry = tk.Entry(budget_frame, width=8)
+        self.budget_entry.insert(0, f"{registry.budget_bytes / 1024 ** 3:.2f}")
+        self.budget_entry.pack(side='left', padx=5)
+        tk.Button(budget_frame, text="Apply", command=self.on_apply).pack(side='left')
+        tk.Button(budget_frame, text="Refresh", command=self.refresh).pack(side='right')
+        self.refresh()
+
+    def refresh(self):
+        self.text_widget.delete('1.0', tk.END)
+        self.text_widget.insert(tk.END, self.registry.dump())
+
+    def on_apply(self):
+        try:
+            budget = float(self.budget_entry.get())
+            if budget <= 0:
+                raise ValueError("The memory budget must be positive.")
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+            return
+        self.registry.budget_bytes = int(budget * 1024 ** 3)
+        self.parent.enforce_memory_budget()
+        self.refresh()
+
+
+class HistoryDialog(tk.Toplevel):
+    """Dialog listing the undo history; double-click an entry to jump back or forward to it."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("History")
+        self.parent = parent
+        self._shown = None
+
+        self.listbox = tk.Listbox(self, width=40, height=20, activestyle='none')
+        self.listbox.pack(padx=10, pady=10, fill='both', expand=True)
+        self.listbox.bind('<Double-Button-1>', self.on_jump)
+        button_frame = tk.Frame(self)
+        button_frame.pack(padx=10, pady=5, fill='x')
+        tk.Button(button_frame, text="Undo", command=parent.undo_action).pack(side='left')
+        tk.Button(button_frame, text="Redo", command=parent.redo_action).pack(side='left', padx=5)
+        tk.Button(button_frame, text="Go to", command=self.on_jump).pack(side='right')
+        self.refresh()
+
+    def refresh(self):
+        history = self.parent.history
+        # Merged slider changes leave the list as it is
+        shown = (len(history), history.position, id(history.entries[0]) if history.entries else None)
+        if shown == self._shown:
+            return
+        self._shown = shown
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, "Start", *history.labels())
+        # Undone entries, which redo would restore, are greyed out
+        for index in range(history.position + 1, len(history) + 1):
+            self.listbox.itemconfig(index, foreground='gray')
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(history.position)
+        self.listbox.see(history.position)
+
+    def on_jump(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self.parent.jump_history(selection[0])
+
 class MeasurementDialog(tk.Toplevel):
     """Dialog for displaying, copying, and exporting measurement results."""
 
+    HISTOGRAM_BINS = 10
+
     def __init__(self, parent, measurements):
         super().__init__(parent)
         self.title("Measurements")
         self.resizable(True, True)
         self.parent = parent
         self.measurements = measurements
+        # Number of measurements currently listed in the text widget
+        self.shown = 0
 
         self.text_widget = scrolledtext.ScrolledText(self, width=40, height=15)
         self.text_widget.pack(padx=10, pady=10)
+
+        self.summary_label = tk.Label(self, anchor='w', justify='left')
+        self.summary_label.pack(padx=10, fill='x')
+        self.histogram_canvas = tk.Canvas(self, width=300, height=60, bg='white')
+        self.histogram_canvas.pack(padx=10, pady=5)
+
         self.update_measurements(self.measurements)
 
         button_frame = tk.Frame(self)
@@ -195,12 +4396,51 @@ class MeasurementDialog(tk.Toplevel):
         save_button = tk.Button(button_frame, text="Save to CSV", command=self.save_to_csv)
         save_button.pack(side='left', padx=5)
 
+    def format_row(self, index):
+        row = self.measurements.row(index)
+        units = self.parent.length_units
+        text = f"{index+1}: {row['length']:.2f} {units}"
+        if not math.isnan(row['feret_min']):
+            text += f" (min {row['feret_min']:.2f}, skeleton {row['skeleton_length']:.2f} {units})"
+        return f"{text}  {row['label']}" if row['label'] else text
+
     def update_measurements(self, measurements):
+        """Sync the list with the store, appending only new rows where possible."""
+        self.measurements = measurements
         self.text_widget.config(state='normal')
-        self.text_widget.delete('1.0', 'end')
-        text = "\n".join(f"{i+1}: {length:.2f} {self.parent.length_units}" for i, length in enumerate(measurements))
-        self.text_widget.insert('1.0', text)
+        if len(measurements) < self.shown:
+            # Rows were removed (undo or clear); rebuild the list
+            self.text_widget.delete('1.0', 'end')
+            self.shown = 0
+        new_rows = [self.format_row(i) for i in range(self.shown, len(measurements))]
+        if new_rows:
+            prefix = "\n" if self.shown else ""
+            self.text_widget.insert('end', prefix + "\n".join(new_rows))
+            self.text_widget.see('end')
+        self.shown = len(measurements)
         self.text_widget.config(state='disabled')
+        self.update_summary()
+
+    def update_summary(self):
+        count, mean, std = self.measurements.summary()
+        self.histogram_canvas.delete('all')
+        if not count:
+            self.summary_label.config(text="No measurements.")
+            return
+        units = self.parent.length_units
+        lengths = self.measurements.lengths
+        self.summary_label.config(
+            text=f"n = {count}   mean = {mean:.2f} {units}   SD = {std:.2f} {units}\n"
+                 f"min = {lengths.min():.2f} {units}   max = {lengths.max():.2f} {units}")
+        counts, edges = self.measurements.histogram(self.HISTOGRAM_BINS)
+        width = int(self.histogram_canvas['width'])
+        height = int(self.histogram_canvas['height'])
+        bar_width = width / len(counts)
+        peak = max(counts.max(), 1)
+        for i, bin_count in enumerate(counts):
+            bar_height = (height - 4) * bin_count / peak
+            self.histogram_canvas.create_rectangle(i * bar_width + 1, height - bar_height, (i + 1) * bar_width - 1,
+                                                   height, fill='steelblue', outline='')
 
     def copy_to_clipboard(self):
         self.clipboard_clear()
@@ -217,18 +4457,359 @@ class MeasurementDialog(tk.Toplevel):
             try:
                 with open(save_path, 'w', newline='') as csvfile:
                     writer = csv.writer(csvfile)
-                    writer.writerow(['Measurement', f'Length ({self.parent.length_units})'])
-                    for i, length in enumerate(self.measurements):
-                        writer.writerow([i+1, f"{length:.2f}"])
+                    units = self.parent.length_units
+                    writer.writerow(['Measurement', f'Length ({units})', 'X0 (px)', 'Y0 (px)',
+                                     'X1 (px)', 'Y1 (px)', 'Angle (deg)', 'Timestamp', 'Label',
+                                     f'Feret Min ({units})', f'Skeleton Length ({units})', f'Area ({units}²)'])
+                    for i in range(len(self.measurements)):
+                        row = self.measurements.row(i)
+                        extra = ['' if math.isnan(row[key]) else f"{row[key]:.4g}"
+                                 for key in ('feret_min', 'skeleton_length', 'area')]
+                        writer.writerow([i+1, f"{row['length']:.2f}", f"{row['x0']:.1f}", f"{row['y0']:.1f}",
+                                         f"{row['x1']:.1f}", f"{row['y1']:.1f}", f"{row['angle']:.1f}",
+                                         time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(row['timestamp'])),
+                                         row['label']] + extra)
                 messagebox.showinfo("Saved", "Measurements saved successfully.")
             except (IOError, OSError) as e:
                 messagebox.showerror("Error", f"Failed to save measurements:\n{e}")
 
+class PhaseClassDialog(tk.Toplevel):
+    """Dialog for managing named HSV phase classes and showing their area table."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Phase Classes")
+        self.resizable(True, True)
+        self.parent = parent
+
+        self.class_list = tk.Listbox(self, width=40, height=MAX_PHASE_CLASSES)
+        self.class_list.pack(padx=10, pady=(10, 5), fill='x')
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(pady=5)
+
+        add_button = tk.Button(button_frame, text="Add Current Window", command=self.add_class)
+        add_button.pack(side='left', padx=5)
+
+        load_button = tk.Button(button_frame, text="Load Window", command=self.load_class)
+        load_button.pack(side='left', padx=5)
+
+        set_button = tk.Button(button_frame, text="Set To Current", command=self.set_class)
+        set_button.pack(side='left', padx=5)
+
+        remove_button = tk.Button(button_frame, text="Remove", command=self.remove_class)
+        remove_button.pack(side='left', padx=5)
+
+        self.show_var = tk.BooleanVar(value=parent.show_classes)
+        show_check = tk.Checkbutton(self, text="Show false-color overlay", variable=self.show_var,
+                                    command=self.toggle_overlay)
+        show_check.pack(pady=5)
+
+        self.text_widget = scrolledtext.ScrolledText(self, width=50, height=10)
+        self.text_widget.pack(padx=10, pady=5)
+
+        save_button = tk.Button(self, text="Save to CSV", command=self.save_to_csv)
+        save_button.pack(pady=(5, 10))
+
+        self.refresh()
+
+    def refresh(self):
+        self.class_list.delete(0, 'end')
+        for index, phase in enumerate(self.parent.phase_classes):
+            self.class_list.insert('end', f"{phase.name}  (H {phase.hue_low:.0f}-{phase.hue_high:.0f}°, "
+                                          f"S {phase.sat_low:.0f}-{phase.sat_high:.0f}%, "
+                                          f"V {phase.val_low:.0f}-{phase.val_high:.0f}%)")
+            self.class_list.itemconfig(index, foreground='#%02x%02x%02x' % phase.color)
+        self.update_area_table()
+
+    def update_area_table(self):
+        rows = self.parent.class_areas()
+        units = self.parent.length_units if self.parent.scale_calibrated else None
+        lines = []
+        for name, count, fraction, area in rows:
+            line = f"{name}: {count} px ({fraction * 100:.2f}%)"
+            if area is not None and units:
+                line += f", {area:.4g} {units}²"
+            lines.append(line)
+        self.text_widget.config(state='normal')
+        self.text_widget.delete('1.0', 'end')
+        self.text_widget.insert('1.0', "\n".join(lines))
+        self.text_widget.config(state='disabled')
+
+    def add_class(self):
+        if len(self.parent.phase_classes) >= MAX_PHASE_CLASSES:
+            messagebox.showwarning("Phase Classes", f"At most {MAX_PHASE_CLASSES} classes are supported.")
+            return
+        name = simpledialog.askstring("Phase Class", "Enter a name for the class:", parent=self)
+        if not name:
+            return
+        color = PHASE_CLASS_COLORS[len(self.parent.phase_classes) % len(PHASE_CLASS_COLORS)]
+        picked = colorchooser.askcolor(color='#%02x%02x%02x' % color, title="Class Color", parent=self)
+        if picked[0] is not None:
+            color = picked[0]
+        p = self.parent
+        p.phase_classes.append(PhaseClass(name, p.hue_low, p.hue_high, p.sat_low, p.sat_high,
+                                          p.val_low, p.val_high, color))
+        p.record_history('Phase classes', 'phase_classes')
+        p.update_image()
+        self.refresh()
+
+    def load_class(self):
+        selection = self.class_list.curselection()
+        if not selection:
+            return
+        self.parent.set_thresholds(*self.parent.phase_classes[selection[0]].window())
+
+    def set_class(self):
+        selection = self.class_list.curselection()
+        if not selection:
+            return
+        p = self.parent
+        phase = p.phase_classes[selection[0]]
+        phase.hue_low, phase.hue_high = p.hue_low, p.hue_high
+        phase.sat_low, phase.sat_high = p.sat_low, p.sat_high
+        phase.val_low, phase.val_high = p.val_low, p.val_high
+        p.record_history('Phase classes', 'phase_classes')
+        p.update_image()
+        self.refresh()
+
+    def remove_class(self):
+        selection = self.class_list.curselection()
+        if not selection:
+            return
+        del self.parent.phase_classes[selection[0]]
+        self.parent.record_history('Phase classes', 'phase_classes')
+        self.parent.update_image()
+        self.refresh()
+
+    def toggle_overlay(self):
+        self.parent.show_classes = self.show_var.get()
+        self.parent.record_history('Class overlay', 'show_classes')
+        self.parent.update_image()
+
+    def save_to_csv(self):
+        save_path = filedialog.asksaveasfilename(
+            defaultextension='.csv',
+            filetypes=[('CSV File', '*.csv'), ('All Files', '*.*')],
+            title='Save Phase Areas'
+        )
+        if save_path:
+            units = self.parent.length_units if self.parent.scale_calibrated else None
+            try:
+                with open(save_path, 'w', newline='') as csvfile:
+                    writer = csv.writer(csvfile)
+                    header = ['Class', 'Pixels', 'Area Fraction']
+                    if units:
+                        header.append(f'Area ({units}²)')
+                    writer.writerow(header)
+                    for name, count, fraction, area in self.parent.class_areas():
+                        row = [name, count, f"{fraction:.6f}"]
+                        if units:
+                            row.append(f"{area:.6g}")
+                        writer.writerow(row)
+                messagebox.showinfo("Saved", "Phase areas saved successfully.")
+            except (IOError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to save phase areas:\n{e}")
+
+class ThresholdSuggestionDialog(tk.Toplevel):
+    """Dialog listing histogram-based threshold candidates and coverage curves.
+
+    Everything shown is computed from the HSV histograms of the image, so
+    browsing candidates and curves never re-renders the image; only
+    applying a candidate or clicking a curve changes the thresholds.
+    """
+
+    CURVE_WIDTH = 360
+    CURVE_HEIGHT = 140
+    CURVE_POINTS = 256
+    BOUND_LABELS = ('Hue low', 'Hue high', 'Saturation low', 'Saturation high', 'Value low', 'Value high')
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Suggest Thresholds")
+        self.parent = parent
+        self.candidates = []
+
+        tk.Label(self, text="Candidates (most stable first):", anchor='w').pack(padx=10, pady=(10, 0), fill='x')
+        self.candidate_list = tk.Listbox(self, width=72, height=8, font=('Courier', 10))
+        self.candidate_list.pack(padx=10, pady=5, fill='x')
+        self.candidate_list.bind('<Double-Button-1>', lambda event: self.apply_candidate())
+        tk.Button(self, text="Apply", command=self.apply_candidate).pack(pady=5)
+
+        curve_frame = tk.Frame(self)
+        curve_frame.pack(padx=10, pady=(5, 0), fill='x')
+        tk.Label(curve_frame, text="Coverage curve of:").pack(side='left')
+        self.bound_var = tk.StringVar(value=self.BOUND_LABELS[2])
+        bound_box = ttk.Combobox(curve_frame, textvariable=self.bound_var, values=self.BOUND_LABELS,
+                                 state='readonly', width=16)
+        bound_box.pack(side='left', padx=5)
+        bound_box.bind('<<ComboboxSelected>>', lambda event: self.draw_curve())
+
+        self.curve_canvas = tk.Canvas(self, width=self.CURVE_WIDTH, height=self.CURVE_HEIGHT, bg='white')
+        self.curve_canvas.pack(padx=10, pady=5)
+        self.curve_canvas.bind('<Button-1>', self.on_curve_click)
+        self.curve_label = tk.Label(self, text="Click the curve to set the bound.", anchor='w')
+        self.curve_label.pack(padx=10, pady=(0, 10), fill='x')
+
+        self.refresh()
+
+    def refresh(self):
+        """Recompute the candidates for the current image and thresholds."""
+        histogram = self.parent.hsv_histogram()
+        self.candidate_list.delete(0, tk.END)
+        self.candidates = suggest_thresholds(histogram, self.parent.thresholds()) if histogram else []
+        for candidate in self.candidates:
+            h0, h1, s0, s1, v0, v1 = candidate['window']
+            self.candidate_list.insert(
+                tk.END, f"{candidate['name']:<24} H {h0:3.0f}-{h1:3.0f}  S {s0:3.0f}-{s1:3.0f}  "
+                        f"V {v0:3.0f}-{v1:3.0f}  {candidate['coverage'] * 100:6.2f}%")
+        self.draw_curve()
+
+    def apply_candidate(self):
+        selection = self.candidate_list.curselection()
+        if selection:
+            self.parent.set_thresholds(*self.candidates[selection[0]]['window'])
+            self.draw_curve()
+
+    def selected_bound(self):
+        return self.BOUND_LABELS.index(self.bound_var.get())
+
+    def draw_curve(self):
+        """Plot the coverage against the selected bound over the channel histogram."""
+        canvas = self.curve_canvas
+        canvas.delete('all')
+        histogram = self.parent.hsv_histogram()
+        if histogram is None:
+            return
+        index = self.selected_bound()
+        name, channel, scale = THRESHOLD_BOUNDS[index]
+        width, height = self.CURVE_WIDTH, self.CURVE_HEIGHT
+        counts = histogram.channels[channel]
+        peak = max(int(counts.max()), 1)
+        bar_width = width / len(counts)
+        for level, count in enumerate(counts):
+            if count:
+                top = height - count / peak * (height - 10)
+                canvas.create_rectangle(level * bar_width, top, (level + 1) * bar_width, height,
+                                        fill='#d0d0d0', outline='')
+        window = self.parent.thresholds()
+        values = np.linspace(0, scale, self.CURVE_POINTS)
+        coverage = histogram.coverage_curve(window, name, values)
+        points = np.column_stack([values / scale * width, height - coverage * (height - 10)]).ravel().tolist()
+        canvas.create_line(*points, fill='blue', width=2)
+        current = window[index] / scale * width
+        canvas.create_line(current, 0, current, height, fill='red')
+        stable = stable_bound(values, coverage)
+        text = f"{self.BOUND_LABELS[index]} = {window[index]:.1f}: {histogram.coverage(*window) * 100:.2f}% selected"
+        if stable is not None:
+            x = stable / scale * width
+            canvas.create_line(x, 0, x, height, fill='green', dash=(4, 2))
+            text += f"; flattest at {stable:.1f}"
+        self.curve_label.config(text=text)
+
+    def on_curve_click(self, event):
+        """Set the selected bound to the clicked position."""
+        index = self.selected_bound()
+        _, _, scale = THRESHOLD_BOUNDS[index]
+        window = list(self.parent.thresholds())
+        value = min(max(event.x / self.CURVE_WIDTH * scale, 0), scale)
+        if index >= 2:
+            # Saturation and value bounds must not cross; hue windows may wrap
+            low, high = (index // 2) * 2, (index // 2) * 2 + 1
+            value = min(value, window[high]) if index == low else max(value, window[low])
+            value = round(value)
+        window[index] = value
+        self.parent.set_thresholds(*window)
+        self.draw_curve()
+
+
+class ThicknessDialog(tk.Toplevel):
+    """Dialog showing the local thickness histogram of the processed mask."""
+
+    HISTOGRAM_BINS = 50
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Local Thickness")
+        self.parent = parent
+        self.histogram = None
+
+        self.summary_label = tk.Label(self, anchor='w', justify='left')
+        self.summary_label.pack(padx=10, pady=(10, 0), fill='x')
+        self.histogram_canvas = tk.Canvas(self, width=360, height=120, bg='white')
+        self.histogram_canvas.pack(padx=10, pady=5)
+        self.range_label = tk.Label(self, anchor='w')
+        self.range_label.pack(padx=10, fill='x')
+
+        self.show_var = tk.BooleanVar(value=parent.show_thickness)
+        tk.Checkbutton(self, text="Show heat map", variable=self.show_var,
+                       command=self.toggle_heat_map).pack(padx=10, anchor='w')
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(pady=5)
+        tk.Button(button_frame, text="Recompute", command=self.recompute).pack(side='left', padx=5)
+        tk.Button(button_frame, text="Save to CSV", command=self.save_to_csv).pack(side='left', padx=5)
+
+        self.refresh()
+
+    def refresh(self):
+        """Show the histogram of the current thickness map, if it is up to date."""
+        self.histogram_canvas.delete('all')
+        thickness = self.parent.thickness_map()
+        if thickness is None:
+            self.histogram = None
+            self.summary_label.config(text="The thickness map is out of date; click Recompute.")
+            self.range_label.config(text="")
+            return
+        length_per_pixel = self.parent.length_per_pixel if self.parent.scale_calibrated else None
+        units = self.parent.length_units if length_per_pixel else 'px'
+        self.histogram = thickness_histogram(thickness, self.HISTOGRAM_BINS, length_per_pixel)
+        h = self.histogram
+        self.summary_label.config(
+            text=f"{h['pixels']} px   mean = {h['mean']:.4g} {units}   SD = {h['std']:.4g} {units}\n"
+                 f"median = {h['median']:.4g} {units}   max = {h['max']:.4g} {units}")
+        self.range_label.config(text=f"0 – {h['edges'][-1]:.4g} {units}")
+        counts = h['counts']
+        width = int(self.histogram_canvas['width'])
+        height = int(self.histogram_canvas['height'])
+        bar_width = width / len(counts)
+        peak = max(counts.max(), 1)
+        for i, bin_count in enumerate(counts):
+            bar_height = (height - 4) * bin_count / peak
+            color = '#%02x%02x%02x' % tuple(thickness_colors((i + 0.5) / len(counts)))
+            self.histogram_canvas.create_rectangle(i * bar_width, height - bar_height, (i + 1) * bar_width,
+                                                   height, fill=color, outline='')
+
+    def toggle_heat_map(self):
+        self.parent.show_thickness = self.show_var.get()
+        self.parent.update_image()
+
+    def recompute(self):
+        self.parent.compute_thickness()
+        self.refresh()
+
+    def save_to_csv(self):
+        if self.histogram is None:
+            return
+        save_path = filedialog.asksaveasfilename(
+            defaultextension='.csv',
+            filetypes=[('CSV File', '*.csv'), ('All Files', '*.*')],
+            title='Save Thickness Histogram'
+        )
+        if save_path:
+            try:
+                units = self.parent.length_units if self.parent.scale_calibrated else None
+                write_thickness_csv(save_path, self.histogram, units)
+                messagebox.showinfo("Saved", "Thickness histogram saved successfully.")
+            except (IOError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to save thickness histogram:\n{e}")
+
+
 class HSVThresholdAdjuster(tk.Tk):
     """Main application window for interactive HSV color thresholding,
     scale calibration, and distance measurement on images."""
 
-    def __init__(self):
+    def __init__(self, image_path=None):
         super().__init__()
         self.title('HSV Threshold Adjuster')
 
@@ -254,20 +4835,96 @@ class HSVThresholdAdjuster(tk.Tk):
         # Measurement instructions flag
         self.measurement_instructions_shown = False
 
-        # List to store measurements
-        self.measurements = []
-        self.measure_lines = []
-
-        # Undo stack
-        self.undo_stack = []
+        # Measurements (in image coordinates); their canvas layer is created with the canvas
+        self.measurements = MeasurementStore()
+        self._overlay_zoom = self.zoom_level
+
+        # Undo/redo history of thresholds, calibration, clean-up, ROIs, measurements and scale bar
+        self.history = HistoryManager()
+        self._restoring_history = False
+
+        # Loaded image data (RGB and cached HSV arrays) and its source file
+        self.rgb_array = None
+        self.hsv_array = None
+        self.image_path = None
+        self.session_path = None
+        self.results_path = None
+        self.image_cache = ImageCache()
+        self.metadata_cache = MetadataCache(os.path.join(self.image_cache.directory, 'metadata.json'))
+        self._loader = None
+        self._loaded_calibration = None
+        self._on_loaded = None
+
+        # Phase classes for multi-label classification
+        self.phase_classes = []
+        self.show_classes = False
+        self._labels_cache = (None, None)
+
+        # Display mode and the cached full-resolution threshold mask
+        self.display_mode = 'mask'
+        self._mask_cache = (None, None)
+
+        # HSV histograms for threshold suggestions, computed on first use
+        self._histogram = None
+
+        # Local thickness map of the processed mask as (key, map, maximum), and its heat map toggle
+        self.thickness_radius = THICKNESS_MAX_RADIUS
+        self._thickness = (None, None, 0.0)
+        self.show_thickness = False
+
+        # Regions of interest (image coordinates), their outlines and the ROI being drawn
+        self.rois = []
+        self.roi_items = []
+        self._roi_cache = (None, None)
+        self._roi_kind = None
+        self._roi_points = []
+
+        # Morphological post-processing of the mask and its cached full-resolution result
+        self.postprocessing = PostProcessing()
+        self._processed_cache = (None, None)
+        self._coverage_job = None
+        self._render_pending = False
+
+        # Rendered display tiles; render_version changes whenever the rendered content does
+        self.tile_cache = TileCache()
+        self.render_version = 0
+        self._render_state = None
+        # Versions of recently rendered states, so returning to one (e.g. by undo) reuses its tiles
+        self._render_versions = OrderedDict()
+        self._render_counter = 0
+        self.tile_items = {}
+        self._tile_zoom = None
+        self._pending_tiles = []
+        self._tile_job = None
+
+        # Accounting of large buffers against the memory budget
+        self.buffers = BufferRegistry()
+        self.register_buffers()
+
+        # Coalesced wheel zoom: accumulated notches, cursor anchor and end of the zoom gesture
+        self._wheel_notches = 0
+        self._wheel_anchor = (0, 0)
+        self._wheel_job = None
+        self._zoom_active_until = 0.0
+
+        # Throttling state for interactive redraws
+        self._redraw_job = None
+        self._last_redraw = 0.0
+        self._lines_dirty = False
+
+        # Recorder of interaction events for replay benchmarks, while recording
+        self.recorder = None
 
         # Create GUI elements
         self.create_widgets()
 
-        # Try to load an initial image; if cancelled, show placeholder
-        self.load_image_initial()
+        # Load the given image, or ask for one; if cancelled, show placeholder
+        if image_path:
+            self.load_image(image_path, on_loaded=self.show_loaded_image)
+        else:
+            self.load_image_initial()
 
-        if hasattr(self, 'original_image'):
+        if self.rgb_array is not None:
             # Update threshold lines
             self.update_threshold_lines()
             # Update the displayed image
@@ -289,70 +4946,472 @@ class HSVThresholdAdjuster(tk.Tk):
         if not image_path:
             return
 
-        self.load_image(image_path)
+        self.load_image(image_path, on_loaded=self.show_loaded_image)
 
-    def load_image(self, image_path):
-        try:
-            # Remove placeholder text if present
-            self.image_canvas.delete("placeholder")
+    def show_loaded_image(self):
+        self.update_threshold_lines()
+        self.update_image()
 
-            # Open the image using Pillow
-            self.original_image = Image.open(image_path)
+    def load_image(self, image_path, on_loaded=None):
+        """Start loading an image on a worker thread.
 
-            # Convert image to RGB if not already
-            if self.original_image.mode != 'RGB':
-                self.original_image = self.original_image.convert('RGB')
+        A preview is shown as soon as one is decoded. `on_loaded` is called
+        once the full-resolution arrays are installed; it is not called if
+        loading fails or is cancelled, in which case the current image stays.
+        """
+        self.cancel_loading()
+        self._loader = ImageLoader(image_path, self.image_cache, metadata=self.metadata_cache)
+        self._on_loaded = on_loaded
+        self._loaded_calibration = None
+        self.load_label.config(text=f"Loading {os.path.basename(image_path)}...")
+        self.load_progress.config(mode='indeterminate', value=0)
+        self.load_progress.start()
+        self.load_frame.place(relx=0.5, rely=0.5, anchor='center')
+        self.load_frame.lift()
+        self._loader.start()
+        self.after(LOAD_POLL_MS, self.poll_loader)
+
+    def cancel_loading(self):
+        if self._loader is not None:
+            self._loader.cancel()
+            self.end_loading()
+
+    def end_loading(self):
+        self._loader = None
+        self.load_progress.stop()
+        self.load_frame.place_forget()
+        self.image_canvas.delete('preview')
+
+    def poll_loader(self):
+        """Handle the messages posted by the loader thread, then poll again."""
+        loader = self._loader
+        if loader is None:
+            return
+        try:
+            while True:
+                message = loader.messages.get_nowait()
+                kind = message[0]
+                if kind == 'calibration':
+                    self._loaded_calibration = message[1]
+                elif kind == 'preview':
+                    self.show_preview(*message[1:])
+                elif kind == 'progress':
+                    fraction, stage = message[1:]
+                    self.load_label.config(text=f"{stage}...")
+                    if fraction is None:
+                        if self.load_progress['mode'] != 'indeterminate':
+                            self.load_progress.config(mode='indeterminate')
+                            self.load_progress.start()
+                    else:
+                        self.load_progress.stop()
+                        self.load_progress.config(mode='determinate', value=100 * fraction)
+                elif kind == 'done':
+                    self.end_loading()
+                    rgb, hsv, fingerprint = message[1:]
+                    # Cache the RGB and HSV arrays; thresholds are evaluated against them on every update
+                    self.set_image_arrays(rgb, hsv, loader.path)
+                    if fingerprint is not None:
+                        self._fingerprint = (loader.path, fingerprint)
+                    if self._on_loaded is not None:
+                        self._on_loaded()
+                    # A calibration restored by the callback (e.g. from a session) takes precedence
+                    if not self.scale_calibrated and self._loaded_calibration is not None:
+                        self.apply_metadata_calibration(self._loaded_calibration)
+                    self.history.reset(self.history_state())
+                    return
+                elif kind == 'cancelled':
+                    self.end_loading()
+                    return
+                else:
+                    self.end_loading()
+                    messagebox.showerror("Error", f"Failed to load image:\n{message[1]}")
+                    return
+        except queue.Empty:
+            pass
+        self.after(LOAD_POLL_MS, self.poll_loader)
+
+    def show_preview(self, preview, full_size):
+        """Show a low-resolution preview, scaled to the size the full image will have."""
+        self.image_canvas.delete('placeholder')
+        self.image_canvas.delete('preview')
+        canvas_width = self.image_canvas.winfo_width()
+        canvas_height = self.image_canvas.winfo_height()
+        zoom = 1.0
+        if canvas_width > 1 and canvas_height > 1:
+            zoom = min(canvas_width / full_size[0], canvas_height / full_size[1], 1.0)
+        size = (max(int(full_size[0] * zoom), 1), max(int(full_size[1] * zoom), 1))
+        self.preview_tk = ImageTk.PhotoImage(preview.resize(size, Image.BILINEAR))
+        preview_id = self.image_canvas.create_image(0, 0, anchor='nw', image=self.preview_tk, tags='preview')
+        self.image_canvas.tag_lower(preview_id)
+
+    def show_image_cache(self):
+        if not hasattr(self, 'cache_dialog') or not self.cache_dialog.winfo_exists():
+            self.cache_dialog = ImageCacheDialog(self, self.image_cache)
+        else:
+            self.cache_dialog.update_stats()
+            self.cache_dialog.lift()
 
-            self.image_width, self.image_height = self.original_image.size
+    def set_image_arrays(self, rgb_array, hsv_array, image_path):
+        """Install decoded RGB and HSV arrays as the current image.
 
-            # Auto-fit zoom level to window size
-            self.update_idletasks()
-            canvas_width = self.image_canvas.winfo_width()
-            canvas_height = self.image_canvas.winfo_height()
-            if canvas_width > 1 and canvas_height > 1:
-                zoom_w = canvas_width / self.image_width
-                zoom_h = canvas_height / self.image_height
-                self.zoom_level = min(zoom_w, zoom_h, 1.0)
-        except (IOError, OSError, ValueError) as e:
-            messagebox.showerror("Error", f"Failed to load image:\n{e}")
+        The arrays may be read-only memory maps; they are never modified.
+        """
+        # Remove placeholder text and any loading preview
+        self.image_canvas.delete("placeholder")
+        self.image_canvas.delete("preview")
+
+        self.rgb_array = rgb_array
+        self.hsv_array = hsv_array
+        self.image_path = image_path
+        self.image_height, self.image_width = rgb_array.shape[:2]
+        self._labels_cache = (None, None)
+        self._mask_cache = (None, None)
+        self._processed_cache = (None, None)
+        self._histogram = None
+        self._thickness = (None, None, 0.0)
+        # Force a new render version so no tile of the previous image is reused
+        self._render_state = None
+        self._render_versions.clear()
+
+        # Auto-fit zoom level to window size
+        self.update_idletasks()
+        canvas_width = self.image_canvas.winfo_width()
+        canvas_height = self.image_canvas.winfo_height()
+        if canvas_width > 1 and canvas_height > 1:
+            zoom_w = canvas_width / self.image_width
+            zoom_h = canvas_height / self.image_height
+            self.zoom_level = min(zoom_w, zoom_h, 1.0)
 
     def enable_color_picker(self):
         self.image_canvas.bind("<Button-1>", self.pick_color)
+        self.image_canvas.bind("<Shift-Button-1>", self.extend_color_pick)
         self.image_canvas.config(cursor='cross')
 
     def pick_color(self, event):
+        """Set thresholds from the color region around the clicked pixel."""
+        samples = self.sample_colors(event)
+        if samples is not None:
+            self.picker_samples = samples
+            self.set_thresholds(*thresholds_from_samples(samples))
+        # Disable color picker after selection
+        self.image_canvas.unbind("<Button-1>")
+        self.image_canvas.unbind("<Shift-Button-1>")
+        self.image_canvas.config(cursor='')
+        # Re-enable panning
+        self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
+        self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
+
+    def extend_color_pick(self, event):
+        """Add the samples around the clicked pixel to the current pick; the picker stays active."""
+        samples = self.sample_colors(event)
+        if samples is None:
+            return
+        if getattr(self, 'picker_samples', None) is not None:
+            samples = np.concatenate([self.picker_samples, samples])
+            if len(samples) > PICKER_MAX_SAMPLES:
+                keep = np.random.default_rng(0).choice(len(samples), PICKER_MAX_SAMPLES, replace=False)
+                samples = samples[keep]
+        self.picker_samples = samples
+        self.set_thresholds(*thresholds_from_samples(samples))
+
+    def sample_colors(self, event):
+        """Return the (N, 3) HSV samples picked at an event, or None outside the image.
+
+        Only a window of PICKER_WINDOW pixels around the click is examined, so the
+        cost does not depend on the image size.
+        """
         x = self.image_canvas.canvasx(event.x)
         y = self.image_canvas.canvasy(event.y)
-        # Get the pixel color from the original image
         img_x = int(x / self.zoom_level)
         img_y = int(y / self.zoom_level)
-        if 0 <= img_x < self.image_width and 0 <= img_y < self.image_height:
-            pixel_color = self.original_image.getpixel((img_x, img_y))
-            # Convert RGB to HSV
-            hsv_color = colorsys.rgb_to_hsv(*(c / 255.0 for c in pixel_color))
-            hue = hsv_color[0] * 360
-            saturation = hsv_color[1] * 100
-            value = hsv_color[2] * 100
-            # Set thresholds based on picked color with some tolerance
-            self.hue_low = (hue - 10) % 360
-            self.hue_high = (hue + 10) % 360
-            self.sat_low = max(saturation - 20, 0)
-            self.sat_high = min(saturation + 20, 100)
-            self.val_low = max(value - 20, 0)
-            self.val_high = min(value + 20, 100)
-            # Update GUI elements
-            self.update_threshold_lines()
-            self.sat_low_scale.set(self.sat_low)
-            self.sat_high_scale.set(self.sat_high)
-            self.val_low_scale.set(self.val_low)
-            self.val_high_scale.set(self.val_high)
-            self.update_image()
-        # Disable color picker after selection
-        self.image_canvas.unbind("<Button-1>")
-        self.image_canvas.config(cursor='')
-    
+        if not (0 <= img_x < self.image_width and 0 <= img_y < self.image_height):
+            return None
+        if self.picker_mode_var.get() == 'neighbourhood':
+            radius = PICKER_NEIGHBOURHOOD
+        else:
+            radius = PICKER_WINDOW
+        x0, y0 = max(img_x - radius, 0), max(img_y - radius, 0)
+        x1, y1 = min(img_x + radius + 1, self.image_width), min(img_y + radius + 1, self.image_height)
+        window = self.hsv_array[y0:y1, x0:x1]
+        if self.picker_mode_var.get() == 'neighbourhood':
+            return window.reshape(-1, 3).copy()
+        region = grow_region(window, (img_y - y0, img_x - x0))
+        return window[region]
+
+    def thresholds(self):
+        return (self.hue_low, self.hue_high, self.sat_low, self.sat_high, self.val_low, self.val_high)
+
+    def hsv_histogram(self):
+        """Return the HSVHistogram of the loaded image, computed once per image."""
+        if self.rgb_array is None:
+            return None
+        if self._histogram is None:
+            self._histogram = HSVHistogram(self.hsv_array)
+        return self._histogram
+
+    def show_threshold_suggestions(self):
+        if self.rgb_array is None:
+            return
+        if not hasattr(self, 'suggestion_dialog') or not self.suggestion_dialog.winfo_exists():
+            self.config(cursor='watch')
+            self.update_idletasks()
+            try:
+                self.suggestion_dialog = ThresholdSuggestionDialog(self)
+            finally:
+                self.config(cursor='')
+        else:
+            self.suggestion_dialog.refresh()
+            self.suggestion_dialog.lift()
+
+    def thickness_key(self):
+        return (self.thresholds(), self.rois_key(), self.postprocessing.key(), self.thickness_radius)
+
+    def thickness_map(self):
+        """Return the local thickness map of the processed mask, or None if missing or out of date."""
+        key, thickness, _ = self._thickness
+        return thickness if thickness is not None and key == self.thickness_key() else None
+
+    def compute_thickness(self):
+        """Compute the local thickness map of the processed mask, a tile at a time.
+
+        Maps larger than a quarter of the memory budget are written to a
+        temporary memory-mapped file instead of memory.
+        """
+        self.config(cursor='watch')
+        self.update_idletasks()
+        try:
+            # Drop the previous map before allocating the new one
+            self._thickness = (None, None, 0.0)
+            shape = (self.image_height, self.image_width)
+            out = None
+            if 4 * shape[0] * shape[1] > self.buffers.budget_bytes // 4:
+                out = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shape)
+            thickness = local_thickness_tiled(self.processed_mask(), self.thickness_radius, out=out)
+            maximum = max(float(thickness[top:top + 1024].max()) for top in range(0, shape[0], 1024))
+            self._thickness = (self.thickness_key(), thickness, maximum)
+        finally:
+            self.config(cursor='')
+        self.enforce_memory_budget()
+
+    def show_local_thickness(self):
+        """Compute the local thickness map if needed, show it as a heat map and open its histogram."""
+        if self.rgb_array is None:
+            return
+        if self.thickness_map() is None:
+            length_per_pixel = self.length_per_pixel if self.scale_calibrated else None
+            units = self.length_units if length_per_pixel else 'pixels'
+            default = 2 * self.thickness_radius - 1
+            maximum = simpledialog.askfloat(
+                "Local Thickness", f"Maximum thickness to resolve ({units}):",
+                initialvalue=round(default * length_per_pixel, 6) if length_per_pixel else default,
+                minvalue=0, parent=self)
+            if not maximum:
+                return
+            pixels = maximum / length_per_pixel if length_per_pixel else maximum
+            self.thickness_radius = max((pixels + 1) / 2, 1.0)
+            try:
+                self.compute_thickness()
+            except (MemoryError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to compute local thickness:\n{e}")
+                return
+        self.show_thickness = True
+        self.update_image()
+        if not hasattr(self, 'thickness_dialog') or not self.thickness_dialog.winfo_exists():
+            self.thickness_dialog = ThicknessDialog(self)
+        else:
+            self.thickness_dialog.show_var.set(True)
+            self.thickness_dialog.refresh()
+            self.thickness_dialog.lift()
+
+    def set_thresholds(self, hue_low, hue_high, sat_low, sat_high, val_low, val_high):
+        """Set all six thresholds at once and refresh the controls and image."""
+        self.hue_low = hue_low
+        self.hue_high = hue_high
+        self.sat_low = sat_low
+        self.sat_high = sat_high
+        self.val_low = val_low
+        self.val_high = val_high
+        # Update GUI elements
+        self.update_threshold_lines()
+        for name in ('hue_low', 'hue_high', 'sat_low', 'sat_high', 'val_low', 'val_high'):
+            getattr(self, name + '_scale').set(getattr(self, name))
+        self.record_history('Thresholds', 'thresholds')
+        self.update_image()
+
+    def show_phase_classes(self):
+        if not hasattr(self, 'phase_dialog') or not self.phase_dialog.winfo_exists():
+            self.phase_dialog = PhaseClassDialog(self)
+        else:
+            self.phase_dialog.lift()
+
+    def class_key(self):
+        return tuple((phase.window(), phase.color) for phase in self.phase_classes)
+
+    def class_labels(self):
+        """Return the uint8 phase label image for the current classes, computed once per class set."""
+        key = self.class_key()
+        cached_key, labels = self._labels_cache
+        if cached_key != key or labels is None:
+            labels = classify_hsv(self.hsv_array, build_class_luts(self.phase_classes))
+            self._labels_cache = (key, labels)
+        return labels
+
+    def current_mask(self):
+        """Return the full-resolution threshold mask as a RunLengthMask, recomputed only when thresholds change.
+
+        With ROIs, only their bounding boxes are thresholded and the mask is
+        empty outside them.
+        """
+        thresholds = self.thresholds()
+        key = self.mask_key()
+        cached_key, mask = self._mask_cache
+        if cached_key != key or mask is None:
+            if self.rois:
+                mask = compute_roi_runs(self.hsv_array, self.rois, *thresholds)
+            else:
+                mask = compute_hsv_runs(self.hsv_array, *thresholds)
+            self._mask_cache = (key, mask)
+        return mask
+
+    def mask_key(self):
+        return self.thresholds() + (self.rois_key(),)
+
+    def rois_key(self):
+        return tuple(roi.key() for roi in self.rois)
+
+    def roi_mask(self):
+        """Return the union of the ROIs as a RunLengthMask, or None without ROIs."""
+        key = (self.rois_key(), self.image_width, self.image_height)
+        cached_key, mask = self._roi_cache
+        if cached_key != key:
+            mask = roi_union(self.rois, (self.image_width, self.image_height))
+            self._roi_cache = (key, mask)
+        return mask
+
+    def processed_mask(self):
+        """Return the full-resolution RunLengthMask after post-processing, for export and analysis.
+
+        Computed in strips and cached until the thresholds or parameters change.
+        """
+        if not self.postprocessing.is_active():
+            return self.current_mask()
+        mask = self.current_mask()
+        key = (self._mask_cache[0], self.postprocessing.key())
+        cached_key, processed = self._processed_cache
+        if cached_key != key or processed is None:
+            processed = self.postprocessing.apply_in_strips(mask)
+            if self.rois:
+                # Closing may grow objects across an ROI border
+                processed = processed & self.roi_mask()
+            self._processed_cache = (key, processed)
+        return processed
+
+    def update_postprocessing(self, *args):
+        """Read the post-processing controls and redraw."""
+        try:
+            self.postprocessing = PostProcessing(self.open_radius_var.get(), self.close_radius_var.get(),
+                                                 self.fill_holes_var.get(), self.min_size_var.get())
+        except (tk.TclError, ValueError):
+            # Incomplete input in a spinbox; keep the previous parameters
+            return
+        self.record_history('Clean-up', 'postprocessing', coalesce='postprocessing')
+        self.request_redraw()
+
+    def set_postprocessing(self, postprocessing):
+        self.postprocessing = postprocessing
+        self.open_radius_var.set(postprocessing.open_radius)
+        self.close_radius_var.set(postprocessing.close_radius)
+        self.fill_holes_var.set(postprocessing.fill_holes)
+        self.min_size_var.set(postprocessing.min_size)
+
+    def set_display_mode(self, mode=None):
+        """Switch the display mode; only the viewport composite is redone."""
+        self.display_mode = mode if mode is not None else self.display_mode_var.get()
+        self.display_mode_var.set(self.display_mode)
+        self.record_history('Display mode', 'display_mode')
+        self.update_image()
+
+    def class_areas(self):
+        """Return the per-class area table for the loaded image."""
+        if self.rgb_array is None or not self.phase_classes:
+            return []
+        length_per_pixel = self.length_per_pixel if self.scale_calibrated else None
+        return class_area_table(self.class_labels(), self.phase_classes, length_per_pixel)
+
+    def register_buffers(self):
+        """Register the image arrays and caches with the buffer registry.
+
+        The image arrays are required; caches are evicted in the order tiles,
+        phase labels, threshold mask, as the later ones are dearer to rebuild.
+        Caches keyed to the current render state are kept, and of the display
+        tiles only those off screen are dropped.
+        """
+        self.buffers.register('Image RGB', lambda: array_footprint(self.rgb_array))
+        self.buffers.register('Image HSV', lambda: array_footprint(self.hsv_array))
+        self.buffers.register('Display tiles', lambda: self.tile_cache.nbytes,
+                              lambda: self.tile_cache.retain({key for _, key, _ in self.tile_items.values()}),
+                              priority=0)
+        self.buffers.register('Phase labels', lambda: array_footprint(self._labels_cache[1]),
+                              lambda: setattr(self, '_labels_cache', (None, None)), priority=1,
+                              in_use=lambda: self._labels_cache[0] == self.class_key())
+        self.buffers.register('Threshold mask', lambda: array_footprint(self._mask_cache[1]),
+                              lambda: setattr(self, '_mask_cache', (None, None)), priority=2,
+                              in_use=lambda: self._mask_cache[0] == self.mask_key())
+        self.buffers.register('Processed mask', lambda: array_footprint(self._processed_cache[1]),
+                              lambda: setattr(self, '_processed_cache', (None, None)), priority=1,
+                              in_use=lambda: self._processed_cache[0] == (self.mask_key(), self.postprocessing.key()))
+        self.buffers.register('HSV histogram', lambda: array_footprint(self._histogram),
+                              lambda: setattr(self, '_histogram', None), priority=1)
+        self.buffers.register('Thickness map', lambda: array_footprint(self._thickness[1]),
+                              lambda: setattr(self, '_thickness', (None, None, 0.0)), priority=2,
+                              in_use=lambda: self.show_thickness and self._thickness[0] == self.thickness_key())
+
+    def enforce_memory_budget(self):
+        """Evict caches beyond the memory budget and update the footprint display.
+
+        When the buffers in use exceed the budget on their own, nothing more
+        is evicted and the label says so.
+        """
+        self.buffers.enforce()
+        resident, mapped = self.buffers.total()
+        text = f"Memory: {format_bytes(resident)} of {format_bytes(self.buffers.budget_bytes)}"
+        if mapped:
+            text += f" (+{format_bytes(mapped)} mapped)"
+        if self.buffers.over_budget:
+            text += " - over budget"
+        self.memory_label.config(text=text, fg='red' if resident > self.buffers.budget_bytes else 'black')
+
+    def toggle_recording(self):
+        """Start recording interactions, or stop and save the recording as a replay script."""
+        if self.recording_var.get():
+            self.recorder = InteractionRecorder(self)
+            return
+        recorder, self.recorder = self.recorder, None
+        if recorder is None or not recorder.events:
+            return
+        save_path = filedialog.asksaveasfilename(
+            defaultextension='.json',
+            filetypes=[('Interaction Script', '*.json'), ('All Files', '*.*')],
+            title='Save Interaction Recording'
+        )
+        if save_path:
+            try:
+                recorder.save(save_path)
+            except (IOError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to save recording:\n{e}")
+
+    def show_memory_usage(self):
+        if not hasattr(self, 'memory_dialog') or not self.memory_dialog.winfo_exists():
+            self.memory_dialog = MemoryDialog(self, self.buffers)
+        else:
+            self.memory_dialog.refresh()
+            self.memory_dialog.lift()
 
     def create_widgets(self):
+        self.display_mode_var = tk.StringVar(value=self.display_mode)
+        self.picker_mode_var = tk.StringVar(value='region')
+        self.recording_var = tk.BooleanVar(value=False)
+
         # Create menu bar
         self.create_menu()
 
@@ -398,6 +5457,10 @@ class HSVThresholdAdjuster(tk.Tk):
         self.lower_line = self.wheel_canvas.create_line(0, 0, 0, 0, fill='white', width=2)
         self.upper_line = self.wheel_canvas.create_line(0, 0, 0, 0, fill='white', width=2)
 
+        # Shaded sector between the lines; its coordinates are updated in place while dragging
+        self.wheel_table = unit_circle_table()
+        self.sector = self.wheel_canvas.create_polygon(0, 0, 0, 0, 0, 0, fill='gray', stipple='gray50', outline='')
+
         # Create a frame for the hue bar
         self.hue_bar_frame = tk.Frame(self.controls_frame)
         self.hue_bar_frame.pack(pady=10)
@@ -413,6 +5476,11 @@ class HSVThresholdAdjuster(tk.Tk):
         self.hue_bar_canvas.pack()
         self.hue_bar_canvas.create_image(0, 0, anchor='nw', image=self.hue_bar_tk)
         self.hue_bar_selection = self.hue_bar_canvas.create_rectangle(0, 0, 0, 50, fill='gray', stipple='gray50', outline='')
+        # Two rectangles for a selection that wraps around 0°; hidden until needed
+        self.hue_bar_selection1 = self.hue_bar_canvas.create_rectangle(0, 0, 0, 50, fill='gray', stipple='gray50',
+                                                                       outline='', state='hidden')
+        self.hue_bar_selection2 = self.hue_bar_canvas.create_rectangle(0, 0, 0, 50, fill='gray', stipple='gray50',
+                                                                       outline='', state='hidden')
         
         # Keep a reference to the image to prevent garbage collection
         self.hue_bar_canvas.image = self.hue_bar_tk
@@ -467,6 +5535,8 @@ class HSVThresholdAdjuster(tk.Tk):
 
         undo_button = tk.Button(self.buttons_frame, text='Undo', command=self.undo_action)
         undo_button.pack(fill='x', pady=2)
+        redo_button = tk.Button(self.buttons_frame, text='Redo', command=self.redo_action)
+        redo_button.pack(fill='x', pady=2)
 
         zoom_in_button = tk.Button(self.buttons_frame, text='Zoom In', command=self.zoom_in)
         zoom_in_button.pack(fill='x', pady=2)
@@ -481,6 +5551,47 @@ class HSVThresholdAdjuster(tk.Tk):
         color_picker_button = tk.Button(self.buttons_frame, text='Pick Color', command=self.enable_color_picker)
         color_picker_button.pack(fill='x', pady=2)
 
+        phase_button = tk.Button(self.buttons_frame, text='Phase Classes', command=self.show_phase_classes)
+        phase_button.pack(fill='x', pady=2)
+
+        # Display mode selection
+        self.display_frame = tk.Frame(self.controls_frame)
+        self.display_frame.pack(pady=5)
+        tk.Label(self.display_frame, text="Display:").pack()
+        for mode, label in DISPLAY_MODES:
+            tk.Radiobutton(self.display_frame, text=label, value=mode, variable=self.display_mode_var,
+                           command=self.set_display_mode).pack(anchor='w')
+
+        # Morphological post-processing of the mask
+        self.open_radius_var = tk.IntVar(value=0)
+        self.close_radius_var = tk.IntVar(value=0)
+        self.fill_holes_var = tk.BooleanVar(value=False)
+        self.min_size_var = tk.IntVar(value=0)
+        self.postprocess_frame = tk.Frame(self.controls_frame)
+        self.postprocess_frame.pack(pady=5)
+        tk.Label(self.postprocess_frame, text="Clean-up:").grid(row=0, column=0, columnspan=2)
+        for row, (label, variable, limit) in enumerate((("Opening radius", self.open_radius_var, 20),
+                                                       ("Closing radius", self.close_radius_var, 20),
+                                                       ("Min. size (px)", self.min_size_var, 10 ** 7)), start=1):
+            tk.Label(self.postprocess_frame, text=label).grid(row=row, column=0, sticky='w')
+            tk.Spinbox(self.postprocess_frame, from_=0, to=limit, width=8,
+                       textvariable=variable).grid(row=row, column=1)
+            # Fires for the arrows and for typed values alike
+            variable.trace_add('write', self.update_postprocessing)
+        tk.Checkbutton(self.postprocess_frame, text="Fill holes", variable=self.fill_holes_var,
+                       command=self.update_postprocessing).grid(row=4, column=0, columnspan=2, sticky='w')
+
+        # Source of an automatic scale calibration
+        self.calibration_label = tk.Label(self.controls_frame, anchor='w', justify='left')
+        self.calibration_label.pack(pady=5, fill='x')
+
+        # Coverage of the current selection
+        self.coverage_label = tk.Label(self.controls_frame, anchor='w', justify='left')
+        self.coverage_label.pack(pady=5, fill='x')
+
+        # Current memory footprint of image buffers and caches
+        self.memory_label = tk.Label(self.controls_frame, anchor='w')
+        self.memory_label.pack(pady=5, fill='x')
 
         # Create a frame for the image and scrollbars
         self.image_frame = tk.Frame(self)
@@ -489,14 +5600,23 @@ class HSVThresholdAdjuster(tk.Tk):
         # Create a canvas for the image
         self.image_canvas = tk.Canvas(self.image_frame, bg='black')
         self.image_canvas.pack(side='left', fill='both', expand=True)
+        self.measurement_layer = MeasurementLayer(self.image_canvas, self.measurements)
+
+        # Progress indicator shown over the canvas while an image loads in the background
+        self.load_frame = tk.Frame(self.image_frame, relief='raised', borderwidth=1)
+        self.load_label = tk.Label(self.load_frame, width=30)
+        self.load_label.pack(padx=10, pady=(10, 0))
+        self.load_progress = ttk.Progressbar(self.load_frame, length=240, maximum=100)
+        self.load_progress.pack(padx=10, pady=5)
+        tk.Button(self.load_frame, text='Cancel', command=self.cancel_loading).pack(pady=(0, 10))
 
         # Create vertical scrollbar
-        self.v_scroll = tk.Scrollbar(self.image_frame, orient='vertical', command=self.image_canvas.yview)
+        self.v_scroll = tk.Scrollbar(self.image_frame, orient='vertical', command=self.on_yscroll)
         self.v_scroll.pack(side='right', fill='y')
         self.image_canvas.config(yscrollcommand=self.v_scroll.set)
 
         # Create horizontal scrollbar
-        self.h_scroll = tk.Scrollbar(self, orient='horizontal', command=self.image_canvas.xview)
+        self.h_scroll = tk.Scrollbar(self, orient='horizontal', command=self.on_xscroll)
         self.h_scroll.pack(side='bottom', fill='x')
         self.image_canvas.config(xscrollcommand=self.h_scroll.set)
 
@@ -512,11 +5632,42 @@ class HSVThresholdAdjuster(tk.Tk):
 
         self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
         self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
+        # Only the visible part of the image is rendered, so re-render when the viewport changes
+        self.image_canvas.bind('<Configure>', lambda e: self.schedule_render())
 
+    @recorded
     def update_hue(self, val):
-        self.hue_low = min(self.hue_low_scale.get(), self.hue_high_scale.get())
-        self.hue_high = max(self.hue_low_scale.get(), self.hue_high_scale.get())
-        self.update_threshold_lines()
+        low, high = self.hue_low_scale.get(), self.hue_high_scale.get()
+        if (low, high) == (round(self.hue_low), round(self.hue_high)):
+            # Echo of set_thresholds(), the color wheel or an undo; keep the exact (possibly wrapped) hue window
+            return
+        self.hue_low = min(low, high)
+        self.hue_high = max(low, high)
+        self.record_history('Thresholds', 'thresholds', coalesce='thresholds')
+        self.request_redraw(threshold_lines=True)
+
+    def request_redraw(self, threshold_lines=False):
+        """Redraw after an interactive change, at most once per REDRAW_INTERVAL_MS.
+
+        Bursts of slider and wheel events are coalesced: the first event redraws
+        immediately, later ones within the interval are folded into one redraw
+        at the end of it.
+        """
+        self._lines_dirty = self._lines_dirty or threshold_lines
+        if self._redraw_job is not None:
+            return
+        elapsed_ms = (time.perf_counter() - self._last_redraw) * 1000
+        if elapsed_ms >= REDRAW_INTERVAL_MS:
+            self._run_redraw()
+        else:
+            self._redraw_job = self.after(int(REDRAW_INTERVAL_MS - elapsed_ms) + 1, self._run_redraw)
+
+    def _run_redraw(self):
+        self._redraw_job = None
+        self._last_redraw = time.perf_counter()
+        if self._lines_dirty:
+            self._lines_dirty = False
+            self.update_threshold_lines()
         self.update_image()
 
     def create_menu(self):
@@ -526,10 +5677,65 @@ class HSVThresholdAdjuster(tk.Tk):
         file_menu = tk.Menu(menu_bar, tearoff=0)
         file_menu.add_command(label='Load New Image', command=self.load_new_image)
         file_menu.add_command(label='Save Image', command=self.save_image)
+        file_menu.add_command(label='Export Pyramid...', command=self.export_pyramid)
+        file_menu.add_separator()
+        file_menu.add_command(label='Open Session...', command=self.open_session)
+        file_menu.add_command(label='Save Session...', command=self.save_session)
+        file_menu.add_separator()
+        file_menu.add_command(label='Image Cache...', command=self.show_image_cache)
         file_menu.add_separator()
         file_menu.add_command(label='Exit', command=self.quit)
         menu_bar.add_cascade(label='File', menu=file_menu)
 
+        # Edit menu
+        edit_menu = tk.Menu(menu_bar, tearoff=0)
+        edit_menu.add_command(label='Undo', accelerator='Ctrl+Z', command=self.undo_action)
+        edit_menu.add_command(label='Redo', accelerator='Ctrl+Y', command=self.redo_action)
+        edit_menu.add_separator()
+        edit_menu.add_command(label='History...', command=self.show_history)
+        menu_bar.add_cascade(label='Edit', menu=edit_menu)
+        self.bind('<Control-z>', lambda e: self.undo_action())
+        self.bind('<Control-y>', lambda e: self.redo_action())
+        self.bind('<Control-Z>', lambda e: self.redo_action())
+
+        # View menu
+        view_menu = tk.Menu(menu_bar, tearoff=0)
+        for mode, label in DISPLAY_MODES:
+            view_menu.add_radiobutton(label=label, value=mode, variable=self.display_mode_var,
+                                      command=self.set_display_mode)
+        view_menu.add_separator()
+        view_menu.add_command(label='Memory Usage...', command=self.show_memory_usage)
+        view_menu.add_checkbutton(label='Record Interactions', variable=self.recording_var,
+                                  command=self.toggle_recording)
+        menu_bar.add_cascade(label='View', menu=view_menu)
+
+        # Analysis menu
+        analysis_menu = tk.Menu(menu_bar, tearoff=0)
+        analysis_menu.add_command(label='Phase Classes...', command=self.show_phase_classes)
+        analysis_menu.add_command(label='Suggest Thresholds...', command=self.show_threshold_suggestions)
+        analysis_menu.add_command(label='Measure Features...', command=self.auto_measure_features)
+        analysis_menu.add_command(label='Local Thickness...', command=self.show_local_thickness)
+        analysis_menu.add_command(label='Record Results...', command=self.record_results)
+        analysis_menu.add_separator()
+        analysis_menu.add_radiobutton(label='Picker: Grow Similar Region', value='region',
+                                      variable=self.picker_mode_var)
+        analysis_menu.add_radiobutton(label='Picker: Sample Neighbourhood', value='neighbourhood',
+                                      variable=self.picker_mode_var)
+        menu_bar.add_cascade(label='Analysis', menu=analysis_menu)
+
+        # ROI menu
+        roi_menu = tk.Menu(menu_bar, tearoff=0)
+        roi_menu.add_command(label='Draw Rectangle', command=lambda: self.start_roi('rectangle'))
+        roi_menu.add_command(label='Draw Polygon', command=lambda: self.start_roi('polygon'))
+        roi_menu.add_command(label='Draw Freehand', command=lambda: self.start_roi('freehand'))
+        roi_menu.add_separator()
+        roi_menu.add_command(label='Load ROIs...', command=self.load_rois)
+        roi_menu.add_command(label='Save ROIs...', command=self.save_rois)
+        roi_menu.add_command(label='Export ROI Statistics...', command=self.export_roi_statistics)
+        roi_menu.add_separator()
+        roi_menu.add_command(label='Clear ROIs', command=self.clear_rois)
+        menu_bar.add_cascade(label='ROI', menu=roi_menu)
+
         # Help menu
         help_menu = tk.Menu(menu_bar, tearoff=0)
         help_menu.add_command(label='Instructions', command=self.show_instructions)
@@ -548,7 +5754,7 @@ class HSVThresholdAdjuster(tk.Tk):
             "5. Add a scale bar to the image if desired.\n"
             "6. Use the Measure tool to measure distances on the image.\n"
             "7. Save the processed image using the Save Image option.\n"
-            "8. Use Undo to revert the last action.\n"
+            "8. Use Undo (Ctrl+Z) and Redo (Ctrl+Y) to step through your changes, or Edit > History to jump to any of them.\n"
             "\n"
             "Controls:\n"
             "- Left-click and drag to pan the image.\n"
@@ -566,15 +5772,27 @@ class HSVThresholdAdjuster(tk.Tk):
         )
         messagebox.showinfo("About", about_text)
 
+    @recorded
     def update_saturation(self, val):
-        self.sat_low = min(self.sat_low_scale.get(), self.sat_high_scale.get())
-        self.sat_high = max(self.sat_low_scale.get(), self.sat_high_scale.get())
-        self.update_image()
+        low = min(self.sat_low_scale.get(), self.sat_high_scale.get())
+        high = max(self.sat_low_scale.get(), self.sat_high_scale.get())
+        if (low, high) == (round(self.sat_low), round(self.sat_high)):
+            # Echo of set_thresholds() or an undo; keep the exact thresholds
+            return
+        self.sat_low, self.sat_high = low, high
+        self.record_history('Thresholds', 'thresholds', coalesce='thresholds')
+        self.request_redraw()
 
+    @recorded
     def update_value(self, val):
-        self.val_low = min(self.val_low_scale.get(), self.val_high_scale.get())
-        self.val_high = max(self.val_low_scale.get(), self.val_high_scale.get())
-        self.update_image()
+        low = min(self.val_low_scale.get(), self.val_high_scale.get())
+        high = max(self.val_low_scale.get(), self.val_high_scale.get())
+        if (low, high) == (round(self.val_low), round(self.val_high)):
+            # Echo of set_thresholds() or an undo; keep the exact thresholds
+            return
+        self.val_low, self.val_high = low, high
+        self.record_history('Thresholds', 'thresholds', coalesce='thresholds')
+        self.request_redraw()
 
     def calibrate_scale(self):
         # Ask the user if they want to calibrate the scale
@@ -646,38 +5864,53 @@ class HSVThresholdAdjuster(tk.Tk):
             messagebox.showerror("Calibration Error", "Calibration line length cannot be zero.")
             self.image_canvas.delete(self.calibration_line)
             self.scale_calibrated = False
+            self.record_history('Calibration', 'calibration')
             return
         dialog = CalibrationDialog(self)
         self.wait_window(dialog)
         if dialog.length is None or dialog.units is None:
             self.image_canvas.delete(self.calibration_line)
             self.scale_calibrated = False
+            self.record_history('Calibration', 'calibration')
             return
         try:
             self.length_per_pixel = dialog.length / pixel_distance
             self.length_units = dialog.units
             self.scale_calibrated = True
+            self.calibration_label.config(text='')
             messagebox.showinfo("Calibration Complete", f"Scale calibrated: {self.length_per_pixel:.4f} {self.length_units} per pixel.")
-            self.undo_stack.append(('calibration_line', self.calibration_line))
         except (ValueError, ZeroDivisionError) as e:
             messagebox.showerror("Calibration Error", f"Error during calibration:\n{e}")
             self.scale_calibrated = False
         self.image_canvas.delete(self.calibration_line)
+        self.record_history('Calibration', 'calibration')
 
     def enter_pixel_size(self):
         dialog = CalibrationDialog(self)
         self.wait_window(dialog)
         if dialog.length is None or dialog.units is None:
             self.scale_calibrated = False
+            self.record_history('Calibration', 'calibration')
             return
         try:
             self.length_per_pixel = dialog.length
             self.length_units = dialog.units
             self.scale_calibrated = True
+            self.calibration_label.config(text='')
             messagebox.showinfo("Calibration Complete", f"Scale calibrated: {self.length_per_pixel:.4f} {self.length_units} per pixel.")
         except (ValueError, ZeroDivisionError) as e:
             messagebox.showerror("Calibration Error", f"Error during calibration:\n{e}")
             self.scale_calibrated = False
+        self.record_history('Calibration', 'calibration')
+
+    def apply_metadata_calibration(self, calibration):
+        """Calibrate the scale from the pixel size read from the image header."""
+        self.length_per_pixel = calibration['length_per_pixel']
+        self.length_units = calibration['units']
+        self.scale_calibrated = True
+        self.calibration_label.config(text=f"Scale from {calibration['source']} metadata:\n"
+                                           f"{self.length_per_pixel:.4g} {self.length_units} per pixel")
+        self.schedule_coverage_update()
 
     def add_scale_bar(self):
         if not self.scale_calibrated:
@@ -695,20 +5928,29 @@ class HSVThresholdAdjuster(tk.Tk):
             y0 = self.image_height * self.zoom_level - 50
             x1 = x0 + pixel_length
             # Draw the scale bar
-            if hasattr(self, 'scale_bar'):
-                self.image_canvas.delete(self.scale_bar)
-                self.image_canvas.delete(self.scale_bar_text)
-            self.scale_bar = self.image_canvas.create_line(x0, y0, x1, y0, fill='white', width=5, tags='scale_bar')
-            self.scale_bar_text = self.image_canvas.create_text((x0 + x1)/2, y0 - 10, text=f"{desired_length} {self.length_units}", fill='white', font=('Arial', 12), tags='scale_bar')
-            # Enable dragging
-            self.image_canvas.tag_bind('scale_bar', '<ButtonPress-1>', self.on_scale_bar_press)
-            self.image_canvas.tag_bind('scale_bar', '<B1-Motion>', self.on_scale_bar_move)
-            self.image_canvas.tag_bind('scale_bar', '<ButtonRelease-1>', self.on_scale_bar_release)
-            
-            self.undo_stack.append(('scale_bar', (self.scale_bar, self.scale_bar_text)))
+            self.create_scale_bar(x0, y0, x1, desired_length)
+            self.record_history('Scale bar', 'scale_bar')
         except (ValueError, ZeroDivisionError) as e:
             messagebox.showerror("Error", f"Failed to add scale bar:\n{e}")
 
+    def create_scale_bar(self, x0, y0, x1, desired_length):
+        """Draw the draggable scale bar at canvas coordinates, replacing any existing one."""
+        self.remove_scale_bar()
+        self.scale_bar_length = desired_length
+        self.scale_bar = self.image_canvas.create_line(x0, y0, x1, y0, fill='white', width=5, tags='scale_bar')
+        self.scale_bar_text = self.image_canvas.create_text((x0 + x1)/2, y0 - 10, text=f"{desired_length} {self.length_units}", fill='white', font=('Arial', 12), tags='scale_bar')
+        # Enable dragging
+        self.image_canvas.tag_bind('scale_bar', '<ButtonPress-1>', self.on_scale_bar_press)
+        self.image_canvas.tag_bind('scale_bar', '<B1-Motion>', self.on_scale_bar_move)
+        self.image_canvas.tag_bind('scale_bar', '<ButtonRelease-1>', self.on_scale_bar_release)
+
+    def remove_scale_bar(self):
+        if hasattr(self, 'scale_bar'):
+            self.image_canvas.delete(self.scale_bar)
+            self.image_canvas.delete(self.scale_bar_text)
+            del self.scale_bar
+            del self.scale_bar_text
+
     def on_scale_bar_press(self, event):
         # Disable panning during scale bar movement
         self.image_canvas.unbind('<ButtonPress-1>')
@@ -729,6 +5971,14 @@ class HSVThresholdAdjuster(tk.Tk):
         # Re-enable panning after moving the scale bar
         self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
         self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
+        self.record_history('Move scale bar', 'scale_bar')
+
+    def scale_bar_state(self):
+        """Return the scale bar as (x0, y0, x1, length) in image coordinates, or None."""
+        if not hasattr(self, 'scale_bar'):
+            return None
+        x0, y0, x1, _ = (c / self.zoom_level for c in self.image_canvas.coords(self.scale_bar))
+        return (x0, y0, x1, self.scale_bar_length)
 
     def start_measurement(self):
         if not self.scale_calibrated:
@@ -753,6 +6003,7 @@ class HSVThresholdAdjuster(tk.Tk):
             # Update the measurements in the dialog
             self.measurement_dialog.update_measurements(self.measurements)
 
+    @recorded
     def start_measure_line(self, event):
         # Start line drawing
         self.measure_line_start = (self.image_canvas.canvasx(event.x), self.image_canvas.canvasy(event.y))
@@ -763,35 +6014,108 @@ class HSVThresholdAdjuster(tk.Tk):
         self.image_canvas.bind("<Motion>", self.draw_measure_line)
 
 
+    @recorded
     def draw_measure_line(self, event):
         x, y = self.image_canvas.canvasx(event.x), self.image_canvas.canvasy(event.y)
         self.image_canvas.coords(self.current_measure_line, self.measure_line_start[0], self.measure_line_start[1], x, y)
 
+    @recorded
     def end_measure_line(self, event):
         self.image_canvas.unbind("<Motion>")
         x_end, y_end = self.image_canvas.canvasx(event.x), self.image_canvas.canvasy(event.y)
-        pixel_distance = ((x_end - self.measure_line_start[0])**2 + (y_end - self.measure_line_start[1])**2)**0.5 / self.zoom_level
+        # Store the end points in image coordinates so the measurement survives zooming
+        x0 = self.measure_line_start[0] / self.zoom_level
+        y0 = self.measure_line_start[1] / self.zoom_level
+        x1 = x_end / self.zoom_level
+        y1 = y_end / self.zoom_level
+        pixel_distance = ((x1 - x0)**2 + (y1 - y0)**2)**0.5
         actual_length = pixel_distance * self.length_per_pixel
-        self.measurements.append(actual_length)
-        self.measure_lines.append(self.current_measure_line)
-        # Display the length near the line
-        mid_x = (self.measure_line_start[0] + x_end) / 2
-        mid_y = (self.measure_line_start[1] + y_end) / 2
-        text = f"{actual_length:.2f} {self.length_units}"
-        text_id = self.image_canvas.create_text(
-            mid_x, mid_y - 10, text=text, fill='yellow', font=('Arial', 12), tags='measurement')
-        self.measure_lines.append(text_id)
+        self.measurements.append(x0, y0, x1, y1, actual_length)
+        # The measurement layer draws the stored line and its length in place of the drawn one
+        self.image_canvas.delete(self.current_measure_line)
+        self.refresh_overlays()
         # Update the measurement dialog
         if hasattr(self, 'measurement_dialog') and self.measurement_dialog.winfo_exists():
             self.measurement_dialog.update_measurements(self.measurements)
         else:
             self.measurement_dialog = MeasurementDialog(self, self.measurements)
-        # Undo stack
-        self.undo_stack.append(('measurement', (self.current_measure_line, text_id)))
+        self.record_history('Measurement', 'measurements')
         # Re-bind events for next measurement
         self.image_canvas.bind("<ButtonPress-1>", self.start_measure_line)
         self.image_canvas.bind("<ButtonRelease-1>", self.end_measure_line)
 
+    def auto_measure_features(self):
+        """Measure every object of the current mask and add the results as measurements."""
+        if self.rgb_array is None:
+            return
+        if not self.scale_calibrated:
+            messagebox.showwarning("Scale Not Calibrated", "Please calibrate the scale first.")
+            return
+        min_area = simpledialog.askinteger("Measure Features", "Minimum object area (pixels):",
+                                           initialvalue=20, minvalue=1)
+        if min_area is None:
+            return
+        self.config(cursor='watch')
+        self.update_idletasks()
+        mask = self.processed_mask()
+        image_size = (self.image_width, self.image_height)
+        # Objects are measured per ROI, and labelled with the ROI name
+        regions = ([(roi.name or f"ROI {i + 1}", mask & roi.runs(image_size)) for i, roi in enumerate(self.rois)]
+                   if self.rois else [(None, mask)])
+        try:
+            results = [(name, measure_features(region, self.length_per_pixel, min_area)) for name, region in regions]
+        finally:
+            self.config(cursor='')
+        count = 0
+        for name, features in results:
+            prefix = f"{name} " if name else ''
+            for i in range(len(features['label'])):
+                self.measurements.append(
+                    features['feret_x0'][i], features['feret_y0'][i], features['feret_x1'][i],
+                    features['feret_y1'][i], features['feret_max'][i],
+                    label=f"{prefix}Object {features['label'][i]} (Feret max)",
+                    feret_min=features['feret_min'][i], skeleton_length=features['skeleton_length'][i],
+                    area=features['area'][i])
+                count += 1
+        self.refresh_overlays()
+        self.record_history('Measure features', 'measurements')
+        if hasattr(self, 'measurement_dialog') and self.measurement_dialog.winfo_exists():
+            self.measurement_dialog.update_measurements(self.measurements)
+        else:
+            self.measurement_dialog = MeasurementDialog(self, self.measurements)
+        messagebox.showinfo("Measure Features", f"Measured {count} objects.")
+
+    def record_results(self):
+        """Add the results for the current image to a results database."""
+        if self.rgb_array is None:
+            return
+        path = filedialog.asksaveasfilename(
+            defaultextension='.sqlite', initialfile=os.path.basename(self.results_path or 'results.sqlite'),
+            filetypes=[('Results Database', '*.sqlite'), ('All Files', '*.*')],
+            title='Record Results', confirmoverwrite=False)
+        if not path:
+            return
+        calibrated = self.scale_calibrated
+        mask = self.processed_mask()
+        length_per_pixel = self.length_per_pixel if calibrated else None
+        record = results_record(
+            self.image_path, self.thresholds(), mask, length_per_pixel,
+            self.length_units if calibrated else None, phases=self.class_areas(),
+            measurements=[self.measurements.row(i) for i in range(len(self.measurements))],
+            preset=os.path.basename(self.session_path) if self.session_path else '',
+            rois=roi_statistics(mask, self.rois, length_per_pixel))
+        try:
+            database = ResultsDatabase(path)
+            try:
+                database.add_results([record])
+            finally:
+                database.close()
+        except (sqlite3.Error, ValueError) as e:
+            messagebox.showerror("Error", f"Failed to record results:\n{e}")
+            return
+        self.results_path = path
+        messagebox.showinfo("Record Results", f"Results recorded in {os.path.basename(path)}.")
+
     def finish_measurement(self, event):
         self.image_canvas.unbind("<ButtonPress-1>")
         self.image_canvas.unbind("<ButtonRelease-1>")
@@ -801,9 +6125,144 @@ class HSVThresholdAdjuster(tk.Tk):
         self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
         self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
 
+    def roi_canvas_coords(self, points):
+        """Flatten image-coordinate points into canvas coordinates at the current zoom."""
+        return [c * self.zoom_level for point in points for c in point]
+
+    def start_roi(self, kind):
+        """Let the user draw an ROI of the given kind on the image."""
+        if self.rgb_array is None:
+            return
+        self._roi_kind = kind
+        self._roi_points = []
+        self.image_canvas.unbind('<ButtonPress-1>')
+        self.image_canvas.unbind('<B1-Motion>')
+        self.image_canvas.bind('<ButtonPress-1>', self.roi_press)
+        if kind == 'polygon':
+            # Click to add vertices, right-click to close the polygon
+            self.image_canvas.bind('<Button-3>', lambda event: self.finish_roi())
+        else:
+            self.image_canvas.bind('<B1-Motion>', self.roi_drag)
+            self.image_canvas.bind('<ButtonRelease-1>', lambda event: self.finish_roi())
+        self.image_canvas.config(cursor='crosshair')
+
+    def roi_point(self, event):
+        zoom = self.zoom_level
+        return self.image_canvas.canvasx(event.x) / zoom, self.image_canvas.canvasy(event.y) / zoom
+
+    def roi_press(self, event):
+        point = self.roi_point(event)
+        if self._roi_kind == 'polygon':
+            self._roi_points.append(point)
+        else:
+            self._roi_points = [point, point] if self._roi_kind == 'rectangle' else [point]
+        self.draw_roi_draft()
+
+    def roi_drag(self, event):
+        point = self.roi_point(event)
+        if self._roi_kind == 'rectangle':
+            self._roi_points[1] = point
+        elif not self._roi_points or math.dist(point, self._roi_points[-1]) * self.zoom_level >= 2:
+            # Skip freehand samples closer than two screen pixels
+            self._roi_points.append(point)
+        self.draw_roi_draft()
+
+    def draw_roi_draft(self):
+        self.image_canvas.delete('roi_draft')
+        points = self._roi_points
+        if self._roi_kind == 'rectangle':
+            points = ROI('rectangle', points).outline() + points[:1]
+        if len(points) > 1:
+            self.image_canvas.create_line(*self.roi_canvas_coords(points), fill=ROI_COLOR, width=2,
+                                          dash=(4, 2), tags='roi_draft')
+        else:
+            x, y = self.roi_canvas_coords(points)
+            self.image_canvas.create_oval(x - 2, y - 2, x + 2, y + 2, outline=ROI_COLOR, tags='roi_draft')
+
+    def finish_roi(self):
+        """Add the ROI being drawn and return to panning."""
+        self.image_canvas.delete('roi_draft')
+        for sequence in ('<ButtonPress-1>', '<B1-Motion>', '<ButtonRelease-1>', '<Button-3>'):
+            self.image_canvas.unbind(sequence)
+        self.image_canvas.config(cursor='')
+        self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
+        self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
+        try:
+            roi = ROI(self._roi_kind, self._roi_points, name=f"ROI {len(self.rois) + 1}")
+        except ValueError:
+            return
+        finally:
+            self._roi_kind = None
+            self._roi_points = []
+        x0, y0, x1, y1 = roi.bbox((self.image_width, self.image_height))
+        if x1 > x0 and y1 > y0:
+            self.add_roi(roi)
+            self.record_history('ROI', 'rois')
+
+    def add_roi(self, roi):
+        self.rois.append(roi)
+        self.roi_items.append(self.image_canvas.create_polygon(
+            *self.roi_canvas_coords(roi.outline()), outline=ROI_COLOR, fill='', width=2, tags='roi'))
+        self.update_image()
+
+    def set_rois(self, rois):
+        """Replace all ROIs; the caller redraws the image."""
+        self.image_canvas.delete('roi')
+        self.rois = []
+        self.roi_items = []
+        for roi in rois:
+            self.rois.append(roi)
+            self.roi_items.append(self.image_canvas.create_polygon(
+                *self.roi_canvas_coords(roi.outline()), outline=ROI_COLOR, fill='', width=2, tags='roi'))
+
+    def clear_rois(self):
+        self.set_rois([])
+        self.record_history('Clear ROIs', 'rois')
+        self.update_image()
+
+    def load_rois(self):
+        if self.rgb_array is None:
+            return
+        path = filedialog.askopenfilename(title='Load ROIs', filetypes=[('ROI Files', '*.json'), ('All Files', '*.*')])
+        if path:
+            try:
+                self.set_rois(read_roi_file(path))
+                self.record_history('Load ROIs', 'rois')
+                self.update_image()
+            except (OSError, ValueError, KeyError) as e:
+                messagebox.showerror("Error", f"Failed to load ROIs:\n{e}")
+
+    def save_rois(self):
+        if not self.rois:
+            messagebox.showwarning("Save ROIs", "There are no ROIs to save.")
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.json', title='Save ROIs',
+                                            filetypes=[('ROI Files', '*.json'), ('All Files', '*.*')])
+        if path:
+            try:
+                write_roi_file(path, self.rois)
+            except (IOError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to save ROIs:\n{e}")
+
+    def export_roi_statistics(self):
+        """Save the selected area inside each ROI as CSV."""
+        if self.rgb_array is None or not self.rois:
+            messagebox.showwarning("ROI Statistics", "Please draw or load ROIs first.")
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.csv', title='Export ROI Statistics',
+                                            filetypes=[('CSV Files', '*.csv'), ('All Files', '*.*')])
+        if path:
+            length_per_pixel = self.length_per_pixel if self.scale_calibrated else None
+            try:
+                write_roi_statistics_csv(path, roi_statistics(self.processed_mask(), self.rois, length_per_pixel),
+                                         self.length_units if self.scale_calibrated else None)
+                messagebox.showinfo("Saved", "ROI statistics saved successfully.")
+            except (IOError, OSError) as e:
+                messagebox.showerror("Error", f"Failed to save ROI statistics:\n{e}")
+
     def load_new_image(self):
         # Only ask for confirmation if an image is already loaded
-        if hasattr(self, 'original_image'):
+        if self.rgb_array is not None:
             result = messagebox.askyesno("Load New Image", "Do you want to close the current image and load a new one?")
             if not result:
                 return
@@ -814,56 +6273,191 @@ class HSVThresholdAdjuster(tk.Tk):
                 filetypes=[('Image Files', '*.tif;*.tiff;*.png;*.jpg;*.jpeg;*.bmp')]
             )
             if image_path:
-                try:
-                    # Load the new image
-                    self.load_image(image_path)
-                    # Reset zoom level
-                    self.zoom_level = 1.0
-                    # Clear measurements and scale bar
-                    if hasattr(self, 'scale_bar'):
-                        self.image_canvas.delete(self.scale_bar)
-                        self.image_canvas.delete(self.scale_bar_text)
-                        del self.scale_bar
-                        del self.scale_bar_text
-                    # Delete measurement lines and texts from the canvas
-                    for item in self.measure_lines:
-                        self.image_canvas.delete(item)
-                    self.measure_lines.clear()
-                    self.measurements.clear()
-                    # Reset scale calibration
-                    self.scale_calibrated = False
-                    # Clear undo stack
-                    self.undo_stack.clear()
-                    # Reset HSV thresholds to default values
-                    self.hue_low = 0
-                    self.hue_high = 360
-                    self.sat_low = 0
-                    self.sat_high = 100
-                    self.val_low = 0
-                    self.val_high = 100
-                    # Update GUI elements if necessary
-                    self.sat_low_scale.set(self.sat_low)
-                    self.sat_high_scale.set(self.sat_high)
-                    self.val_low_scale.set(self.val_low)
-                    self.val_high_scale.set(self.val_high)
-                    # Update the image canvas
-                    self.update_image()
-                    # Update the threshold lines
-                    self.update_threshold_lines()
-                    # Update the scroll region
-                    self.image_canvas.config(scrollregion=(0, 0, self.image_width * self.zoom_level, self.image_height * self.zoom_level))
-                    # Close measurement dialog if open
-                    if hasattr(self, 'measurement_dialog') and self.measurement_dialog.winfo_exists():
-                        self.measurement_dialog.destroy()
-                    # Reset event bindings if necessary
-                    self.image_canvas.unbind("<ButtonPress-1>")
-                    self.image_canvas.unbind("<B1-Motion>")
-                    self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
-                    self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
-                except (IOError, OSError, ValueError) as e:
-                    messagebox.showerror("Error", f"Failed to load image:\n{e}")
+                # Load the new image; the current one stays until loading succeeds
+                self.load_image(image_path, on_loaded=self.on_new_image_loaded)
+
+    def on_new_image_loaded(self):
+        # Reset zoom level
+        self.zoom_level = 1.0
+        self.reset_image_state()
+        # Update the image canvas
+        self.update_image()
+        # Update the threshold lines
+        self.update_threshold_lines()
+        # Update the scroll region
+        self.image_canvas.config(scrollregion=(0, 0, self.image_width * self.zoom_level, self.image_height * self.zoom_level))
+
+    def reset_image_state(self):
+        """Clear measurements, scale bar, calibration and thresholds, and start a new undo history."""
+        # Clear measurements and scale bar
+        self.remove_scale_bar()
+        self.measurements.clear()
+        self.refresh_overlays()
+        self.set_rois([])
+        # Reset scale calibration
+        self.scale_calibrated = False
+        self.calibration_label.config(text='')
+        # Reset HSV thresholds to default values
+        self.hue_low = 0
+        self.hue_high = 360
+        self.sat_low = 0
+        self.sat_high = 100
+        self.val_low = 0
+        self.val_high = 100
+        # Update GUI elements if necessary
+        self.sat_low_scale.set(self.sat_low)
+        self.sat_high_scale.set(self.sat_high)
+        self.val_low_scale.set(self.val_low)
+        self.val_high_scale.set(self.val_high)
+        # Close measurement dialog if open
+        if hasattr(self, 'measurement_dialog') and self.measurement_dialog.winfo_exists():
+            self.measurement_dialog.destroy()
+        # Reset event bindings if necessary
+        self.image_canvas.unbind("<ButtonPress-1>")
+        self.image_canvas.unbind("<B1-Motion>")
+        self.image_canvas.bind('<ButtonPress-1>', self.on_canvas_click)
+        self.image_canvas.bind('<B1-Motion>', self.on_canvas_drag)
+        # Start a new undo history
+        self.history.reset(self.history_state())
+
+    def session_state(self):
+        """Return the current thresholds, calibration, measurements and scale bar as a dict.
 
+        All positions are in image pixel coordinates.
+        """
+        session_dir = os.path.dirname(os.path.abspath(self.session_path)) if self.session_path else os.getcwd()
+        image_path = os.path.abspath(self.image_path)
+        state = {
+            'image': {
+                'path': image_path,
+                'relative_path': os.path.relpath(image_path, session_dir) if os.path.splitdrive(image_path)[0] ==
+                os.path.splitdrive(session_dir)[0] else None,
+                'fingerprint': self.image_fingerprint(),
+                'width': self.image_width,
+                'height': self.image_height,
+            },
+            'thresholds': {'hue': [self.hue_low, self.hue_high], 'saturation': [self.sat_low, self.sat_high],
+                           'value': [self.val_low, self.val_high]},
+            'display_mode': self.display_mode,
+            'postprocessing': self.postprocessing.to_dict(),
+            'phase_classes': [phase.to_dict() for phase in self.phase_classes],
+            'show_classes': self.show_classes,
+            'calibration': ({'length_per_pixel': self.length_per_pixel, 'units': self.length_units}
+                            if self.scale_calibrated else None),
+            'measurements': [self.measurements.row(i) for i in range(len(self.measurements))],
+            'scale_bar': None,
+            'rois': [roi.to_dict() for roi in self.rois],
+        }
+        bar = self.scale_bar_state()
+        if bar is not None:
+            state['scale_bar'] = dict(zip(('x0', 'y0', 'x1', 'length'), bar))
+        # Store NaN metrics of manual measurements as null to keep the file valid JSON
+        for row in state['measurements']:
+            for key, value in row.items():
+                if isinstance(value, float) and math.isnan(value):
+                    row[key] = None
+        return state
+
+    def apply_session_state(self, state):
+        """Restore thresholds, calibration, measurements and scale bar from a session dict."""
+        self.phase_classes = [PhaseClass.from_dict(d) for d in state.get('phase_classes', [])]
+        self.show_classes = state.get('show_classes', False)
+        self.display_mode = state.get('display_mode', 'mask')
+        self.set_postprocessing(PostProcessing.from_dict(state.get('postprocessing', {})))
+        self.display_mode_var.set(self.display_mode)
+        calibration = state.get('calibration')
+        if calibration:
+            self.length_per_pixel = calibration['length_per_pixel']
+            self.length_units = calibration['units']
+            self.scale_calibrated = True
+            self.calibration_label.config(text='')
+        for row in state.get('measurements', []):
+            extra = {key: math.nan if row.get(key) is None else row[key]
+                     for key in ('feret_min', 'skeleton_length', 'area')}
+            self.measurements.append(row['x0'], row['y0'], row['x1'], row['y1'], row['length'],
+                                     label=row.get('label', ''), timestamp=row.get('timestamp'), **extra)
+        self.refresh_overlays()
+        self.set_rois([ROI.from_dict(d) for d in state.get('rois', [])])
+        bar = state.get('scale_bar')
+        if bar and self.scale_calibrated:
+            zoom = self.zoom_level
+            self.create_scale_bar(bar['x0'] * zoom, bar['y0'] * zoom, bar['x1'] * zoom, bar['length'])
+        thresholds = state['thresholds']
+        self.set_thresholds(*thresholds['hue'], *thresholds['saturation'], *thresholds['value'])
+
+    def image_fingerprint(self):
+        """Return the fingerprint of the loaded image file, hashing it at most once."""
+        cached = getattr(self, '_fingerprint', None)
+        if cached is None or cached[0] != self.image_path or not fingerprint_matches(self.image_path, cached[1]):
+            self._fingerprint = (self.image_path, file_fingerprint(self.image_path))
+        return self._fingerprint[1]
+
+    def derived_arrays(self):
+        """Return the derived arrays worth caching next to a session."""
+        return {'rgb': self.rgb_array, 'hsv': self.hsv_array}
+
+    def save_session(self):
+        if self.rgb_array is None:
+            messagebox.showwarning("Save Session", "Please load an image first.")
+            return
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=SESSION_EXTENSION,
+            filetypes=[('HSV-Wizard Session', '*' + SESSION_EXTENSION), ('All Files', '*.*')],
+            title='Save Session'
+        )
+        if not save_path:
+            return
+        with_cache = messagebox.askyesno(
+            "Save Session", "Also store a cache of the decoded image data?\n"
+                            "The session then reopens without decoding the image, at the cost of disk space.")
+        try:
+            self.session_path = save_path
+            write_session(save_path, self.session_state(), self.derived_arrays() if with_cache else None)
+            messagebox.showinfo("Save Session", "Session saved successfully.")
+        except (IOError, OSError) as e:
+            messagebox.showerror("Error", f"Failed to save session:\n{e}")
+
+    def open_session(self):
+        session_path = filedialog.askopenfilename(
+            title='Open Session',
+            filetypes=[('HSV-Wizard Session', '*' + SESSION_EXTENSION), ('All Files', '*.*')]
+        )
+        if session_path:
+            self.load_session(session_path)
+
+    def load_session(self, session_path):
+        """Open a session, memory-mapping its cached arrays when they are still valid."""
+        try:
+            state = read_session(session_path)
+            image_path = session_image_path(session_path, state)
+            if not os.path.exists(image_path):
+                raise IOError(f"Image not found: {image_path}")
+            arrays = None
+            if fingerprint_matches(image_path, state['image']['fingerprint']):
+                arrays = load_session_cache(session_path, state)
+            elif not messagebox.askyesno("Open Session", "The image has changed since the session was saved.\n"
+                                                         "Open it anyway?"):
+                return
+        except (IOError, OSError, ValueError, KeyError) as e:
+            messagebox.showerror("Error", f"Failed to open session:\n{e}")
+            return
+
+        def restore():
+            self.session_path = session_path
+            self.reset_image_state()
+            self.apply_session_state(state)
+            self.history.reset(self.history_state())
+
+        if arrays is not None:
+            self.cancel_loading()
+            self.set_image_arrays(arrays['rgb'], arrays['hsv'], image_path)
+            self._fingerprint = (image_path, state['image']['fingerprint'])
+            restore()
+        else:
+            self.load_image(image_path, on_loaded=restore)
 
+
+    @recorded
     def on_click(self, event):
         angle = self.get_angle(event.x, event.y)
         if self.is_near_angle(angle, self.hue_low):
@@ -873,18 +6467,19 @@ class HSVThresholdAdjuster(tk.Tk):
         else:
             self.dragging = None
 
+    @recorded
     def on_drag(self, event):
         angle = self.get_angle(event.x, event.y)
         if self.dragging == 'low':
             self.hue_low = angle
             self.hue_low_scale.set(self.hue_low)
-            self.update_threshold_lines()
-            self.update_image()
         elif self.dragging == 'high':
             self.hue_high = angle
             self.hue_high_scale.set(self.hue_high)
-            self.update_threshold_lines()
-            self.update_image()
+        else:
+            return
+        self.record_history('Thresholds', 'thresholds', coalesce='thresholds')
+        self.request_redraw(threshold_lines=True)
 
     def get_angle(self, x, y):
         dx = x - self.wheel_radius
@@ -896,10 +6491,6 @@ class HSVThresholdAdjuster(tk.Tk):
         return min(abs(angle1 - angle2), 360 - abs(angle1 - angle2)) < threshold
 
     def update_threshold_lines(self):
-        # Remove existing sector if it exists
-        if hasattr(self, 'sector'):
-            self.wheel_canvas.delete(self.sector)
-
         # Lower threshold line
         x1, y1 = self.get_line_coords(self.hue_low)
         self.wheel_canvas.coords(self.lower_line, self.wheel_radius, self.wheel_radius, x1, y1)
@@ -908,164 +6499,501 @@ class HSVThresholdAdjuster(tk.Tk):
         x2, y2 = self.get_line_coords(self.hue_high)
         self.wheel_canvas.coords(self.upper_line, self.wheel_radius, self.wheel_radius, x2, y2)
 
-        # Draw the shaded sector
-        points = [self.wheel_radius, self.wheel_radius, x1, y1]
-        # Generate points along the arc
-        angle_start = self.hue_low
-        angle_end = self.hue_high
-        if angle_start > angle_end:
-            angle_end += 360  # Handle wrap-around
-        num_points = int(abs(angle_end - angle_start))  # Number of points along the arc
-        for angle in np.linspace(angle_start, angle_end, num_points):
-            x, y = self.get_line_coords(angle % 360)
-            points.extend([x, y])
-        points.extend([x2, y2])
-        # Draw the sector
-        self.sector = self.wheel_canvas.create_polygon(points, fill='gray', stipple='gray50', outline='')
+        # Update the shaded sector in place
+        self.wheel_canvas.coords(self.sector, wheel_sector_points(
+            self.hue_low, self.hue_high, self.wheel_radius, self.wheel_radius, self.wheel_table))
 
         # Update the hue bar selection
         bar_width = self.hue_bar_width
         x_start = hue_angle_to_x(self.hue_low, bar_width)
         x_end = hue_angle_to_x(self.hue_high, bar_width)
         if x_start > x_end:
-            # Handle wrap-around by drawing two rectangles
-            if hasattr(self, 'hue_bar_selection1'):
-                self.hue_bar_canvas.delete(self.hue_bar_selection1)
-                self.hue_bar_canvas.delete(self.hue_bar_selection2)
-            self.hue_bar_selection1 = self.hue_bar_canvas.create_rectangle(0, 0, x_end, 50, fill='gray', stipple='gray50', outline='')
-            self.hue_bar_selection2 = self.hue_bar_canvas.create_rectangle(x_start, 0, bar_width, 50, fill='gray', stipple='gray50', outline='')
+            # Handle wrap-around with two rectangles
+            self.hue_bar_canvas.coords(self.hue_bar_selection1, 0, 0, x_end, 50)
+            self.hue_bar_canvas.coords(self.hue_bar_selection2, x_start, 0, bar_width, 50)
+            self.hue_bar_canvas.itemconfig(self.hue_bar_selection1, state='normal')
+            self.hue_bar_canvas.itemconfig(self.hue_bar_selection2, state='normal')
             self.hue_bar_canvas.itemconfig(self.hue_bar_selection, state='hidden')
         else:
-            if hasattr(self, 'hue_bar_selection1'):
-                self.hue_bar_canvas.delete(self.hue_bar_selection1)
-                self.hue_bar_canvas.delete(self.hue_bar_selection2)
+            self.hue_bar_canvas.itemconfig(self.hue_bar_selection1, state='hidden')
+            self.hue_bar_canvas.itemconfig(self.hue_bar_selection2, state='hidden')
             self.hue_bar_canvas.coords(self.hue_bar_selection, x_start, 0, x_end, 50)
             self.hue_bar_canvas.itemconfig(self.hue_bar_selection, state='normal')
 
     def get_line_coords(self, angle):
-        radians = np.radians(angle)
-        x = self.wheel_radius + self.wheel_radius * np.cos(radians)
-        y = self.wheel_radius + self.wheel_radius * np.sin(radians)
+        radians = math.radians(angle)
+        x = self.wheel_radius + self.wheel_radius * math.cos(radians)
+        y = self.wheel_radius + self.wheel_radius * math.sin(radians)
         return x, y
 
-    def _apply_hsv_mask(self, image):
+    def _apply_hsv_mask(self, image=None):
         """Apply current HSV thresholds to an image and return the masked result.
 
         Converts the image to HSV color space, creates boolean masks for each
         channel (hue, saturation, value) based on the current threshold settings,
-        and sets all pixels outside the combined mask to black.
+        and composites the image according to the current display mode (by
+        default all pixels outside the combined mask are set to black). The
+        kernel backend (see get_kernels()) may fuse these steps into one pass.
 
         Handles circular hue wrap-around (e.g., selecting reds across 350-10 degrees).
 
+        When phase classes are shown, the false-color class overlay is returned
+        instead. Without an image argument the loaded image is used, reusing
+        its cached HSV array and mask.
+
         Returns:
-            PIL.Image: The masked image with non-matching pixels set to black.
+            PIL.Image: The composited image.
+        """
+        if image is None:
+            if self.show_classes and self.phase_classes:
+                return Image.fromarray(false_color_overlay(self.rgb_array, self.class_labels(), self.phase_classes))
+            return Image.fromarray(composite_runs(self.rgb_array, self.processed_mask(), self.display_mode))
+
+        bounds = threshold_bounds(*self.thresholds())
+        composite, _ = get_kernels().mask_rgb(np.asarray(image.convert('RGB')), bounds, self.display_mode)
+        return Image.fromarray(composite)
+
+    def get_viewport(self):
+        """Return the visible image region as (x0, y0, x1, y1) in image pixel coordinates."""
+        canvas_x = self.image_canvas.canvasx(0)
+        canvas_y = self.image_canvas.canvasy(0)
+        width = max(self.image_canvas.winfo_width(), 1)
+        height = max(self.image_canvas.winfo_height(), 1)
+        x0 = max(int(np.floor(canvas_x / self.zoom_level)), 0)
+        y0 = max(int(np.floor(canvas_y / self.zoom_level)), 0)
+        x1 = min(int(np.ceil((canvas_x + width) / self.zoom_level)) + 1, self.image_width)
+        y1 = min(int(np.ceil((canvas_y + height) / self.zoom_level)) + 1, self.image_height)
+        return x0, y0, max(x1, x0 + 1), max(y1, y0 + 1)
+
+    def render_viewport(self, box, step=1):
+        """Composite the image crop inside box (image coordinates) for display.
+
+        With step > 1 only every step-th pixel is composited, for previews.
         """
-        hsv_image = image.convert('HSV')
-        hsv_array = np.array(hsv_image)
-
-        hue_low = int((self.hue_low / 360) * 255)
-        hue_high = int((self.hue_high / 360) * 255)
-        sat_low = int((self.sat_low / 100) * 255)
-        sat_high = int((self.sat_high / 100) * 255)
-        val_low = int((self.val_low / 100) * 255)
-        val_high = int((self.val_high / 100) * 255)
-
-        if hue_low <= hue_high:
-            hue_mask = (hsv_array[:, :, 0] >= hue_low) & (hsv_array[:, :, 0] <= hue_high)
+        x0, y0, x1, y1 = box
+        thickness = self.thickness_map() if self.show_thickness else None
+        if thickness is not None:
+            return thickness_overlay(self.rgb_array[y0:y1:step, x0:x1:step],
+                                     thickness[y0:y1:step, x0:x1:step], self._thickness[2])
+        if step > 1:
+            rgb_crop = self.rgb_array[y0:y1:step, x0:x1:step]
+            if self.show_classes and self.phase_classes:
+                labels = self.class_labels()[y0:y1:step, x0:x1:step]
+                return false_color_overlay(rgb_crop, labels, self.phase_classes)
+            return composite_mask(rgb_crop, self.current_mask().rasterize(box, step), self.display_mode)
+        # Composite with a halo so outlines and post-processing are correct at the crop border
+        halo = 1 + self.postprocessing.halo()
+        hx0, hy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+        hx1, hy1 = min(x1 + halo, self.image_width), min(y1 + halo, self.image_height)
+        rgb_crop = self.rgb_array[hy0:hy1, hx0:hx1]
+        if self.show_classes and self.phase_classes:
+            labels = self.class_labels()[hy0:hy1, hx0:hx1]
+            composite = false_color_overlay(rgb_crop, labels, self.phase_classes)
         else:
-            hue_mask = (hsv_array[:, :, 0] >= hue_low) | (hsv_array[:, :, 0] <= hue_high)
+            mask = self.current_mask().rasterize((hx0, hy0, hx1, hy1))
+            if self.postprocessing.is_active():
+                mask = self.postprocessing.apply(mask, local=True)
+                if self.rois:
+                    mask &= self.roi_mask().rasterize((hx0, hy0, hx1, hy1))
+            composite = composite_mask(rgb_crop, mask, self.display_mode)
+        return composite[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+    def schedule_render(self):
+        """Coalesce viewport changes into a single render on the next idle cycle."""
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._run_scheduled_render)
+
+    def _run_scheduled_render(self):
+        self._render_pending = False
+        self.update_image()
 
-        sat_mask = (hsv_array[:, :, 1] >= sat_low) & (hsv_array[:, :, 1] <= sat_high)
-        val_mask = (hsv_array[:, :, 2] >= val_low) & (hsv_array[:, :, 2] <= val_high)
+    def update_image(self):
+        """Show the visible part of the image as cached display tiles.
 
-        mask = hue_mask & sat_mask & val_mask
+        Tiles already rendered at this zoom level and render version are
+        reused. After a zoom step, missing tiles are covered by a quick
+        nearest-neighbour preview and rendered sharply in the background.
+        """
+        if self.rgb_array is None:
+            return
+        zoom = self.zoom_level
+        zoomed_width = int(self.image_width * zoom)
+        zoomed_height = int(self.image_height * zoom)
+        # Set the scroll region first so the viewport reflects the current zoom
+        self.image_canvas.config(scrollregion=(0, 0, zoomed_width, zoomed_height))
 
-        masked_array = np.copy(np.array(image))
-        masked_array[~mask] = [0, 0, 0]
+        state = self.render_state()
+        if state != self._render_state:
+            self._render_state = state
+            self.render_version = self.render_version_for(state)
+            self.schedule_coverage_update()
+
+        viewport = (self.image_canvas.canvasx(0), self.image_canvas.canvasy(0),
+                    max(self.image_canvas.winfo_width(), 1), max(self.image_canvas.winfo_height(), 1))
+        visible = visible_tiles(zoom, (self.image_width, self.image_height), viewport)
+        keys = [(zoom, tx, ty, self.render_version) for tx, ty in visible]
+        zoom_changed = zoom != self._tile_zoom
+        if zoom_changed:
+            if any(self.tile_cache.peek(key) is None for key in keys):
+                self.show_zoom_preview(self._tile_zoom)
+            for item_id, _, _ in self.tile_items.values():
+                self.image_canvas.delete(item_id)
+            self.tile_items.clear()
+            self._tile_zoom = zoom
+
+        self._pending_tiles = []
+        for key in keys:
+            entry = self.tile_cache.get(key)
+            if entry is not None:
+                self.show_tile(key, entry[1])
+            elif zoom_changed:
+                self._pending_tiles.append(key)
+            else:
+                self.show_tile(key, self.render_tile(key))
+        # Drop canvas items of tiles that scrolled out of view; their images stay cached
+        visible = set(visible)
+        for index in [index for index in self.tile_items if index not in visible]:
+            self.image_canvas.delete(self.tile_items.pop(index)[0])
+
+        if self._tile_job is not None:
+            self.after_cancel(self._tile_job)
+            self._tile_job = None
+        if self._pending_tiles:
+            # Keep the cheap preview until a zoom gesture has settled
+            delay = max(int((self._zoom_active_until - time.perf_counter()) * 1000), 1)
+            self._tile_job = self.after(delay, self.fill_tiles)
+        else:
+            self.image_canvas.delete('zoom_preview')
 
-        return Image.fromarray(masked_array)
+        # Tiles are stacked below the overlays as they are created, so overlays need no raising
+        self.refresh_overlays()
 
-    def update_image(self):
-        if not hasattr(self, 'original_image'):
-            return
-        masked_image = self._apply_hsv_mask(self.original_image)
+        self.enforce_memory_budget()
 
-        # Resize the image according to the zoom level
-        zoomed_width = int(self.image_width * self.zoom_level)
-        zoomed_height = int(self.image_height * self.zoom_level)
-        zoomed_image = masked_image.resize((zoomed_width, zoomed_height), Image.BILINEAR)
+    def schedule_coverage_update(self):
+        if self._coverage_job is not None:
+            self.after_cancel(self._coverage_job)
+        self._coverage_job = self.after(COVERAGE_DELAY_MS, self.update_coverage)
 
-        self.masked_image_tk = ImageTk.PhotoImage(zoomed_image)
+    def selection_coverage(self):
+        """Return (pixels, fraction of the image or ROIs, calibrated area or None) of the post-processed selection."""
+        pixels = self.processed_mask().area
+        area = pixels * self.length_per_pixel ** 2 if self.scale_calibrated else None
+        total = self.roi_mask().area if self.rois else self.image_width * self.image_height
+        return pixels, pixels / total if total else 0.0, area
 
-        # Update the image on the canvas
-        if hasattr(self, 'image_id'):
-            self.image_canvas.itemconfig(self.image_id, image=self.masked_image_tk)
+    def update_coverage(self):
+        self._coverage_job = None
+        if self.rgb_array is None:
+            return
+        pixels, fraction, area = self.selection_coverage()
+        text = f"Selected: {fraction * 100:.2f}%{' of ROIs' if self.rois else ''} ({pixels} px)"
+        if area is not None:
+            text += f"\n= {area:.6g} {self.length_units}²"
+        self.coverage_label.config(text=text)
+
+    def render_state(self):
+        """Return everything that determines the rendered pixels, apart from zoom and position."""
+        if self.show_thickness and self.thickness_map() is not None:
+            content = ('thickness', self.thickness_key())
+        elif self.show_classes and self.phase_classes:
+            content = ('classes', tuple((phase.window(), phase.color) for phase in self.phase_classes))
         else:
-            self.image_id = self.image_canvas.create_image(0, 0, anchor='nw', image=self.masked_image_tk)
-            self.image_canvas.tag_lower(self.image_id)  # Ensure the image is at the bottom
-            
-        # Raise measurement items above the image
-        self.image_canvas.tag_raise('measurement')
-        
-        # Raise scale bar above the image
-        self.image_canvas.tag_raise('scale_bar') 
-        
-        # Update the scroll region
-        self.image_canvas.config(scrollregion=(0, 0, zoomed_width, zoomed_height))
+            content = ('mask', self.hue_low, self.hue_high, self.sat_low, self.sat_high, self.val_low,
+                       self.val_high, self.display_mode, self.postprocessing.key(), self.rois_key())
+        return content
+
+    def render_version_for(self, state):
+        """Return the tile version of a render state.
 
+        A state rendered recently keeps its version, so returning to it (by
+        undo or redo) shows its tiles from the tile cache without rendering.
+        """
+        version = self._render_versions.pop(state, None)
+        if version is None:
+            self._render_counter += 1
+            version = self._render_counter
+        self._render_versions[state] = version
+        while len(self._render_versions) > RENDER_VERSIONS_KEPT:
+            self._render_versions.popitem(last=False)
+        return version
+
+    def render_tile(self, key):
+        """Render one display tile with bilinear resampling and cache it."""
+        zoom, tx, ty, _ = key
+        size, (fx0, fy0, fx1, fy1) = tile_geometry(tx, ty, zoom, (self.image_width, self.image_height))
+        # Composite the whole pixels covering the tile; the resample box keeps tiles seamless
+        x0, y0 = int(fx0), int(fy0)
+        x1 = min(int(math.ceil(fx1)), self.image_width)
+        y1 = min(int(math.ceil(fy1)), self.image_height)
+        crop = Image.fromarray(self.render_viewport((x0, y0, x1, y1)))
+        tile = crop.resize(size, Image.BILINEAR, box=(fx0 - x0, fy0 - y0, fx1 - x0, fy1 - y0))
+        photo = ImageTk.PhotoImage(tile)
+        self.tile_cache.put(key, tile, photo)
+        return photo
+
+    def show_tile(self, key, photo):
+        """Place a rendered tile on the canvas, reusing the item already at its position."""
+        _, tx, ty, _ = key
+        current = self.tile_items.get((tx, ty))
+        if current is not None:
+            if current[1] != key:
+                self.image_canvas.itemconfig(current[0], image=photo)
+                self.tile_items[(tx, ty)] = (current[0], key, photo)
+            return
+        item_id = self.image_canvas.create_image(tx * TILE_SIZE, ty * TILE_SIZE, anchor='nw', image=photo,
+                                                 tags='tile')
+        # Stack tiles above a zoom preview they replace, but below all overlays
+        if self.image_canvas.find_withtag('zoom_preview'):
+            self.image_canvas.tag_raise(item_id, 'zoom_preview')
+        else:
+            self.image_canvas.tag_lower(item_id)
+        self.tile_items[(tx, ty)] = (item_id, key, photo)
+
+    def fill_tiles(self):
+        """Render pending sharp tiles for a slice of time, then yield to the event loop."""
+        self._tile_job = None
+        deadline = time.perf_counter() + TILE_FILL_BUDGET_MS / 1000
+        while self._pending_tiles and time.perf_counter() < deadline:
+            key = self._pending_tiles.pop(0)
+            self.show_tile(key, self.render_tile(key))
+        if self._pending_tiles:
+            self._tile_job = self.after(1, self.fill_tiles)
+        else:
+            self.image_canvas.delete('zoom_preview')
+            self.enforce_memory_budget()
+
+    def show_zoom_preview(self, previous_zoom):
+        """Cover the viewport with a fast nearest-neighbour preview at the new zoom level.
+
+        The preview is assembled from tiles cached at the previous zoom level
+        when they cover the viewport, and composited directly otherwise.
+        """
+        self.image_canvas.delete('zoom_preview')
+        zoom = self.zoom_level
+        x0, y0, x1, y1 = self.get_viewport()
+        source = None
+        if previous_zoom is not None:
+            source = self.scaled_from_tiles(previous_zoom, (x0, y0, x1, y1))
+        if source is None:
+            # Zoomed out, composite only every step-th pixel; the preview cannot show more
+            step = max(int(1 / zoom), 1)
+            source = Image.fromarray(self.render_viewport((x0, y0, x1, y1), step))
+        left = int(round(x0 * zoom))
+        top = int(round(y0 * zoom))
+        width = max(int(round(x1 * zoom)) - left, 1)
+        height = max(int(round(y1 * zoom)) - top, 1)
+        self.zoom_preview_tk = ImageTk.PhotoImage(source.resize((width, height), Image.NEAREST))
+        preview_id = self.image_canvas.create_image(left, top, anchor='nw', image=self.zoom_preview_tk,
+                                                    tags='zoom_preview')
+        self.image_canvas.tag_lower(preview_id)
+
+    def scaled_from_tiles(self, zoom, box):
+        """Assemble the image region `box` from tiles cached at `zoom`, or return None.
+
+        The result has the resolution of that zoom level.
+        """
+        size = (self.image_width, self.image_height)
+        x0, y0, x1, y1 = (int(math.floor(c * zoom)) for c in box)
+        x1 = max(min(x1, int(size[0] * zoom)), x0 + 1)
+        y1 = max(min(y1, int(size[1] * zoom)), y0 + 1)
+        indices = visible_tiles(zoom, size, (x0, y0, x1 - x0, y1 - y0))
+        if not indices:
+            return None
+        mosaic = Image.new('RGB', (x1 - x0, y1 - y0))
+        for tx, ty in indices:
+            entry = self.tile_cache.peek((zoom, tx, ty, self.render_version))
+            if entry is None:
+                return None
+            mosaic.paste(entry[0], (tx * TILE_SIZE - x0, ty * TILE_SIZE - y0))
+        return mosaic
+
+    def refresh_overlays(self):
+        """Show the measurements in view, and move ROI outlines and the scale bar after a zoom change."""
+        zoom = self.zoom_level
+        if self.rgb_array is not None:
+            self.measurement_layer.refresh(zoom, self.get_viewport(), self.length_units)
+        else:
+            self.measurement_layer.sync()
+        if self._overlay_zoom == zoom:
+            return
+        for roi, item in zip(self.rois, self.roi_items):
+            self.image_canvas.coords(item, *self.roi_canvas_coords(roi.outline()))
+        if hasattr(self, 'scale_bar'):
+            ratio = zoom / self._overlay_zoom
+            x0, y0, x1, y1 = (c * ratio for c in self.image_canvas.coords(self.scale_bar))
+            self.image_canvas.coords(self.scale_bar, x0, y0, x1, y1)
+            self.image_canvas.coords(self.scale_bar_text, (x0 + x1) / 2, y0 - 10)
+        self._overlay_zoom = zoom
+
+    @recorded
     def on_canvas_click(self, event):
         self.image_canvas.scan_mark(event.x, event.y)
 
+    @recorded
     def on_canvas_drag(self, event):
         self.image_canvas.scan_dragto(event.x, event.y, gain=1)
+        self.schedule_render()
 
-    def on_mousewheel(self, event):
-        if platform.system() == 'Windows':
-            delta = event.delta
-        elif platform.system() == 'Darwin':
-            delta = event.delta
-        else:
-            delta = -event.delta
+    def on_xscroll(self, *args):
+        self.image_canvas.xview(*args)
+        self.schedule_render()
 
-        if delta > 0:
-            self.zoom_in()
+    def on_yscroll(self, *args):
+        self.image_canvas.yview(*args)
+        self.schedule_render()
+
+    @recorded
+    def on_mousewheel(self, event):
+        """Zoom around the cursor; notches within WHEEL_COALESCE_MS form one zoom step."""
+        if event.num == 4:
+            notches = 1
+        elif event.num == 5:
+            notches = -1
         else:
-            self.zoom_out()
+            notches = 1 if event.delta > 0 else -1
+        self._wheel_notches += notches
+        self._wheel_anchor = (event.x, event.y)
+        # Render only cheap previews until the wheel has been still for a moment
+        self._zoom_active_until = time.perf_counter() + ZOOM_SETTLE_MS / 1000
+        if self._wheel_job is None:
+            self._wheel_job = self.after(WHEEL_COALESCE_MS, self._apply_wheel_zoom)
+
+    def _apply_wheel_zoom(self):
+        self._wheel_job = None
+        notches, self._wheel_notches = self._wheel_notches, 0
+        if notches:
+            self.zoom_at(ZOOM_STEP ** notches, *self._wheel_anchor)
+
+    def zoom_at(self, factor, x, y):
+        """Zoom by `factor`, keeping the image point under widget position (x, y) in place."""
+        old_zoom = self.zoom_level
+        new_zoom = min(max(old_zoom * factor, self.min_zoom), self.max_zoom)
+        if new_zoom == old_zoom or self.rgb_array is None:
+            return
+        left = zoom_anchor_origin(self.image_canvas.canvasx(x), x, old_zoom, new_zoom)
+        top = zoom_anchor_origin(self.image_canvas.canvasy(y), y, old_zoom, new_zoom)
+        self.zoom_level = new_zoom
+        # The scroll region must match the new zoom before the view can be moved
+        zoomed_width = max(int(self.image_width * new_zoom), 1)
+        zoomed_height = max(int(self.image_height * new_zoom), 1)
+        self.image_canvas.config(scrollregion=(0, 0, zoomed_width, zoomed_height))
+        self.image_canvas.xview_moveto(left / zoomed_width)
+        self.image_canvas.yview_moveto(top / zoomed_height)
+        self.update_image()
 
     def zoom_in(self):
-        if self.zoom_level < self.max_zoom:
-            self.zoom_level *= 1.1  # Increase zoom level by 10%
-            self.update_image()
+        self.zoom_at(ZOOM_STEP, self.image_canvas.winfo_width() / 2, self.image_canvas.winfo_height() / 2)
 
     def zoom_out(self):
-        if self.zoom_level > self.min_zoom:
-            self.zoom_level /= 1.1  # Decrease zoom level by 10%
-            self.update_image()
-
-    def undo_action(self):
-        if self.undo_stack:
-            action, item = self.undo_stack.pop()
-            if action == 'measurement':
-                line_id, text_id = item
-                self.image_canvas.delete(line_id)
-                self.image_canvas.delete(text_id)
-                if self.measurements:
-                    self.measurements.pop()
+        self.zoom_at(1 / ZOOM_STEP, self.image_canvas.winfo_width() / 2, self.image_canvas.winfo_height() / 2)
+
+    def history_state(self, fields=None):
+        """Return the undoable state (or only `fields` of it) as a dict of comparable values."""
+        getters = {
+            'thresholds': self.thresholds,
+            'calibration': lambda: (self.scale_calibrated, self.length_per_pixel, self.length_units),
+            'postprocessing': self.postprocessing.key,
+            'display_mode': lambda: self.display_mode,
+            'phase_classes': lambda: tuple(phase.key() for phase in self.phase_classes),
+            'show_classes': lambda: self.show_classes,
+            'rois': lambda: tuple(self.rois),
+            'measurements': self.measurements.rows,
+            'scale_bar': self.scale_bar_state,
+        }
+        return {field: getters[field]() for field in (fields or getters)}
+
+    def record_history(self, label, *fields, coalesce=None):
+        """Record the current value of `fields` (default: all) as an undoable change."""
+        if self._restoring_history:
+            return
+        if self.history.record(label, self.history_state(fields), coalesce=coalesce):
+            self.refresh_history_dialog()
+
+    def undo_action(self, steps=1):
+        """Undo the last `steps` changes, redrawing once."""
+        # Changes made without a history entry become undoable first
+        self.record_history('Edit')
+        state = self.history.undo(steps)
+        if state is None:
+            messagebox.showinfo("Undo", "Nothing to undo.")
+            return
+        self.apply_history_state(state)
+
+    def redo_action(self, steps=1):
+        """Redo the last `steps` undone changes, redrawing once."""
+        self.record_history('Edit')
+        state = self.history.redo(steps)
+        if state is None:
+            messagebox.showinfo("Redo", "Nothing to redo.")
+            return
+        self.apply_history_state(state)
+
+    def jump_history(self, position):
+        """Undo or redo to the state after the first `position` history entries."""
+        if position < self.history.position:
+            self.undo_action(self.history.position - position)
+        elif position > self.history.position:
+            self.redo_action(position - self.history.position)
+
+    def apply_history_state(self, state):
+        """Set the app to a state from the history; only changed fields are touched and the image is redrawn once."""
+        self._restoring_history = True
+        try:
+            if state['thresholds'] != self.thresholds():
+                (self.hue_low, self.hue_high, self.sat_low, self.sat_high,
+                 self.val_low, self.val_high) = state['thresholds']
+                self.update_threshold_lines()
+                for name in ('hue_low', 'hue_high', 'sat_low', 'sat_high', 'val_low', 'val_high'):
+                    getattr(self, name + '_scale').set(getattr(self, name))
+            calibration = state['calibration']
+            if calibration != (self.scale_calibrated, self.length_per_pixel, self.length_units):
+                self.scale_calibrated, self.length_per_pixel, self.length_units = calibration
+                self.calibration_label.config(text='')
+                self.schedule_coverage_update()
+            if state['postprocessing'] != self.postprocessing.key():
+                self.set_postprocessing(PostProcessing(*state['postprocessing']))
+            if state['display_mode'] != self.display_mode:
+                self.display_mode = state['display_mode']
+                self.display_mode_var.set(self.display_mode)
+            phase_classes = state['phase_classes']
+            if (phase_classes != tuple(phase.key() for phase in self.phase_classes)
+                    or state['show_classes'] != self.show_classes):
+                self.phase_classes = [PhaseClass.from_key(key) for key in phase_classes]
+                self.show_classes = state['show_classes']
+                self._labels_cache = (None, None)
+                if hasattr(self, 'phase_dialog') and self.phase_dialog.winfo_exists():
+                    self.phase_dialog.show_var.set(self.show_classes)
+                    self.phase_dialog.refresh()
+            if state['rois'] != tuple(self.rois):
+                self.set_rois(list(state['rois']))
+            if state['measurements'] != self.measurements.rows():
+                self.measurement_layer.truncate(self.measurements.set_rows(state['measurements']))
                 if hasattr(self, 'measurement_dialog') and self.measurement_dialog.winfo_exists():
                     self.measurement_dialog.update_measurements(self.measurements)
-            elif action == 'calibration_line':
-                self.image_canvas.delete(item)
-                self.scale_calibrated = False
-            elif action == 'scale_bar':
-                scale_line, scale_text = item
-                self.image_canvas.delete(scale_line)
-                self.image_canvas.delete(scale_text)
-                if hasattr(self, 'scale_bar'):
-                    del self.scale_bar
-                    del self.scale_bar_text
-            # Add more undo actions as needed
+            bar = state['scale_bar']
+            if bar != self.scale_bar_state():
+                self.remove_scale_bar()
+                if bar is not None:
+                    x0, y0, x1, length = bar
+                    zoom = self.zoom_level
+                    self.create_scale_bar(x0 * zoom, y0 * zoom, x1 * zoom, length)
+        finally:
+            self._restoring_history = False
+        self.refresh_overlays()
+        self.update_image()
+        self.refresh_history_dialog()
+
+    def show_history(self):
+        if not hasattr(self, 'history_dialog') or not self.history_dialog.winfo_exists():
+            self.history_dialog = HistoryDialog(self)
         else:
-            messagebox.showinfo("Undo", "Nothing to undo.")
+            self.history_dialog.lift()
+
+    def refresh_history_dialog(self):
+        if hasattr(self, 'history_dialog') and self.history_dialog.winfo_exists():
+            self.history_dialog.refresh()
 
     def save_image(self):
         # Prompt the user to select a save location
@@ -1077,7 +7005,7 @@ class HSVThresholdAdjuster(tk.Tk):
         if save_path:
             try:
                 # Apply the HSV mask to a copy of the original image
-                save_image = self._apply_hsv_mask(self.original_image)
+                save_image = self._apply_hsv_mask()
 
                 # Draw scale bar onto the image if it exists
                 if hasattr(self, 'scale_bar'):
@@ -1130,6 +7058,70 @@ class HSVThresholdAdjuster(tk.Tk):
             except (IOError, OSError) as e:
                 messagebox.showerror("Error", f"Failed to save image:\n{e}")
 
+    def export_strip(self, top, bottom):
+        """Return rows top:bottom of the image as saved: the class overlay if shown, else the composited mask."""
+        if self.show_classes and self.phase_classes:
+            return false_color_overlay(self.rgb_array[top:bottom], self.class_labels()[top:bottom], self.phase_classes)
+        return composite_runs_strip(self.rgb_array, self.processed_mask(), top, bottom, self.display_mode)
+
+    def export_pyramid(self):
+        """Export the processed image as a pyramidal tiled TIFF or a DeepZoom tile directory."""
+        if self.rgb_array is None:
+            messagebox.showwarning("Export Pyramid", "Please load an image first.")
+            return
+        save_path = filedialog.asksaveasfilename(
+            defaultextension='.tif',
+            filetypes=[('Pyramidal TIFF', '*.tif;*.tiff'), ('DeepZoom', '*.dzi'), ('All Files', '*.*')],
+            title='Export Pyramid'
+        )
+        if not save_path:
+            return
+        resolution = tiff_resolution(self.length_per_pixel, self.length_units) if self.scale_calibrated else None
+        self.config(cursor='watch')
+        self.update_idletasks()
+        try:
+            export_pyramid(save_path, self.export_strip, (self.image_width, self.image_height), resolution=resolution)
+            messagebox.showinfo("Export Pyramid", "Pyramid exported successfully.")
+        except (IOError, OSError) as e:
+            messagebox.showerror("Error", f"Failed to export pyramid:\n{e}")
+        finally:
+            self.config(cursor='')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Interactive HSV color threshold adjuster.')
+    parser.add_argument('image', nargs='?', help='image to open in the GUI')
+    parser.add_argument('--watch', metavar='DIR', help='process new images in DIR headless instead of opening the GUI')
+    parser.add_argument('--preset', metavar='SESSION', help='session file with the settings to apply in watch mode')
+    parser.add_argument('--rois', metavar='FILE',
+                        help='ROI file to use instead of the ROIs of the preset; results are also stored per ROI')
+    parser.add_argument('--results', metavar='DB', default='results.sqlite', help='results database (watch mode)')
+    parser.add_argument('--output', metavar='DIR', help='save the composited images to DIR (watch mode)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between folder polls')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must stay unchanged before it is processed')
+    parser.add_argument('--existing', action='store_true', help='also process images already in the folder')
+    args = parser.parse_args(argv)
+    if args.watch is None:
+        app = HSVThresholdAdjuster(args.image)
+        app.mainloop()
+        return
+    if args.preset is None:
+        parser.error('--watch requires --preset')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    settings = watch_settings(args.preset)
+    if args.rois is not None:
+        settings['rois'] = [roi.to_dict() for roi in read_roi_file(args.rois)]
+    try:
+        watch_folder(args.watch, settings, args.results, args.output, args.workers,
+                     args.interval, args.settle, args.existing)
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        sys.exit(f"Error: {e}")
+
+
 if __name__ == '__main__':
-    app = HSVThresholdAdjuster()
-    app.mainloop()
+    # Needed for worker processes of the frozen Windows executable
+    multiprocessing.freeze_support()
+    main()
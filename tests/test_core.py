@@ -7,7 +7,7 @@ import math
 
 import numpy as np
 import pytest
-from PIL import Image
+from PIL import Image, TiffImagePlugin
 
 # Import the module despite the hyphenated filename
 spec = importlib.util.spec_from_file_location(
@@ -315,3 +315,1794 @@ class TestCalibrationLogic:
         x_end, y_end = 50, 50
         pixel_distance = ((x_end - x_start)**2 + (y_end - y_start)**2)**0.5
         assert pixel_distance == 0.0
+
+
+# ─── Multi-Class Classification Tests ─────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestPhaseClassification:
+    """Tests for the single-pass multi-class lookup-table classifier."""
+
+    def _hsv(self, colors):
+        img = Image.fromarray(np.array([colors], dtype=np.uint8))
+        return np.array(img.convert('HSV'))
+
+    def test_labels_match_individual_masks(self):
+        rng = np.random.default_rng(0)
+        hsv = np.array(Image.fromarray(rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)).convert('HSV'))
+        classes = [
+            hsv_wizard.PhaseClass('red', 330, 30, 20, 100, 10, 100, (255, 0, 0)),
+            hsv_wizard.PhaseClass('green', 90, 150, 0, 100, 0, 100, (0, 255, 0)),
+            hsv_wizard.PhaseClass('dark', 0, 360, 0, 100, 0, 30, (0, 0, 255)),
+        ]
+        labels = hsv_wizard.classify_hsv(hsv, hsv_wizard.build_class_luts(classes))
+        claimed = np.zeros(hsv.shape[:2], dtype=bool)
+        for index, phase in enumerate(classes):
+            mask = hsv_wizard.compute_hsv_mask(hsv, *phase.window())
+            # Earlier classes take precedence where windows overlap
+            np.testing.assert_array_equal(labels == index + 1, mask & ~claimed)
+            claimed |= mask
+        assert (labels[~claimed] == 0).all()
+
+    def test_too_many_classes_rejected(self):
+        classes = [hsv_wizard.PhaseClass(str(i), 0, 360, 0, 100, 0, 100, (0, 0, 0))
+                   for i in range(hsv_wizard.MAX_PHASE_CLASSES + 1)]
+        with pytest.raises(ValueError):
+            hsv_wizard.build_class_luts(classes)
+
+    def test_area_table_uses_calibration(self):
+        hsv = self._hsv([(255, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 0)])
+        classes = [hsv_wizard.PhaseClass('red', 350, 10, 50, 100, 50, 100, (255, 0, 0))]
+        labels = hsv_wizard.classify_hsv(hsv, hsv_wizard.build_class_luts(classes))
+        (name, count, fraction, area), = hsv_wizard.class_area_table(labels, classes, length_per_pixel=0.5)
+        assert name == 'red'
+        assert count == 2
+        assert fraction == pytest.approx(0.5)
+        assert area == pytest.approx(0.5)
+
+    def test_false_color_overlay_leaves_unclassified_pixels(self):
+        rgb = np.array([[(200, 0, 0), (10, 20, 30)]], dtype=np.uint8)
+        labels = np.array([[1, 0]], dtype=np.uint8)
+        classes = [hsv_wizard.PhaseClass('a', 0, 360, 0, 100, 0, 100, (0, 100, 0))]
+        overlay = hsv_wizard.false_color_overlay(rgb, labels, classes)
+        assert tuple(overlay[0, 0]) == (100, 50, 0)
+        assert tuple(overlay[0, 1]) == (10, 20, 30)
+
+    def test_class_round_trips_through_dict(self):
+        phase = hsv_wizard.PhaseClass('pore', 10, 20, 30, 40, 50, 60, (1, 2, 3))
+        restored = hsv_wizard.PhaseClass.from_dict(phase.to_dict())
+        assert restored.name == 'pore'
+        assert restored.window() == phase.window()
+        assert restored.color == (1, 2, 3)
+
+
+# ─── Display Mode Compositing Tests ───────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestCompositeMask:
+    """Tests for the integer display-mode compositing."""
+
+    def setup_method(self):
+        rng = np.random.default_rng(1)
+        self.rgb = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        self.mask = np.zeros((12, 16), dtype=bool)
+        self.mask[3:9, 4:12] = True
+
+    def test_mask_mode_blacks_out_rejected_pixels(self):
+        out = hsv_wizard.composite_mask(self.rgb, self.mask, 'mask')
+        np.testing.assert_array_equal(out[self.mask], self.rgb[self.mask])
+        assert (out[~self.mask] == 0).all()
+
+    def test_tint_mode_keeps_background(self):
+        out = hsv_wizard.composite_mask(self.rgb, self.mask, 'tint')
+        assert out.dtype == np.uint8
+        np.testing.assert_array_equal(out[~self.mask], self.rgb[~self.mask])
+        assert not np.array_equal(out[self.mask], self.rgb[self.mask])
+
+    def test_dim_mode_darkens_background_only(self):
+        out = hsv_wizard.composite_mask(self.rgb, self.mask, 'dim')
+        np.testing.assert_array_equal(out[self.mask], self.rgb[self.mask])
+        assert (out[~self.mask] <= self.rgb[~self.mask]).all()
+
+    def test_outline_mode_marks_boundary(self):
+        out = hsv_wizard.composite_mask(self.rgb, self.mask, 'outline', color=(1, 2, 3))
+        edge = hsv_wizard.mask_outline(self.mask)
+        assert edge.sum() == 2 * (6 + 8) - 4
+        assert (out[edge] == (1, 2, 3)).all()
+        np.testing.assert_array_equal(out[~edge], self.rgb[~edge])
+
+    def test_inputs_are_not_modified(self):
+        rgb_before = self.rgb.copy()
+        for mode, _ in hsv_wizard.DISPLAY_MODES:
+            hsv_wizard.composite_mask(self.rgb, self.mask, mode)
+        np.testing.assert_array_equal(self.rgb, rgb_before)
+
+    def test_unknown_mode_rejected(self):
+        with pytest.raises(ValueError):
+            hsv_wizard.composite_mask(self.rgb, self.mask, 'sepia')
+
+
+# ─── Color Picker Sampling Tests ──────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestColorPickerSampling:
+    """Tests for region growing and threshold derivation in the color picker."""
+
+    def _hsv(self, rgb):
+        return np.array(Image.fromarray(rgb).convert('HSV'))
+
+    def test_region_stops_at_color_boundary(self):
+        rgb = np.zeros((30, 30, 3), dtype=np.uint8)
+        rgb[:, :] = (0, 0, 200)
+        rgb[5:15, 5:20] = (200, 20, 20)
+        region = hsv_wizard.grow_region(self._hsv(rgb), (10, 10))
+        expected = np.zeros((30, 30), dtype=bool)
+        expected[5:15, 5:20] = True
+        np.testing.assert_array_equal(region, expected)
+
+    def test_region_does_not_jump_gaps(self):
+        rgb = np.full((20, 20, 3), (0, 0, 200), dtype=np.uint8)
+        rgb[2:6, 2:6] = (200, 20, 20)
+        rgb[12:18, 12:18] = (200, 20, 20)
+        region = hsv_wizard.grow_region(self._hsv(rgb), (3, 3))
+        assert region.sum() == 16
+        assert not region[12:18, 12:18].any()
+
+    def test_region_follows_serpentine_path(self):
+        # A path of 3-pixel lanes winding back and forth is far longer than the window perimeter
+        rgb = np.full((43, 44, 3), (0, 0, 200), dtype=np.uint8)
+        path = np.zeros((43, 44), dtype=bool)
+        for lane in range(11):
+            path[4 * lane:4 * lane + 3, 1:43] = True
+        path[3::8, 42] = True
+        path[7::8, 1] = True
+        rgb[path] = (200, 20, 20)
+        region = hsv_wizard.grow_region(self._hsv(rgb), (1, 20))
+        np.testing.assert_array_equal(region, path)
+
+    def test_region_symmetric_across_red(self):
+        # Stripes of hue levels 10 below and above the seed's 0, with a far hue beyond them
+        hues = [128, 245, 250, 0, 5, 10, 128]
+        hsv = np.full((9, 3 * len(hues), 3), 200, dtype=np.uint8)
+        hsv[:, :, 0] = np.repeat(hues, 3)
+        region = hsv_wizard.grow_region(hsv, (4, 10), tolerance=(10, 40, 40))
+        expected = np.zeros(hsv.shape[:2], dtype=bool)
+        expected[:, 3:18] = True
+        np.testing.assert_array_equal(region, expected)
+        assert hsv_wizard.hue_distance(np.array([254, 255, 1]), 0).tolist() == [1, 0, 1]
+
+    def test_thresholds_cover_samples(self):
+        rng = np.random.default_rng(2)
+        rgb = np.clip(rng.normal((120, 180, 60), 8, (50, 50, 3)), 0, 255).astype(np.uint8)
+        hsv = self._hsv(rgb)
+        window = hsv_wizard.thresholds_from_samples(hsv, percentiles=(0, 100))
+        assert hsv_wizard.compute_hsv_mask(hsv, *window).all()
+
+    def test_hue_window_wraps_around_red(self):
+        hsv = np.array([[(250, 200, 200), (252, 200, 200), (2, 200, 200), (5, 200, 200)]], dtype=np.uint8)
+        hue_low, hue_high, *_ = hsv_wizard.thresholds_from_samples(hsv, percentiles=(0, 100))
+        assert hue_low > hue_high
+        assert hsv_wizard.compute_hsv_mask(hsv, hue_low, hue_high, 0, 100, 0, 100).all()
+
+    def test_hue_window_centred_on_wrap(self):
+        # Levels 254 and 0 are neighbours on the 255-level hue circle
+        hsv = np.array([[(252, 200, 200), (254, 200, 200), (0, 200, 200), (2, 200, 200)]], dtype=np.uint8)
+        hue_low, hue_high, *_ = hsv_wizard.thresholds_from_samples(hsv, percentiles=(0, 100))
+        assert hsv_wizard.compute_hsv_mask(hsv, hue_low, hue_high, 0, 100, 0, 100).all()
+        assert (hue_high - hue_low) % 360 < 10
+
+    def test_level_round_trip(self):
+        for level in range(256):
+            bounds = hsv_wizard.threshold_bounds(
+                hsv_wizard.level_to_threshold(level, 360), 0,
+                hsv_wizard.level_to_threshold(level, 100), 0, 0, 0)
+            assert bounds[0] == level
+            assert bounds[2] == level
+
+
+# ─── Wheel Sector Geometry Tests ──────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestWheelSectorPoints:
+    """Tests for the table-driven wheel sector polygon."""
+
+    def setup_method(self):
+        self.table = hsv_wizard.unit_circle_table()
+
+    def _points(self, low, high):
+        flat = hsv_wizard.wheel_sector_points(low, high, 150, 150, self.table)
+        return np.array(flat).reshape(-1, 2)
+
+    def test_starts_at_center_and_ends_on_thresholds(self):
+        points = self._points(10.5, 80.25)
+        assert tuple(points[0]) == (150, 150)
+        assert points[1] == pytest.approx((150 + 150 * math.cos(math.radians(10.5)),
+                                           150 + 150 * math.sin(math.radians(10.5))))
+        assert points[-1] == pytest.approx((150 + 150 * math.cos(math.radians(80.25)),
+                                            150 + 150 * math.sin(math.radians(80.25))))
+
+    def test_arc_points_lie_on_circle(self):
+        points = self._points(0, 270)[1:]
+        radii = np.hypot(points[:, 0] - 150, points[:, 1] - 150)
+        np.testing.assert_allclose(radii, 150)
+
+    def test_wrap_around_arc(self):
+        points = self._points(350, 10)
+        angles = np.degrees(np.arctan2(points[2:-1, 1] - 150, points[2:-1, 0] - 150)) % 360
+        assert len(angles) == 19
+        assert all(a >= 350 or a <= 10 for a in angles)
+
+
+# ─── Measurement Store Tests ──────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestMeasurementStore:
+    """Tests for the columnar measurement store."""
+
+    def test_append_grows_past_capacity(self):
+        store = hsv_wizard.MeasurementStore(capacity=2)
+        for i in range(1000):
+            store.append(0, 0, i, 0, float(i))
+        assert len(store) == 1000
+        np.testing.assert_array_equal(store.lengths, np.arange(1000.0))
+
+    def test_row_contains_image_coordinates_and_angle(self):
+        store = hsv_wizard.MeasurementStore()
+        store.append(10, 20, 20, 10, 5.0, label='fibre', timestamp=123.0)
+        row = store.row(0)
+        assert (row['x0'], row['y0'], row['x1'], row['y1']) == (10, 20, 20, 10)
+        # Image y points down, so a line going up-right is at +45°
+        assert row['angle'] == pytest.approx(45.0)
+        assert row['timestamp'] == 123.0
+        assert row['label'] == 'fibre'
+
+    def test_summary_matches_numpy(self):
+        store = hsv_wizard.MeasurementStore()
+        values = [1.5, 2.0, 4.25, 8.0, 3.0]
+        for v in values:
+            store.append(0, 0, 1, 1, v)
+        count, mean, std = store.summary()
+        assert count == 5
+        assert mean == pytest.approx(np.mean(values))
+        assert std == pytest.approx(np.std(values, ddof=1))
+
+    def test_pop_updates_summary(self):
+        store = hsv_wizard.MeasurementStore()
+        store.append(0, 0, 1, 1, 2.0)
+        store.append(0, 0, 1, 1, 6.0)
+        assert store.pop()['length'] == 6.0
+        assert store.summary() == (1, 2.0, 0.0)
+        store.pop()
+        assert not store
+        with pytest.raises(IndexError):
+            store.pop()
+
+    def test_summary_exact_for_large_offset(self):
+        # Lengths with a large common offset; sums of squares would cancel catastrophically
+        store = hsv_wizard.MeasurementStore()
+        values = [1e8 + 0.1, 1e8 + 0.2, 1e8 + 0.3, 1e8 + 0.4]
+        for v in values + [1e12]:
+            store.append(0, 0, 1, 1, v)
+        store.pop()
+        count, mean, std = store.summary()
+        assert count == 4
+        assert mean == pytest.approx(np.mean(values), rel=1e-15)
+        assert std == pytest.approx(np.std(values, ddof=1), rel=1e-6)
+
+    def test_columns_are_read_only(self):
+        store = hsv_wizard.MeasurementStore()
+        store.append(0, 0, 1, 1, 2.0)
+        with pytest.raises(ValueError):
+            store.lengths[0] = 3.0
+
+    def test_histogram(self):
+        store = hsv_wizard.MeasurementStore()
+        for v in [1, 1, 2, 9]:
+            store.append(0, 0, 1, 1, v)
+        counts, edges = store.histogram(bins=2)
+        assert counts.tolist() == [3, 1]
+
+
+# ─── Automatic Feature Measurement Tests ──────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestFeatureMeasurement:
+    """Tests for run labelling, skeletons and Feret diameters."""
+
+    def test_runs_round_trip(self):
+        mask = np.random.default_rng(3).random((20, 30)) > 0.5
+        rows, starts, ends = hsv_wizard.mask_runs(mask)
+        rebuilt = np.zeros_like(mask)
+        for r, s, e in zip(rows, starts, ends):
+            rebuilt[r, s:e] = True
+        np.testing.assert_array_equal(rebuilt, mask)
+
+    def test_connectivity(self):
+        mask = np.array([[1, 0, 0],
+                         [0, 1, 0],
+                         [0, 0, 0],
+                         [1, 1, 1]], dtype=bool)
+        runs = hsv_wizard.mask_runs(mask)
+        assert hsv_wizard.label_runs(*runs, connectivity=8)[1] == 2
+        assert hsv_wizard.label_runs(*runs, connectivity=4)[1] == 3
+
+    def test_u_shape_is_one_object(self):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[1:9, 1] = True
+        mask[1:9, 8] = True
+        mask[8, 1:9] = True
+        labels, count = hsv_wizard.label_runs(*hsv_wizard.mask_runs(mask))
+        assert count == 1
+
+    def test_rectangle_feret_and_skeleton(self):
+        mask = np.zeros((20, 60), dtype=bool)
+        mask[5:8, 5:45] = True
+        features = hsv_wizard.measure_features(mask, length_per_pixel=0.5)
+        assert len(features['label']) == 1
+        assert features['area'][0] == pytest.approx(120 * 0.25)
+        assert features['feret_max'][0] == pytest.approx(math.hypot(40, 3) * 0.5)
+        assert features['feret_min'][0] == pytest.approx(3 * 0.5)
+        assert features['skeleton_length'][0] == pytest.approx(40 * 0.5, rel=0.1)
+        assert features['centroid_x'][0] == pytest.approx(25.0)
+        assert features['centroid_y'][0] == pytest.approx(6.5)
+
+    def test_orientation_of_diagonal_line(self):
+        mask = np.eye(30, dtype=bool)[::-1]
+        features = hsv_wizard.measure_features(mask)
+        assert features['orientation'][0] == pytest.approx(45.0)
+        assert features['skeleton_length'][0] == pytest.approx(29 * math.sqrt(2))
+
+    def test_min_area_filters_specks(self):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[1, 1] = True
+        mask[5:8, 5:8] = True
+        features = hsv_wizard.measure_features(mask, min_area=2)
+        assert features['label'].tolist() == [2]
+
+    def test_empty_mask(self):
+        features = hsv_wizard.measure_features(np.zeros((5, 5), dtype=bool))
+        assert len(features['label']) == 0
+
+    def test_features_csv(self, tmp_path):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[2:5, 2:8] = True
+        path = tmp_path / 'features.csv'
+        hsv_wizard.write_features_csv(path, hsv_wizard.measure_features(mask), units='µm')
+        lines = path.read_text().splitlines()
+        assert lines[0].startswith('Object,Area (µm²)')
+        assert len(lines) == 2
+
+
+# ─── Session File Tests ───────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestSessionFile:
+    """Tests for session files and their sidecar array cache."""
+
+    def _state(self, image_path):
+        return {
+            'image': {'path': str(image_path), 'relative_path': image_path.name,
+                      'fingerprint': hsv_wizard.file_fingerprint(image_path), 'width': 4, 'height': 3},
+            'thresholds': {'hue': [10, 50], 'saturation': [0, 100], 'value': [20, 80]},
+            'measurements': [{'x0': 0.0, 'y0': 1.0, 'x1': 3.0, 'y1': 1.0, 'length': 1.5, 'label': 'a'}],
+        }
+
+    def _image(self, tmp_path):
+        path = tmp_path / 'image.png'
+        Image.new('RGB', (4, 3), (200, 40, 40)).save(path)
+        return path
+
+    def test_fingerprint_matches_unchanged_file(self, tmp_path):
+        path = self._image(tmp_path)
+        fingerprint = hsv_wizard.file_fingerprint(path)
+        assert hsv_wizard.fingerprint_matches(path, fingerprint)
+        Image.new('RGB', (4, 3), (0, 0, 0)).save(path)
+        assert not hsv_wizard.fingerprint_matches(path, fingerprint)
+
+    def test_fingerprint_survives_touch(self, tmp_path):
+        path = self._image(tmp_path)
+        fingerprint = hsv_wizard.file_fingerprint(path)
+        os.utime(path, ns=(0, fingerprint['mtime_ns'] + 10**9))
+        assert hsv_wizard.fingerprint_matches(path, fingerprint)
+
+    def test_round_trip(self, tmp_path):
+        image_path = self._image(tmp_path)
+        session_path = str(tmp_path / 'run.hsvw')
+        hsv_wizard.write_session(session_path, self._state(image_path))
+        state = hsv_wizard.read_session(session_path)
+        assert state['version'] == hsv_wizard.SESSION_VERSION
+        assert state['thresholds']['hue'] == [10, 50]
+        assert state['measurements'][0]['label'] == 'a'
+        assert state['cache'] is None
+        assert hsv_wizard.load_session_cache(session_path, state) is None
+
+    def test_relative_image_path(self, tmp_path):
+        image_path = self._image(tmp_path)
+        session_path = str(tmp_path / 'run.hsvw')
+        state = self._state(image_path)
+        state['image']['path'] = '/moved/elsewhere/image.png'
+        assert hsv_wizard.session_image_path(session_path, state) == str(image_path)
+
+    def test_cache_is_memory_mapped(self, tmp_path):
+        image_path = self._image(tmp_path)
+        session_path = str(tmp_path / 'run.hsvw')
+        rgb = np.asarray(Image.open(image_path))
+        hsv_wizard.write_session(session_path, self._state(image_path), {'rgb': rgb})
+        state = hsv_wizard.read_session(session_path)
+        arrays = hsv_wizard.load_session_cache(session_path, state)
+        assert isinstance(arrays['rgb'], np.memmap)
+        np.testing.assert_array_equal(arrays['rgb'], rgb)
+
+    def test_stale_cache_is_rejected(self, tmp_path):
+        image_path = self._image(tmp_path)
+        session_path = str(tmp_path / 'run.hsvw')
+        hsv_wizard.write_session(session_path, self._state(image_path), {'rgb': np.zeros((3, 4, 3), np.uint8)})
+        state = hsv_wizard.read_session(session_path)
+        state['image']['fingerprint']['blake2b'] = '0' * 40
+        assert hsv_wizard.load_session_cache(session_path, state) is None
+
+
+# ─── Image Cache Tests ────────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestImageCache:
+    """Tests for the content-addressed image array cache."""
+
+    def _image(self, tmp_path, name, color):
+        path = tmp_path / name
+        Image.new('RGB', (8, 4), color).save(path)
+        return str(path)
+
+    def _arrays(self, path):
+        image = Image.open(path).convert('RGB')
+        return {'rgb': np.asarray(image), 'hsv': np.array(image.convert('HSV'))}
+
+    def test_miss_then_memory_mapped_hit(self, tmp_path):
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'))
+        path = self._image(tmp_path, 'a.png', (10, 200, 30))
+        assert cache.get(path) is None
+        cache.put(path, self._arrays(path))
+        arrays = cache.get(path)
+        assert isinstance(arrays['hsv'], np.memmap)
+        np.testing.assert_array_equal(arrays['rgb'], self._arrays(path)['rgb'])
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_index_persists(self, tmp_path):
+        path = self._image(tmp_path, 'a.png', (10, 200, 30))
+        hsv_wizard.ImageCache(str(tmp_path / 'cache')).put(path, self._arrays(path))
+        assert hsv_wizard.ImageCache(str(tmp_path / 'cache')).get(path) is not None
+
+    def test_unchanged_file_is_not_rehashed(self, tmp_path, monkeypatch):
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'))
+        path = self._image(tmp_path, 'a.png', (10, 200, 30))
+        cache.fingerprint(path)
+        monkeypatch.setattr(hsv_wizard, 'file_fingerprint', lambda p: pytest.fail('file was hashed again'))
+        cache.fingerprint(path)
+
+    def test_changed_file_misses(self, tmp_path):
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'))
+        path = self._image(tmp_path, 'a.png', (10, 200, 30))
+        cache.put(path, self._arrays(path))
+        Image.new('RGB', (8, 5), (0, 0, 0)).save(path)
+        assert cache.get(path) is None
+
+    def test_lru_eviction(self, tmp_path):
+        paths = [self._image(tmp_path, f'{i}.png', (i * 40, 0, 0)) for i in range(3)]
+        entry_bytes = sum(a.nbytes for a in self._arrays(paths[0]).values())
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'), max_bytes=2 * entry_bytes)
+        cache.put(paths[0], self._arrays(paths[0]))
+        cache.put(paths[1], self._arrays(paths[1]))
+        cache.get(paths[0])
+        cache.put(paths[2], self._arrays(paths[2]))
+        assert cache.stats()['evictions'] == 1
+        assert cache.get(paths[1]) is None
+        assert cache.get(paths[0]) is not None
+        assert cache.total_bytes <= cache.max_bytes
+
+    def test_clear(self, tmp_path):
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'))
+        path = self._image(tmp_path, 'a.png', (10, 200, 30))
+        cache.put(path, self._arrays(path))
+        cache.clear()
+        assert cache.stats()['entries'] == 0
+        assert cache.get(path) is None
+
+
+# ─── Background Loading Tests ─────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestImageLoading:
+    """Tests for background image loading, previews and cancellation."""
+
+    def _messages(self, loader):
+        loader.run()
+        messages = []
+        while not loader.messages.empty():
+            messages.append(loader.messages.get_nowait())
+        return messages
+
+    def test_strip_conversion_matches_pil(self):
+        rng = np.random.default_rng(3)
+        image = Image.fromarray(rng.integers(0, 256, (37, 23, 3), dtype=np.uint8))
+        fractions = []
+        rgb, hsv = hsv_wizard.convert_image_arrays(image, progress=fractions.append, strip_bytes=23 * 3 * 5)
+        np.testing.assert_array_equal(rgb, np.asarray(image))
+        np.testing.assert_array_equal(hsv, np.asarray(image.convert('HSV')))
+        assert len(fractions) == 8
+        assert fractions[-1] == 1.0
+
+    def test_strip_conversion_of_grayscale(self):
+        image = Image.fromarray(np.arange(60, dtype=np.uint8).reshape(6, 10))
+        rgb, _ = hsv_wizard.convert_image_arrays(image)
+        np.testing.assert_array_equal(rgb, np.asarray(image.convert('RGB')))
+
+    def test_cancelled_conversion_raises(self):
+        cancel = hsv_wizard.threading.Event()
+        cancel.set()
+        with pytest.raises(hsv_wizard.LoadCancelled):
+            hsv_wizard.convert_image_arrays(Image.new('RGB', (4, 4)), cancel=cancel)
+
+    def test_jpeg_preview_uses_draft(self, tmp_path):
+        path = tmp_path / 'large.jpg'
+        Image.new('RGB', (2048, 1024), (30, 120, 200)).save(path)
+        preview, full_size = hsv_wizard.open_preview(path, max_size=256)
+        assert full_size == (2048, 1024)
+        assert preview.size[0] < 2048
+        assert preview.size[0] >= 256
+
+    def _pyramid(self, path, subfile_type):
+        full = Image.new('RGB', (800, 400), (200, 0, 0))
+        pages = [(full, 0), (full.resize((400, 200)), subfile_type), (full.resize((100, 50)), subfile_type)]
+        with TiffImagePlugin.AppendingTiffWriter(str(path), True) as tiff:
+            for page, subfile in pages:
+                page.save(tiff, format='TIFF', tiffinfo={254: subfile})
+                tiff.newFrame()
+
+    def test_tiff_preview_uses_reduced_page(self, tmp_path):
+        path = tmp_path / 'pyramid.tif'
+        self._pyramid(path, subfile_type=1)
+        preview, full_size = hsv_wizard.open_preview(path, max_size=300)
+        assert full_size == (800, 400)
+        assert preview.size == (400, 200)
+        preview, _ = hsv_wizard.open_preview(path, max_size=1000)
+        assert preview.size == (400, 200)
+        preview, _ = hsv_wizard.open_preview(path, max_size=64)
+        assert preview.size == (100, 50)
+
+    def test_tiff_pages_without_subfile_type_are_not_previews(self, tmp_path):
+        path = tmp_path / 'stack.tif'
+        self._pyramid(path, subfile_type=0)
+        assert hsv_wizard.open_preview(path)[0] is None
+
+    def test_plain_png_has_no_preview(self, tmp_path):
+        path = tmp_path / 'image.png'
+        Image.new('RGB', (20, 10)).save(path)
+        assert hsv_wizard.open_preview(path) == (None, (20, 10))
+
+    def test_loader_reports_done(self, tmp_path):
+        path = tmp_path / 'image.png'
+        Image.new('RGB', (20, 10), (0, 255, 0)).save(path)
+        messages = self._messages(hsv_wizard.ImageLoader(str(path)))
+        kind, rgb, hsv, _ = messages[-1]
+        assert kind == 'done'
+        assert rgb.shape == (10, 20, 3)
+        assert hsv[0, 0, 0] == 85
+
+    def test_loader_uses_cache(self, tmp_path):
+        path = tmp_path / 'image.png'
+        Image.new('RGB', (20, 10), (0, 255, 0)).save(path)
+        cache = hsv_wizard.ImageCache(str(tmp_path / 'cache'))
+        self._messages(hsv_wizard.ImageLoader(str(path), cache))
+        messages = self._messages(hsv_wizard.ImageLoader(str(path), cache))
+        assert messages[-1][0] == 'done'
+        assert isinstance(messages[-1][1], np.memmap)
+        assert cache.stats()['hits'] == 1
+
+    def test_loader_cancel(self, tmp_path):
+        path = tmp_path / 'image.png'
+        Image.new('RGB', (20, 10)).save(path)
+        loader = hsv_wizard.ImageLoader(str(path))
+        loader.cancel()
+        assert self._messages(loader)[-1] == ('cancelled',)
+
+    def test_loader_error(self, tmp_path):
+        messages = self._messages(hsv_wizard.ImageLoader(str(tmp_path / 'missing.png')))
+        assert messages[-1][0] == 'error'
+
+
+# ─── Metadata Calibration Tests ───────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestMetadataCalibration:
+    """Tests for reading the pixel size from image headers."""
+
+    def _tiff(self, path, **tiffinfo):
+        Image.new('RGB', (8, 8)).save(path, tiffinfo={int(tag[3:]): value for tag, value in tiffinfo.items()})
+        return str(path)
+
+    def test_normalize_length_picks_readable_unit(self):
+        assert hsv_wizard.normalize_length(2.5e-9, 'm') == pytest.approx((2.5, 'nm'))
+        value, unit = hsv_wizard.normalize_length(0.5, 'micron')
+        assert (value, unit) == (pytest.approx(500), 'nm')
+        assert hsv_wizard.normalize_length(0.02, 'mm') == pytest.approx((20, 'µm'))
+        assert hsv_wizard.normalize_length(1, 'pixel') is None
+
+    def test_resolution_in_centimetres(self, tmp_path):
+        path = self._tiff(tmp_path / 'a.tif', tag282=20000.0, tag283=20000.0, tag296=3)
+        assert hsv_wizard.read_pixel_size(path) == {
+            'length_per_pixel': pytest.approx(500), 'units': 'nm', 'source': 'Resolution'}
+
+    def test_low_dpi_is_ignored(self, tmp_path):
+        path = tmp_path / 'a.tif'
+        Image.new('RGB', (8, 8)).save(path, dpi=(300, 300))
+        assert hsv_wizard.read_pixel_size(str(path)) is None
+        Image.new('RGB', (8, 8)).save(path, dpi=(25400, 25400))
+        assert hsv_wizard.read_pixel_size(str(path))['length_per_pixel'] == pytest.approx(1.0)
+
+    def test_imagej_description(self, tmp_path):
+        path = self._tiff(tmp_path / 'a.tif', tag270='ImageJ=1.53t\nunit=micron\n',
+                          tag282=4.0, tag283=4.0, tag296=1)
+        calibration = hsv_wizard.read_pixel_size(path)
+        assert calibration['source'] == 'ImageJ'
+        assert calibration['length_per_pixel'] == pytest.approx(250)
+        assert calibration['units'] == 'nm'
+
+    def test_ome_description(self, tmp_path):
+        description = '<?xml version="1.0"?><OME><Image><Pixels PhysicalSizeX="0.325" PhysicalSizeY="0.325"/></Image></OME>'
+        calibration = hsv_wizard.read_pixel_size(self._tiff(tmp_path / 'a.tif', tag270=description))
+        assert calibration == {'length_per_pixel': pytest.approx(325), 'units': 'nm', 'source': 'OME-XML'}
+
+    def test_vendor_tags_take_precedence(self, tmp_path):
+        path = self._tiff(tmp_path / 'fei.tif', tag34682='[Scan]\r\nPixelWidth=4.5e-009\r\n',
+                          tag282=100.0, tag283=100.0, tag296=3)
+        assert hsv_wizard.read_pixel_size(path) == {
+            'length_per_pixel': pytest.approx(4.5), 'units': 'nm', 'source': 'FEI'}
+        path = self._tiff(tmp_path / 'zeiss.tif', tag34118='AP_PIXEL_SIZE\r\nImage Pixel Size = 2.233 nm\r\n')
+        assert hsv_wizard.read_pixel_size(path)['length_per_pixel'] == pytest.approx(2.233)
+
+    def test_header_is_read_without_decoding(self, tmp_path, monkeypatch):
+        path = self._tiff(tmp_path / 'a.tif', tag282=20000.0, tag283=20000.0, tag296=3)
+        monkeypatch.setattr(Image.Image, 'load', lambda self: pytest.fail('pixels decoded'))
+        assert hsv_wizard.read_pixel_size(path) is not None
+
+    def test_cache_skips_unchanged_files(self, tmp_path, monkeypatch):
+        paths = [self._tiff(tmp_path / f'{i}.tif', tag282=1000.0 * (i + 1), tag296=3) for i in range(3)]
+        paths.append(str(tmp_path / 'missing.tif'))
+        cache = hsv_wizard.MetadataCache(str(tmp_path / 'cache' / 'metadata.json'))
+        results = hsv_wizard.calibrate_files(paths, cache)
+        assert results[paths[1]]['length_per_pixel'] == pytest.approx(5)
+        assert results[paths[3]] is None
+
+        monkeypatch.setattr(hsv_wizard, 'read_pixel_size', lambda path: pytest.fail('header reread'))
+        cache = hsv_wizard.MetadataCache(str(tmp_path / 'cache' / 'metadata.json'))
+        assert hsv_wizard.calibrate_files(paths[:3], cache) == {path: results[path] for path in paths[:3]}
+
+    def test_loader_reports_calibration(self, tmp_path):
+        path = self._tiff(tmp_path / 'a.tif', tag282=20000.0, tag283=20000.0, tag296=3)
+        loader = hsv_wizard.ImageLoader(path, metadata=hsv_wizard.MetadataCache(str(tmp_path / 'm.json')))
+        loader.run()
+        assert loader.messages.get_nowait() == ('calibration', hsv_wizard.read_pixel_size(path))
+
+    def test_malformed_vendor_tag_falls_back(self, tmp_path):
+        path = self._tiff(tmp_path / 'fei.tif', tag34682='[Scan]\r\nPixelWidth=-\r\n',
+                          tag282=20000.0, tag283=20000.0, tag296=3)
+        assert hsv_wizard.read_pixel_size(path)['source'] == 'Resolution'
+
+    def test_calibration_failure_does_not_block_loading(self, tmp_path):
+        class BrokenMetadata:
+            def get(self, path):
+                raise ValueError("could not convert string to float: '-'")
+
+            def save(self):
+                pass
+
+        path = self._tiff(tmp_path / 'a.tif')
+        loader = hsv_wizard.ImageLoader(path, metadata=BrokenMetadata())
+        loader.run()
+        messages = []
+        while not loader.messages.empty():
+            messages.append(loader.messages.get_nowait())
+        assert messages[0] == ('calibration', None)
+        assert messages[-1][0] == 'done'
+
+
+# ─── Display Tile Tests ───────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestDisplayTiles:
+    """Tests for display tile geometry and the rendered tile cache."""
+
+    def test_visible_tiles_clipped_to_image(self):
+        tiles = hsv_wizard.visible_tiles(1.0, (600, 300), (0, 0, 1000, 1000), tile_size=256)
+        assert tiles == [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]
+
+    def test_visible_tiles_follow_viewport(self):
+        tiles = hsv_wizard.visible_tiles(2.0, (1000, 1000), (300, 600, 200, 200), tile_size=256)
+        assert tiles == [(1, 2), (1, 3)]
+
+    def test_tile_geometry_covers_image_exactly(self):
+        zoom, size = 0.7, (1000, 500)
+        covered = 0
+        for tx, ty in hsv_wizard.visible_tiles(zoom, size, (0, 0, 10 ** 4, 10 ** 4), tile_size=256):
+            (width, height), box = hsv_wizard.tile_geometry(tx, ty, zoom, size, tile_size=256)
+            assert box[2] - box[0] == pytest.approx(width / zoom)
+            covered += width * height
+        assert covered == int(1000 * zoom) * int(500 * zoom)
+
+    def test_zoom_anchor_keeps_point_under_cursor(self):
+        # Viewport starts at canvas x=200, cursor at widget x=300 -> image x=1000 at zoom 0.5
+        origin = hsv_wizard.zoom_anchor_origin(500, 300, 0.5, 0.8)
+        assert (origin + 300) / 0.8 == pytest.approx(1000)
+
+    def test_zoom_anchor_at_origin_is_identity(self):
+        assert hsv_wizard.zoom_anchor_origin(0, 0, 1.0, 2.0) == 0
+
+    def test_cache_evicts_least_recently_used(self):
+        tile = Image.new('RGB', (10, 10))
+        cache = hsv_wizard.TileCache(max_bytes=2 * 10 * 10 * 7)
+        cache.put((1.0, 0, 0, 1), tile)
+        cache.put((1.0, 1, 0, 1), tile)
+        assert cache.get((1.0, 0, 0, 1)) is not None
+        cache.put((1.0, 2, 0, 1), tile)
+        assert cache.get((1.0, 1, 0, 1)) is None
+        assert cache.get((1.0, 0, 0, 1)) is not None
+        assert len(cache) == 2
+        assert cache.nbytes == 2 * 10 * 10 * 7
+
+    def test_new_version_misses(self):
+        cache = hsv_wizard.TileCache()
+        cache.put((1.0, 0, 0, 1), Image.new('RGB', (4, 4)))
+        assert cache.get((1.0, 0, 0, 2)) is None
+        assert cache.hits == 0
+        assert cache.misses == 1
+
+
+# ─── Memory Budget Tests ──────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestBufferRegistry:
+    """Tests for memory accounting and budget enforcement."""
+
+    def test_memory_mapped_arrays_are_not_resident(self, tmp_path):
+        np.save(tmp_path / 'a.npy', np.zeros(100, dtype=np.uint8))
+        mapped = np.load(tmp_path / 'a.npy', mmap_mode='r')
+        assert hsv_wizard.array_footprint(np.zeros(10), mapped, None) == (80, 100)
+
+    def test_enforce_evicts_by_priority_until_within_budget(self):
+        caches = {'tiles': 600, 'labels': 300, 'mask': 300}
+        registry = hsv_wizard.BufferRegistry(budget_bytes=1000)
+        registry.register('image', lambda: 500)
+        for priority, name in enumerate(caches):
+            registry.register(name, lambda name=name: caches[name],
+                              lambda name=name: caches.__setitem__(name, 0), priority=priority)
+        assert registry.total() == (1700, 0)
+        assert registry.enforce() == ['tiles', 'labels']
+        assert registry.total()[0] == 800
+        assert caches['mask'] == 300
+        assert registry.evictions == 2
+
+    def test_required_buffers_are_never_evicted(self):
+        registry = hsv_wizard.BufferRegistry(budget_bytes=10)
+        registry.register('image', lambda: 500)
+        assert registry.enforce() == []
+
+    def test_buffers_in_use_are_kept(self):
+        caches = {'tiles': 100, 'mask': 300}
+        registry = hsv_wizard.BufferRegistry(budget_bytes=200)
+        registry.register('image', lambda: 500)
+        registry.register('tiles', lambda: caches['tiles'], lambda: caches.__setitem__('tiles', 0))
+        registry.register('mask', lambda: caches['mask'], lambda: caches.__setitem__('mask', 0),
+                          priority=1, in_use=lambda: True)
+        assert registry.enforce() == ['tiles']
+        assert caches['mask'] == 300
+        assert registry.over_budget
+        assert 'in use' in registry.dump()
+
+    def test_enforce_only_runs_after_a_change(self):
+        caches = {'tiles': 100}
+        evictions = []
+        registry = hsv_wizard.BufferRegistry(budget_bytes=200)
+        registry.register('image', lambda: 500)
+        registry.register('tiles', lambda: caches['tiles'],
+                          lambda: evictions.append(caches.__setitem__('tiles', 0)))
+        registry.enforce()
+        for _ in range(3):
+            assert registry.enforce() == []
+        assert len(evictions) == 1
+        caches['tiles'] = 50
+        assert registry.enforce() == ['tiles']
+        registry.budget_bytes = 1000
+        assert registry.enforce() == []
+        assert not registry.over_budget
+
+    def test_tile_cache_retain(self):
+        cache = hsv_wizard.TileCache()
+        for key in ('a', 'b', 'c'):
+            cache.put(key, Image.new('RGB', (4, 4)))
+        cache.retain({'b'})
+        assert len(cache) == 1
+        assert cache.peek('b') is not None
+        assert cache.nbytes == 4 * 4 * 7
+
+    def test_dump_lists_buffers(self):
+        registry = hsv_wizard.BufferRegistry(budget_bytes=2 * 1024 ** 3)
+        registry.register('Image RGB', lambda: (3 * 1024 ** 2, 0))
+        registry.register('Display tiles', lambda: 0, lambda: None)
+        dump = registry.dump()
+        assert 'Image RGB' in dump
+        assert '3.0 MB' in dump
+        assert 'Budget: 2.00 GB' in dump
+
+    def test_format_bytes(self):
+        assert hsv_wizard.format_bytes(512) == '512 B'
+        assert hsv_wizard.format_bytes(1536) == '1.5 KB'
+        assert hsv_wizard.format_bytes(5 * 1024 ** 3) == '5.00 GB'
+
+
+# ─── Mask Clean-up Tests ──────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestPostProcessing:
+    """Tests for morphological clean-up of threshold masks."""
+
+    def _random_mask(self, shape=(60, 50), density=0.6, seed=1):
+        return np.random.default_rng(seed).random(shape) > density
+
+    def _naive(self, mask, radius, combine, border):
+        padded = np.pad(mask, radius, constant_values=border)
+        out = np.full(mask.shape, border)
+        for dy in range(2 * radius + 1):
+            for dx in range(2 * radius + 1):
+                out = combine(out, padded[dy:dy + mask.shape[0], dx:dx + mask.shape[1]])
+        return out
+
+    @pytest.mark.parametrize('radius', [1, 2, 3])
+    def test_separable_erosion_and_dilation_match_naive(self, radius):
+        mask = self._random_mask()
+        np.testing.assert_array_equal(hsv_wizard.erode_mask(mask, radius),
+                                      self._naive(mask, radius, np.logical_and, True))
+        np.testing.assert_array_equal(hsv_wizard.dilate_mask(mask, radius),
+                                      self._naive(mask, radius, np.logical_or, False))
+
+    def test_opening_removes_specks(self):
+        mask = np.zeros((20, 20), dtype=bool)
+        mask[5:12, 5:12] = True
+        mask[2, 17] = True
+        opened = hsv_wizard.PostProcessing(open_radius=1).apply(mask)
+        assert not opened[2, 17]
+        np.testing.assert_array_equal(opened[5:12, 5:12], True)
+
+    def test_fill_holes(self):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[2:8, 2:8] = True
+        mask[4:6, 4:6] = False
+        mask[0:3, 0] = False
+        filled = hsv_wizard.fill_holes(mask)
+        np.testing.assert_array_equal(filled[2:8, 2:8], True)
+        assert filled.sum() == 36
+
+    def test_border_background_is_not_a_hole(self):
+        mask = np.ones((5, 5), dtype=bool)
+        mask[2, 0:2] = False
+        np.testing.assert_array_equal(hsv_wizard.fill_holes(mask), mask)
+
+    def test_remove_small_objects(self):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[1, 1] = True
+        mask[0, 8:10] = True
+        mask[5:8, 5:8] = True
+        cleaned = hsv_wizard.remove_small_objects(mask, 4)
+        assert cleaned.sum() == 9
+        kept = hsv_wizard.remove_small_objects(mask, 4, keep_border_objects=True)
+        assert kept.sum() == 11
+
+    def test_strips_match_whole_mask(self):
+        mask = self._random_mask((200, 70))
+        params = hsv_wizard.PostProcessing(open_radius=2, close_radius=3, fill_holes=True, min_size=15)
+        rle = hsv_wizard.RunLengthMask.from_mask(mask)
+        np.testing.assert_array_equal(params.apply_in_strips(rle, strip_rows=23).to_mask(), params.apply(mask))
+
+    def test_inactive_by_default(self):
+        assert not hsv_wizard.PostProcessing().is_active()
+        assert not hsv_wizard.PostProcessing(min_size=1).is_active()
+        assert hsv_wizard.PostProcessing(fill_holes=True).is_active()
+
+    def test_round_trip(self):
+        params = hsv_wizard.PostProcessing(1, 2, True, 30)
+        assert hsv_wizard.PostProcessing.from_dict(params.to_dict()).key() == params.key()
+
+
+# ─── Run-Length Mask Tests ────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestRunLengthMask:
+    """Tests for the run-length encoded mask type."""
+
+    def _masks(self, seed, shape=(13, 17)):
+        rng = np.random.default_rng(seed)
+        return rng.random(shape) > rng.random(), rng.random(shape) > rng.random()
+
+    @pytest.mark.parametrize('seed', range(5))
+    def test_set_operations_match_dense(self, seed):
+        a, b = self._masks(seed)
+        rle_a, rle_b = hsv_wizard.RunLengthMask.from_mask(a), hsv_wizard.RunLengthMask.from_mask(b)
+        np.testing.assert_array_equal((rle_a | rle_b).to_mask(), a | b)
+        np.testing.assert_array_equal((rle_a & rle_b).to_mask(), a & b)
+        np.testing.assert_array_equal(rle_a.complement().to_mask(), ~a)
+        assert rle_a.area == a.sum()
+
+    def test_union_merges_touching_runs(self):
+        a = np.zeros((2, 6), dtype=bool)
+        b = np.zeros((2, 6), dtype=bool)
+        a[0, 0:3] = True
+        b[0, 3:6] = True
+        b[1, 0] = True
+        union = hsv_wizard.RunLengthMask.from_mask(a) | hsv_wizard.RunLengthMask.from_mask(b)
+        assert union.starts.tolist() == [0, 0]
+        assert union.ends.tolist() == [6, 1]
+
+    @pytest.mark.parametrize('step', [1, 2, 3])
+    def test_rasterize_box(self, step):
+        a, _ = self._masks(7, shape=(30, 40))
+        rle = hsv_wizard.RunLengthMask.from_mask(a)
+        np.testing.assert_array_equal(rle.rasterize((5, 3, 33, 27), step), a[3:27:step, 5:33:step])
+
+    def test_bbox(self):
+        mask = np.zeros((10, 12), dtype=bool)
+        mask[2:5, 3:9] = True
+        mask[7, 1] = True
+        assert hsv_wizard.RunLengthMask.from_mask(mask).bbox() == (1, 2, 9, 8)
+        assert hsv_wizard.RunLengthMask.from_mask(np.zeros((3, 3), bool)).bbox() is None
+
+    def test_sparse_selection_is_compact(self):
+        mask = np.zeros((1000, 1000), dtype=bool)
+        mask[100:140, 200:260] = True
+        assert hsv_wizard.RunLengthMask.from_mask(mask).nbytes * 100 < mask.nbytes
+
+    def test_threshold_runs_match_dense_mask(self):
+        hsv = np.random.default_rng(4).integers(0, 256, (45, 20, 3), dtype=np.uint8)
+        window = (300, 40, 10, 90, 20, 100)
+        runs = hsv_wizard.compute_hsv_runs(hsv, *window, strip_rows=8)
+        np.testing.assert_array_equal(runs.to_mask(), hsv_wizard.compute_hsv_mask(hsv, *window))
+
+    @pytest.mark.parametrize('mode', ['mask', 'tint', 'outline', 'dim'])
+    def test_strip_composite_matches_dense(self, mode):
+        rng = np.random.default_rng(5)
+        rgb = rng.integers(0, 256, (40, 12, 3), dtype=np.uint8)
+        mask, _ = self._masks(5, shape=(40, 12))
+        rle = hsv_wizard.RunLengthMask.from_mask(mask)
+        np.testing.assert_array_equal(hsv_wizard.composite_runs(rgb, rle, mode, strip_rows=7),
+                                      hsv_wizard.composite_mask(rgb, mask, mode))
+
+    def test_measure_features_accepts_runs(self):
+        mask = np.zeros((30, 40), dtype=bool)
+        mask[5:8, 5:35] = True
+        mask[15:25, 10:13] = True
+        dense = hsv_wizard.measure_features(mask)
+        runs = hsv_wizard.measure_features(hsv_wizard.RunLengthMask.from_mask(mask))
+        for key in ('area', 'skeleton_length', 'feret_max', 'feret_min'):
+            np.testing.assert_allclose(runs[key], dense[key])
+
+
+# ─── Region of Interest Tests ─────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestRegionsOfInterest:
+    """Tests for ROI rasterization, ROI-restricted thresholding and ROI files."""
+
+    def test_rectangle_covers_its_box(self):
+        roi = hsv_wizard.ROI('rectangle', [(12.4, 3), (2, 8.5)])
+        assert roi.bbox((20, 10)) == (2, 3, 13, 9)
+        runs = roi.runs((20, 10))
+        expected = np.zeros((10, 20), dtype=bool)
+        expected[3:9, 2:13] = True
+        np.testing.assert_array_equal(runs.to_mask(), expected)
+
+    def test_polygon_is_clipped_to_image(self):
+        roi = hsv_wizard.ROI('polygon', [(-5, -5), (15, -5), (-5, 15)])
+        assert roi.bbox((10, 10)) == (0, 0, 10, 10)
+        mask = roi.runs((10, 10)).to_mask()
+        assert mask[0, 0] and mask[0, 9] and mask[9, 0]
+        assert not mask[9, 9]
+
+    def test_rasterized_once_per_image_size(self):
+        roi = hsv_wizard.ROI('freehand', [(1, 1), (8, 2), (5, 9)])
+        assert roi.runs((10, 10)) is roi.runs((10, 10))
+        assert roi.runs((20, 20)).shape == (20, 20)
+
+    def test_invalid_roi(self):
+        with pytest.raises(ValueError):
+            hsv_wizard.ROI('circle', [(0, 0), (1, 1)])
+        with pytest.raises(ValueError):
+            hsv_wizard.ROI('polygon', [(0, 0), (1, 1)])
+
+    def test_roi_threshold_matches_clipped_full_threshold(self):
+        hsv = np.random.default_rng(6).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+        window = (0, 180, 20, 100, 10, 90)
+        rois = [hsv_wizard.ROI('rectangle', [(5, 5), (25, 20)]),
+                hsv_wizard.ROI('polygon', [(20, 10), (45, 15), (30, 38)])]
+        runs = hsv_wizard.compute_roi_runs(hsv, rois, *window)
+        region = hsv_wizard.roi_union(rois, (50, 40)).to_mask()
+        np.testing.assert_array_equal(runs.to_mask(), hsv_wizard.compute_hsv_mask(hsv, *window) & region)
+
+    def test_roi_statistics(self, tmp_path):
+        mask = np.zeros((20, 20), dtype=bool)
+        mask[:, :10] = True
+        rois = [hsv_wizard.ROI('rectangle', [(0, 0), (10, 10)], name='Left'),
+                hsv_wizard.ROI('rectangle', [(5, 10), (15, 20)])]
+        stats = hsv_wizard.roi_statistics(hsv_wizard.RunLengthMask.from_mask(mask), rois, length_per_pixel=0.5)
+        assert [(row['name'], row['roi_pixels'], row['pixels']) for row in stats] == [
+            ('Left', 100, 100), ('ROI 2', 100, 50)]
+        assert stats[1]['fraction'] == 0.5
+        assert stats[1]['area'] == pytest.approx(12.5)
+        path = tmp_path / 'rois.csv'
+        hsv_wizard.write_roi_statistics_csv(str(path), stats, units='µm')
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert lines[0].endswith('Area (µm²)')
+        assert lines[2] == 'ROI 2,rectangle,100,50,0.500000,12.5'
+
+    def test_roi_file_round_trip(self, tmp_path):
+        rois = [hsv_wizard.ROI('rectangle', [(0, 0), (10, 10)], name='A'),
+                hsv_wizard.ROI('freehand', [(1, 2), (3, 4), (5, 1)])]
+        path = str(tmp_path / 'rois.json')
+        hsv_wizard.write_roi_file(path, rois)
+        loaded = hsv_wizard.read_roi_file(path)
+        assert [(roi.name, roi.key()) for roi in loaded] == [(roi.name, roi.key()) for roi in rois]
+        assert hsv_wizard.roi_union([], (10, 10)) is None
+
+
+# ─── Results Database Tests ───────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestResultsDatabase:
+    """Tests for the SQLite results store and its single writer."""
+
+    def _record(self, name, fraction, sample='S1', features=None):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[:int(fraction * 10)] = True
+        phases = [('Ferrite', int(fraction * 100), fraction, None), ('Pearlite', 0, 0.0, None)]
+        measurements = [{'x0': 0.0, 'y0': 0.0, 'x1': 3.0, 'y1': 4.0, 'length': 5.0, 'angle': 53.1,
+                         'timestamp': 0.0, 'feret_min': math.nan, 'skeleton_length': math.nan,
+                         'area': math.nan, 'label': ''}]
+        return hsv_wizard.results_record(name, (0, 360, 0, 100, 0, 100), hsv_wizard.RunLengthMask.from_mask(mask),
+                                         length_per_pixel=0.5, units='µm', phases=phases,
+                                         measurements=measurements, features=features, sample=sample)
+
+    def test_round_trip_and_queries(self, tmp_path):
+        mask = np.zeros((20, 20), dtype=bool)
+        mask[2:5, 2:12] = True
+        features = hsv_wizard.measure_features(mask)
+        database = hsv_wizard.ResultsDatabase(str(tmp_path / 'results.sqlite'))
+        ids = database.add_results([self._record('a.png', 0.3, features=features), self._record('b.png', 0.7),
+                                    self._record('c.png', 0.9, sample='S2')])
+        assert len(ids) == 3
+        assert sorted(os.path.basename(path) for path, _ in
+                      database.images_with_phase_fraction('Ferrite', 0.5)) == ['b.png', 'c.png']
+        summary = database.sample_summary()
+        assert [row[:2] for row in summary] == [('S1', 2), ('S2', 1)]
+        assert summary[0][2] == pytest.approx(0.5)
+        assert database.sample_summary(phase='Ferrite')[1][2] == pytest.approx(0.9)
+        assert database.query('SELECT area FROM images WHERE id = ?', (ids[0],))[0][0] == pytest.approx(7.5)
+        assert database.query('SELECT length, feret_min FROM measurements WHERE image_id = ?', (ids[0],)) == [
+            (5.0, None)]
+        assert database.query('SELECT COUNT(*), SUM(area) FROM features')[0] == (1, 30)
+        assert database.query('SELECT COUNT(*) FROM rois') == [(0,)]
+        with pytest.raises(ValueError):
+            database.sample_summary(column='path; DROP TABLE images')
+        database.close()
+
+    def test_per_roi_results(self, tmp_path):
+        mask = hsv_wizard.RunLengthMask.from_mask(np.ones((10, 10), dtype=bool))
+        rois = [hsv_wizard.ROI('rectangle', [(0, 0), (5, 10)], name='left'),
+                hsv_wizard.ROI('rectangle', [(5, 0), (7, 10)])]
+        record = hsv_wizard.results_record('a.png', (0, 360, 0, 100, 0, 100), mask, length_per_pixel=0.5,
+                                           units='µm', rois=hsv_wizard.roi_statistics(mask, rois, 0.5))
+        database = hsv_wizard.ResultsDatabase(str(tmp_path / 'results.sqlite'))
+        image_id, = database.add_results([record])
+        assert database.query('SELECT name, pixels, fraction, area FROM rois WHERE image_id = ? ORDER BY name',
+                              (image_id,)) == [('ROI 2', 20, 1.0, 5.0), ('left', 50, 1.0, 12.5)]
+        database.close()
+
+    def test_phase_query_uses_index(self, tmp_path):
+        database = hsv_wizard.ResultsDatabase(str(tmp_path / 'results.sqlite'))
+        plan = database.query('EXPLAIN QUERY PLAN SELECT image_id FROM phases WHERE name = ? AND fraction > ?',
+                              ('Ferrite', 0.5))
+        assert any('phases_name_fraction' in row[-1] for row in plan)
+        database.close()
+
+    def test_writer_batches_records(self, tmp_path):
+        path = str(tmp_path / 'results.sqlite')
+        writer = hsv_wizard.ResultsWriter(path, batch_size=4, flush_interval=10)
+        writer.start()
+        for i in range(10):
+            writer.put(self._record(f'{i}.png', i / 10))
+        writer.close()
+        assert writer.error is None
+        assert writer.written == 10
+        database = hsv_wizard.ResultsDatabase(path)
+        assert database.query('SELECT COUNT(*) FROM phases')[0][0] == 20
+        database.close()
+
+    def test_writer_reports_malformed_record(self, tmp_path):
+        writer = hsv_wizard.ResultsWriter(str(tmp_path / 'results.sqlite'), flush_interval=0)
+        writer.start()
+        writer.put({'path': 'a.png'})
+        writer.join(10)
+        assert not writer.is_alive()
+        assert isinstance(writer.error, KeyError)
+        assert writer.written == 0
+
+
+# ─── Watch Folder Tests ───────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestWatchFolder:
+    """Tests for watch mode: complete-file detection and headless processing."""
+
+    def test_files_are_reported_once_they_stop_changing(self, tmp_path):
+        now = [0.0]
+        (tmp_path / 'old.png').write_bytes(b'x')
+        watcher = hsv_wizard.FolderWatcher(str(tmp_path), settle_time=2.0, clock=lambda: now[0])
+        path = tmp_path / 'new.tif'
+        path.write_bytes(b'12')
+        (tmp_path / 'notes.txt').write_bytes(b'x')
+        assert watcher.poll() == []
+        now[0] = 1.0
+        path.write_bytes(b'1234')
+        assert watcher.poll() == []
+        now[0] = 2.5
+        assert watcher.poll() == []
+        now[0] = 3.0
+        assert watcher.poll() == [str(path)]
+        now[0] = 10.0
+        assert watcher.poll() == []
+
+    def test_existing_and_empty_files(self, tmp_path):
+        (tmp_path / 'old.png').write_bytes(b'x')
+        (tmp_path / 'empty.png').write_bytes(b'')
+        watcher = hsv_wizard.FolderWatcher(str(tmp_path), settle_time=0, include_existing=True)
+        watcher.poll()
+        assert watcher.poll() == [str(tmp_path / 'old.png')]
+
+    def _settings(self, **overrides):
+        settings = {'preset': 'test', 'thresholds': (0, 60, 50, 100, 50, 100), 'postprocessing': {}, 'rois': [],
+                    'phase_classes': [], 'calibration': None, 'display_mode': 'mask'}
+        settings.update(overrides)
+        return settings
+
+    def test_process_image_file(self, tmp_path):
+        image = np.zeros((10, 20, 3), dtype=np.uint8)
+        image[:, :5] = (255, 0, 0)
+        path = tmp_path / 'a.tif'
+        Image.fromarray(image).save(path, tiffinfo={282: 10000.0, 296: 3})
+        hsv_wizard._init_watch_worker(self._settings(
+            rois=[hsv_wizard.ROI('rectangle', [(0, 0), (10, 5)]).to_dict()]))
+        record, seconds = hsv_wizard.process_image_file(str(path), str(tmp_path))
+        assert record['selected_pixels'] == 25
+        assert record['length_per_pixel'] == pytest.approx(1.0)
+        assert record['units'] == 'µm'
+        assert record['preset'] == 'test'
+        assert [(row['name'], row['pixels'], row['area']) for row in record['rois']] == [
+            ('ROI 1', 25, pytest.approx(25.0))]
+        assert seconds >= 0
+        assert np.asarray(Image.open(tmp_path / 'a_mask.png'))[0, 0].tolist() == [255, 0, 0]
+
+    def test_unreadable_calibration_is_skipped(self, tmp_path, monkeypatch):
+        path = tmp_path / 'a.png'
+        Image.new('RGB', (8, 8), (255, 0, 0)).save(path)
+
+        def broken(path):
+            raise ValueError("could not convert string to float: '-'")
+
+        monkeypatch.setattr(hsv_wizard, 'read_pixel_size', broken)
+        hsv_wizard._init_watch_worker(self._settings())
+        record, _ = hsv_wizard.process_image_file(str(path))
+        assert record['selected_pixels'] == 64
+        assert record['length_per_pixel'] is None
+
+    def test_watch_folder_writes_results(self, tmp_path):
+        incoming = tmp_path / 'incoming'
+        incoming.mkdir()
+        results = str(tmp_path / 'results.sqlite')
+        stop = hsv_wizard.threading.Event()
+        counts = {}
+        thread = hsv_wizard.threading.Thread(target=lambda: counts.update(hsv_wizard.watch_folder(
+            str(incoming), self._settings(), results, workers=1, poll_interval=0.05, settle_time=0.1,
+            include_existing=True, stop=stop)))
+        thread.start()
+        try:
+            Image.new('RGB', (8, 8), (255, 0, 0)).save(incoming / 'a.png')
+            deadline = hsv_wizard.time.monotonic() + 20
+            while not os.path.exists(results) or hsv_wizard.ResultsDatabase(results).query(
+                    'SELECT COUNT(*) FROM images')[0][0] == 0:
+                assert hsv_wizard.time.monotonic() < deadline
+                hsv_wizard.time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        assert counts == {'processed': 1, 'failed': 0}
+        assert hsv_wizard.ResultsDatabase(results).query('SELECT coverage FROM images') == [(1.0,)]
+
+    def test_writer_failure_stops_watching(self, tmp_path):
+        incoming = tmp_path / 'incoming'
+        incoming.mkdir()
+        # A directory cannot be opened as the results database
+        with pytest.raises(RuntimeError, match='Results writer stopped'):
+            hsv_wizard.watch_folder(str(incoming), self._settings(), str(tmp_path), workers=1,
+                                    poll_interval=0.05, stop=hsv_wizard.threading.Event())
+
+
+# ─── Threshold Suggestion Tests ───────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestThresholdSuggestions:
+    """Tests for histogram-based coverage evaluation and threshold candidates."""
+
+    def _image(self):
+        rng = np.random.default_rng(8)
+        hsv = np.empty((80, 100, 3), dtype=np.uint8)
+        hsv[..., 0] = np.where(np.arange(80)[:, None] < 30, 20, 150) + rng.integers(-4, 5, (80, 100))
+        hsv[..., 1] = rng.integers(100, 256, (80, 100))
+        hsv[..., 2] = rng.integers(0, 256, (80, 100))
+        return hsv
+
+    @pytest.mark.parametrize('window', [
+        (0, 360, 0, 100, 0, 100), (0, 360, 45, 100, 0, 100), (300, 40, 0, 100, 0, 100), (10, 60, 0, 100, 0, 100)])
+    def test_single_channel_windows_are_exact(self, window):
+        hsv = self._image()
+        histogram = hsv_wizard.HSVHistogram(hsv, bins=16)
+        assert histogram.coverage(*window) == pytest.approx(hsv_wizard.compute_hsv_mask(hsv, *window).mean())
+
+    def test_combined_windows_are_close(self):
+        hsv = np.random.default_rng(9).integers(0, 256, (120, 150, 3), dtype=np.uint8)
+        histogram = hsv_wizard.HSVHistogram(hsv)
+        for window in [(20, 200, 10, 90, 30, 70), (300, 40, 10, 90, 0, 100), (0, 360, 60, 50, 0, 100)]:
+            assert histogram.coverage(*window) == pytest.approx(
+                hsv_wizard.compute_hsv_mask(hsv, *window).mean(), abs=0.002)
+
+    def test_coverage_curve_is_vectorised(self):
+        hsv = self._image()
+        histogram = hsv_wizard.HSVHistogram(hsv)
+        values = np.linspace(0, 100, 11)
+        curve = histogram.coverage_curve((0, 360, 0, 100, 0, 100), 'val_low', values)
+        assert curve.shape == (11,)
+        for value, coverage in zip(values, curve):
+            assert coverage == pytest.approx(hsv_wizard.compute_hsv_mask(hsv, 0, 360, 0, 100, value, 100).mean())
+
+    def test_otsu_splits_modes(self):
+        histogram = np.zeros(256)
+        histogram[10:20] = histogram[100:110] = histogram[200:210] = 5
+        assert hsv_wizard.otsu_thresholds(histogram[:150]) == [19]
+        assert hsv_wizard.otsu_thresholds(histogram, classes=3) == [19, 109]
+
+    def test_histogram_peaks_wrap_around(self):
+        histogram = np.zeros(256)
+        histogram[250:] = histogram[:6] = histogram[100:110] = 5
+        histogram[103] = 3
+        assert hsv_wizard.histogram_peaks(histogram, circular=True) == [(100, 100, 109), (250, 250, 5)]
+        assert hsv_wizard.histogram_peaks(histogram) == [(0, 0, 5), (100, 100, 109), (250, 250, 255)]
+
+    def test_suggestions_find_the_hue_modes(self):
+        hsv = self._image()
+        histogram = hsv_wizard.HSVHistogram(hsv)
+        candidates = hsv_wizard.suggest_thresholds(histogram, (0, 360, 0, 100, 0, 100))
+        modes = {c['name']: c for c in candidates if c['name'].startswith('Hue mode')}
+        assert len(modes) == 2
+        for candidate in modes.values():
+            assert candidate['coverage'] == pytest.approx(
+                hsv_wizard.compute_hsv_mask(hsv, *candidate['window']).mean())
+        assert sorted(round(c['coverage'], 3) for c in modes.values()) == [0.375, 0.625]
+        assert all(c['coverage'] < 1 for c in candidates)
+
+    def test_stable_bound_finds_plateau(self):
+        values = np.linspace(0, 100, 101)
+        coverage = np.interp(values, [0, 30, 40, 60, 70, 100], [1.0, 0.8, 0.5, 0.5, 0.2, 0.0])
+        assert 40 <= hsv_wizard.stable_bound(values, coverage) <= 60
+        assert hsv_wizard.stable_bound(values, np.ones(101)) is None
+
+
+# ─── Local Thickness Tests ────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestLocalThickness:
+    """Tests for the distance transform and local thickness maps."""
+
+    def test_distance_transform_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for height, width in [(1, 1), (1, 17), (23, 1), (19, 31)]:
+            mask = rng.random((height, width)) < 0.7
+            mask[0, 0] = False
+            ys, xs = np.nonzero(~mask)
+            grid_y, grid_x = np.mgrid[:height, :width]
+            expected = np.sqrt(((grid_y[..., None] - ys) ** 2 + (grid_x[..., None] - xs) ** 2).min(axis=-1))
+            np.testing.assert_allclose(hsv_wizard.distance_transform(mask), expected, rtol=1e-6)
+
+    def test_distance_transform_without_background(self):
+        assert np.isinf(hsv_wizard.distance_transform(np.ones((4, 5), dtype=bool))).all()
+
+    def test_band_thickness(self):
+        mask = np.zeros((40, 60), dtype=bool)
+        mask[10:17, 5:55] = True
+        thickness = hsv_wizard.local_thickness(mask)
+        assert (thickness[~mask] == 0).all()
+        # Away from the rounded-off ends, a band 7 pixels wide measures 7
+        assert (thickness[10:17, 10:50] == 7).all()
+
+    def test_background_stays_zero(self):
+        # Overlapping discs of non-integer radius, where rounded distances used to reach the background
+        rng = np.random.default_rng(0)
+        grid_y, grid_x = np.mgrid[:120, :120]
+        mask = np.zeros((120, 120), dtype=bool)
+        for cy, cx, radius in zip(rng.integers(0, 120, 8), rng.integers(0, 120, 8), rng.uniform(3, 30, 8)):
+            mask |= (grid_y - cy) ** 2 + (grid_x - cx) ** 2 < radius ** 2
+        thickness = hsv_wizard.local_thickness(mask)
+        assert (thickness[~mask] == 0).all()
+        assert (thickness[mask] > 0).all()
+        capped = hsv_wizard.local_thickness(mask, max_radius=4.5)
+        assert (capped[~mask] == 0).all()
+
+    def test_thickness_is_capped(self):
+        mask = np.zeros((60, 60), dtype=bool)
+        mask[5:55, 5:55] = True
+        thickness = hsv_wizard.local_thickness(mask, max_radius=4)
+        assert thickness.max() == 7
+        assert (thickness[mask] > 0).all()
+
+    def test_tiled_matches_dense(self):
+        rng = np.random.default_rng(1)
+        mask = hsv_wizard.dilate_mask(rng.random((150, 170)) < 0.01, 4)
+        dense = hsv_wizard.local_thickness(mask, max_radius=6)
+        tiled = hsv_wizard.local_thickness_tiled(hsv_wizard.RunLengthMask.from_mask(mask), 6, tile_size=37)
+        np.testing.assert_array_equal(tiled, dense)
+
+    def test_histogram_in_calibrated_units(self, tmp_path):
+        thickness = np.zeros((10, 10), dtype=np.float32)
+        thickness[:2] = 3
+        thickness[2:4] = 5
+        histogram = hsv_wizard.thickness_histogram(thickness, bins=5, length_per_pixel=0.5, strip_rows=3)
+        assert histogram['pixels'] == 40
+        assert histogram['counts'].sum() == 40
+        assert histogram['mean'] == pytest.approx(2.0)
+        assert histogram['std'] == pytest.approx(0.5)
+        assert histogram['max'] == pytest.approx(2.5)
+        path = tmp_path / 'thickness.csv'
+        hsv_wizard.write_thickness_csv(path, histogram, 'µm')
+        assert path.read_text(encoding='utf-8').splitlines()[0].startswith('Thickness From (µm)')
+
+
+# ─── Interaction Replay Tests ─────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestInteractionReplay:
+    """Tests for interaction recording and the latency report of replays."""
+
+    @staticmethod
+    def _app():
+        # The decorator is applied here, not at import, so the file collects without the module
+        class App:
+            def __init__(self):
+                self.recorder = None
+                self.calls = []
+                self.sat_low_scale = type('Scale', (), {'get': lambda self: 20})()
+                self.sat_high_scale = type('Scale', (), {'get': lambda self: 80})()
+
+            @hsv_wizard.recorded
+            def update_saturation(self, val):
+                self.calls.append(val)
+
+            @hsv_wizard.recorded
+            def on_drag(self, event):
+                self.calls.append((event.x, event.y))
+
+        return App()
+
+    def test_recorded_handlers(self, tmp_path):
+        app = self._app()
+        app.update_saturation('20')
+        clock = iter([0.0, 0.5, 0.75]).__next__
+        recorder = hsv_wizard.InteractionRecorder.__new__(hsv_wizard.InteractionRecorder)
+        recorder.clock, recorder.start, recorder.events, recorder.initial = clock, clock(), [], {}
+        app.recorder = recorder
+        app.update_saturation('20')
+        app.on_drag(hsv_wizard.ReplayEvent(x=3, y=4))
+        assert app.calls == ['20', '20', (3, 4)]
+        assert recorder.events == [
+            {'t': 0.5, 'handler': 'update_saturation', 'scales': {'sat_low_scale': 20, 'sat_high_scale': 80}},
+            {'t': 0.75, 'handler': 'on_drag', 'event': {'x': 3, 'y': 4, 'delta': 0, 'num': 0, 'state': 0}}]
+        path = tmp_path / 'session.json'
+        recorder.save(path)
+        assert hsv_wizard.read_interaction_script(path)['events'] == recorder.events
+
+    def test_latency_report(self):
+        latencies = [0.001] * 98 + [0.020, 0.050]
+        handlers = ['on_drag'] * 50 + ['update_hue'] * 50
+        report = hsv_wizard.latency_report(latencies, handlers, frame_ms=10)
+        assert report['count'] == 100
+        assert report['p50_ms'] == pytest.approx(1.0)
+        assert report['max_ms'] == pytest.approx(50.0)
+        assert report['p99_ms'] > report['p95_ms'] >= report['p50_ms']
+        # 20 ms drops one 10 ms frame, 50 ms drops four
+        assert report['dropped_frames'] == 5
+        assert report['handlers']['update_hue']['max_ms'] == pytest.approx(50.0)
+        assert report['handlers']['on_drag']['p99_ms'] == pytest.approx(1.0)
+        gaps = hsv_wizard.latency_report(latencies, gaps=[0.035], frame_ms=10)
+        assert gaps['dropped_frames'] == 3
+
+    def test_replay_waits_for_deferred_redraw(self):
+        class App:
+            def __init__(self):
+                self.now = 0.0
+                self._redraw_job = None
+                self.redraws = 0
+
+            def update(self):
+                # The coalesced redraw timer fires and renders for 20 ms
+                if self._redraw_job is not None:
+                    self._redraw_job = None
+                    self.now += 0.020
+                    self.redraws += 1
+
+            def update_idletasks(self):
+                pass
+
+            def on_drag(self, event):
+                self.now += 0.001
+                self._redraw_job = 'after#1'
+
+        app = App()
+        script = {'events': [{'t': 0.0, 'handler': 'on_drag', 'event': {'x': 1, 'y': 2}}]}
+        report = hsv_wizard.replay_interactions(app, script, realtime=False, settle=0, clock=lambda: app.now)
+        assert app.redraws == 1
+        assert report['p50_ms'] == pytest.approx(21.0)
+
+
+# ─── Measurement Overlay Tests ────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestMeasurementOverlay:
+    """Tests for the spatial index and viewport-limited drawing of measurements."""
+
+    class _Canvas:
+        def __init__(self):
+            self.items = {}
+            self.created = 0
+
+        def _create(self, coords):
+            self.created += 1
+            self.items[self.created] = list(coords)
+            return self.created
+
+        def create_line(self, *coords, **options):
+            return self._create(coords)
+
+        def create_text(self, *coords, **options):
+            return self._create(coords)
+
+        def coords(self, item_id, *coords):
+            if coords:
+                self.items[item_id] = list(coords)
+            return self.items[item_id]
+
+        def delete(self, item_id):
+            self.items.pop(item_id, None)
+
+    def test_index_query_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        index = hsv_wizard.OverlayIndex(cell_size=100)
+        boxes = {}
+        for key in range(300):
+            x, y = rng.random(2) * 2000
+            boxes[key] = (x, y, x + rng.normal() * 80, y + rng.normal() * 80)
+            index.insert(key, boxes[key])
+        for key in range(0, 300, 3):
+            index.remove(key)
+            del boxes[key]
+        for _ in range(20):
+            x0, y0 = rng.random(2) * 1800
+            query = (x0, y0, x0 + 300, y0 + 200)
+            expected = {key for key, (a, b, c, d) in boxes.items()
+                        if min(a, c) <= query[2] and max(a, c) >= query[0]
+                        and min(b, d) <= query[3] and max(b, d) >= query[1]}
+            assert index.query(query) == expected
+        assert len(index) == 200
+
+    def test_layer_realizes_only_visible_measurements(self):
+        store = hsv_wizard.MeasurementStore()
+        for i in range(100):
+            store.append(i * 100, 10, i * 100 + 20, 30, 20.0)
+        canvas = self._Canvas()
+        layer = hsv_wizard.MeasurementLayer(canvas, store)
+        layer.refresh(1.0, (0, 0, 500, 400), 'µm')
+        assert sorted(layer.items) == [0, 1, 2, 3, 4, 5]
+        assert len(canvas.items) == 12
+        layer.refresh(2.0, (0, 0, 250, 200), 'µm')
+        assert sorted(layer.items) == [0, 1, 2]
+        assert canvas.items[layer.items[1][0]] == [200.0, 20.0, 240.0, 60.0]
+        for _ in range(98):
+            store.pop()
+        layer.refresh(2.0, (0, 0, 250, 200), 'µm')
+        assert sorted(layer.items) == [0, 1]
+        assert len(canvas.items) == 4
+
+
+# ─── Undo History Tests ───────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestUndoHistory:
+    """Tests for the delta-based undo/redo history."""
+
+    class _Clock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def _history(self):
+        clock = self._Clock()
+        state = {'thresholds': (0, 360, 0, 100, 0, 100), 'measurements': ()}
+        return hsv_wizard.HistoryManager(state, clock=clock), clock
+
+    def test_slider_drag_is_one_entry(self):
+        history, clock = self._history()
+        for value in range(10, 60):
+            clock.now += 0.02
+            history.record('Thresholds', {'thresholds': (0, 360, value, 100, 0, 100)}, coalesce='thresholds')
+        assert len(history) == 1
+        # Only the changed tail of the thresholds is stored
+        assert history.entries[0]['delta']['thresholds'] == ('tail', 2, (0, 100, 0, 100), (59, 100, 0, 100))
+        clock.now += 5
+        history.record('Thresholds', {'thresholds': (0, 360, 59, 90, 0, 100)}, coalesce='thresholds')
+        assert len(history) == 2
+        assert history.undo(2)['thresholds'] == (0, 360, 0, 100, 0, 100)
+
+    def test_drag_back_to_start_leaves_no_entry(self):
+        history, clock = self._history()
+        for value in (10, 20, 0):
+            history.record('Thresholds', {'thresholds': (0, 360, value, 100, 0, 100)}, coalesce='thresholds')
+        assert len(history) == 0
+        assert not history.can_undo()
+
+    def test_jumps_and_redo_truncation(self):
+        history, clock = self._history()
+        rows = ()
+        for i in range(5):
+            rows += (((i, i, i + 1, i + 1, 1.0), ''),)
+            assert history.record('Measurement', {'measurements': rows})
+        assert history.labels() == ['Measurement'] * 5
+        assert history.undo(3)['measurements'] == rows[:2]
+        assert history.redo(2)['measurements'] == rows[:4]
+        assert history.undo(10)['measurements'] == ()
+        assert history.undo() is None
+        history.redo()
+        history.record('Thresholds', {'thresholds': (10, 20, 0, 100, 0, 100)})
+        assert not history.can_redo()
+        assert history.undo(2) == {'thresholds': (0, 360, 0, 100, 0, 100), 'measurements': ()}
+        # Unchanged values are not recorded
+        assert not history.record('Thresholds', {'thresholds': (0, 360, 0, 100, 0, 100)})
+
+    def test_phase_class_edits_are_undoable(self):
+        def state(classes, shown=False):
+            return {'phase_classes': tuple(phase.key() for phase in classes), 'show_classes': shown}
+
+        ferrite = hsv_wizard.PhaseClass('Ferrite', 350, 10, 20, 100, 0, 100, (255, 0, 0))
+        pearlite = hsv_wizard.PhaseClass('Pearlite', 100, 140, 0, 100, 0, 100, (0, 255, 0))
+        history = hsv_wizard.HistoryManager(state([]))
+        history.record('Phase classes', state([ferrite]))
+        history.record('Phase classes', state([ferrite, pearlite]))
+        history.record('Class overlay', state([ferrite, pearlite], shown=True))
+        pearlite.hue_low = 90
+        history.record('Phase classes', state([ferrite, pearlite], shown=True))
+        history.record('Phase classes', state([pearlite], shown=True))
+        assert len(history) == 5
+        restored = history.undo()
+        assert [hsv_wizard.PhaseClass.from_key(key).name for key in restored['phase_classes']] == [
+            'Ferrite', 'Pearlite']
+        restored = history.undo()
+        assert hsv_wizard.PhaseClass.from_key(restored['phase_classes'][1]).window() == (100, 140, 0, 100, 0, 100)
+        assert history.undo()['show_classes'] is False
+        assert history.undo(2) == state([])
+
+    def test_history_is_bounded(self):
+        history = hsv_wizard.HistoryManager({'measurements': ()}, max_entries=10, max_values=1000)
+        rows = ()
+        for i in range(100):
+            rows += ((float(i),),)
+            history.record('Measurement', {'measurements': rows})
+        assert len(history) == 10
+        assert history.undo(100)['measurements'] == rows[:90]
+        history = hsv_wizard.HistoryManager({'measurements': ()}, max_entries=100, max_values=50)
+        for i in range(100):
+            history.record('Measurement', {'measurements': tuple((float(j),) for j in range(i + 1))})
+        assert history.size <= 50
+        assert history.undo(100)['measurements'] == tuple((float(j),) for j in range(100 - len(history)))
+
+    def test_measurement_rows_round_trip(self):
+        store = hsv_wizard.MeasurementStore()
+        store.append(0, 0, 3, 4, 5.0, label='a')
+        store.append(1, 1, 2, 2, 1.4, label='b', feret_min=0.5, area=3.0)
+        rows = store.rows()
+        assert store.rows() == rows
+        assert rows[0][0][7] is None
+        store.pop()
+        store.append(9, 9, 9, 10, 1.0)
+        assert store.set_rows(rows) == 1
+        assert store.rows() == rows
+        assert store.summary()[0] == 2
+        assert math.isnan(store.row(0)['feret_min'])
+
+
+# ─── Kernel Backend Tests ─────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestKernelBackends:
+    """Tests for the pluggable HSV conversion, thresholding and compositing kernels."""
+
+    WINDOWS = [(10, 200, 30, 90, 20, 100), (300, 40, 0, 100, 10, 95), (0, 360, 0, 100, 0, 100), (90, 90, 50, 50, 0, 0)]
+
+    @pytest.fixture(autouse=True)
+    def _restore_backend(self):
+        yield
+        hsv_wizard._kernels = None
+
+    def _rgb(self):
+        # A coarse sample of the whole RGB cube plus noise
+        levels = np.arange(0, 256, 5, dtype=np.uint8)
+        cube = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 52, 3)
+        noise = np.random.default_rng(0).integers(0, 256, (40, 52, 3), dtype=np.uint8)
+        return np.concatenate([cube, noise])
+
+    def test_numpy_backend_matches_pil(self):
+        rgb = self._rgb()
+        kernels = hsv_wizard.set_kernels('numpy')
+        expected = np.asarray(Image.fromarray(rgb).convert('HSV'))
+        out = np.empty_like(rgb)
+        assert kernels.rgb_to_hsv(rgb, out=out) is out
+        np.testing.assert_array_equal(out, expected)
+        for window in self.WINDOWS:
+            composite, mask = kernels.mask_rgb(rgb, hsv_wizard.threshold_bounds(*window), 'tint')
+            np.testing.assert_array_equal(mask, hsv_wizard.compute_hsv_mask(expected, *window))
+            np.testing.assert_array_equal(composite, hsv_wizard.composite_mask(rgb, mask, 'tint'))
+
+    def test_backends_are_identical(self):
+        pytest.importorskip('numba')
+        rgb = self._rgb()
+        reference = hsv_wizard.NumpyKernels()
+        fused = hsv_wizard.set_kernels('numba')
+        np.testing.assert_array_equal(fused.rgb_to_hsv(rgb), reference.rgb_to_hsv(rgb))
+        # Views and read-only arrays (e.g. memory-mapped caches) are accepted as they are
+        view = rgb[3:90:2, 5:40]
+        view.flags.writeable = False
+        np.testing.assert_array_equal(fused.rgb_to_hsv(view), reference.rgb_to_hsv(view))
+        hsv = reference.rgb_to_hsv(rgb)
+        for window in self.WINDOWS:
+            bounds = hsv_wizard.threshold_bounds(*window)
+            np.testing.assert_array_equal(fused.hsv_mask(hsv, bounds), reference.hsv_mask(hsv, bounds))
+            for mode, _ in hsv_wizard.DISPLAY_MODES:
+                for expected, actual in zip(reference.mask_rgb(rgb, bounds, mode), fused.mask_rgb(rgb, bounds, mode)):
+                    np.testing.assert_array_equal(actual, expected)
+
+    def test_backend_selection(self, monkeypatch):
+        monkeypatch.setenv('HSV_WIZARD_KERNELS', 'numpy')
+        hsv_wizard._kernels = None
+        assert hsv_wizard.get_kernels().name == 'numpy'
+        assert hsv_wizard.get_kernels() is hsv_wizard.get_kernels()
+        with pytest.raises(ValueError):
+            hsv_wizard.set_kernels('opencl')
+        monkeypatch.setitem(sys.modules, 'numba', None)
+        # Without Numba, 'auto' falls back to NumPy and asking for Numba fails
+        assert hsv_wizard.set_kernels('auto').name == 'numpy'
+        with pytest.raises(ImportError):
+            hsv_wizard.set_kernels('numba')
+
+
+# ─── Pyramid Export Tests ─────────────────────────────────────────────────
+
+
+@pytest.mark.skipif(not _module_loaded, reason="tkinter/display not available")
+class TestPyramidExport:
+    """Tests for streaming pyramidal TIFF and DeepZoom export."""
+
+    def _image(self, width=700, height=530):
+        return np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def test_pyramid_strips_stream_every_level(self):
+        image = self._image()
+        reads = []
+
+        def read_strip(top, bottom):
+            reads.append((top, bottom))
+            return image[top:bottom]
+
+        sizes = hsv_wizard.pyramid_sizes((700, 530), 64)
+        assert sizes == [(700, 530), (350, 265), (175, 133), (88, 67), (44, 34)]
+        levels = {}
+        for level, top, strip in hsv_wizard.pyramid_strips(read_strip, (700, 530), len(sizes), 64):
+            assert top == sum(len(s) for s in levels.get(level, []))
+            assert len(strip) <= 64
+            levels.setdefault(level, []).append(strip)
+        # Each strip of the source is read once, in order
+        assert reads == [(top, min(top + 64, 530)) for top in range(0, 530, 64)]
+        expected = image
+        for level, (width, height) in enumerate(sizes):
+            np.testing.assert_array_equal(np.concatenate(levels[level]), expected)
+            assert expected.shape[:2] == (height, width)
+            expected = hsv_wizard.downsample_half(expected)
+
+    def test_downsample_half_averages_and_repeats_edges(self):
+        rows = np.array([[[0], [4], [8]], [[4], [8], [9]], [[1], [1], [2]]], dtype=np.uint8)
+        np.testing.assert_array_equal(hsv_wizard.downsample_half(rows)[..., 0], [[4, 9], [1, 2]])
+
+    def test_tiff_pyramid_round_trip(self, tmp_path):
+        image = self._image()
+        path = str(tmp_path / 'pyramid.tif')
+        resolution = hsv_wizard.tiff_resolution(2.5, 'µm')
+        hsv_wizard.export_pyramid(path, lambda top, bottom: image[top:bottom], (700, 530), tile_size=128,
+                                  resolution=resolution, workers=2)
+        with open(path, 'rb') as f:
+            # Little-endian BigTIFF
+            assert f.read(4) == b'II+\x00'
+        with Image.open(path) as tiff:
+            assert tiff.n_frames == 4
+            assert tiff.tag_v2[322] == 128 and tiff.tag_v2[259] == 8
+            np.testing.assert_array_equal(np.asarray(tiff.convert('RGB')), image)
+            tiff.seek(1)
+            assert tiff.size == (350, 265)
+            assert tiff.tag_v2[254] == 1
+            np.testing.assert_array_equal(np.asarray(tiff.convert('RGB')), hsv_wizard.downsample_half(image))
+        calibration = hsv_wizard.read_pixel_size(path)
+        assert calibration['units'] == 'µm'
+        assert calibration['length_per_pixel'] == pytest.approx(2.5)
+        preview, full_size = hsv_wizard.open_preview(path, max_size=300)
+        assert full_size == (700, 530) and preview.size == (350, 265)
+
+    def test_deepzoom_layout(self, tmp_path):
+        image = self._image(300, 200)
+        path = str(tmp_path / 'slide.dzi')
+        hsv_wizard.export_pyramid(path, lambda top, bottom: image[top:bottom], (300, 200), tile_size=128)
+        with open(path) as f:
+            descriptor = f.read()
+        assert 'TileSize="128"' in descriptor and 'Width="300" Height="200"' in descriptor
+        files = tmp_path / 'slide_files'
+        # Levels from 1x1 (level 0) to full resolution (level 9 = ceil(log2(300)))
+        assert sorted(int(name) for name in os.listdir(files)) == list(range(10))
+        assert sorted(os.listdir(files / '9')) == ['0_0.png', '0_1.png', '1_0.png', '1_1.png', '2_0.png', '2_1.png']
+        np.testing.assert_array_equal(np.asarray(Image.open(files / '9' / '2_1.png')), image[128:, 256:])
+        assert Image.open(files / '0' / '0_0.png').size == (1, 1)
+
+    @pytest.mark.parametrize('name', ['slide.tif', 'slide.dzi'])
+    def test_failed_export_leaves_nothing_behind(self, tmp_path, name):
+        image = self._image(300, 700)
+
+        def read_strip(top, bottom):
+            if top >= 256:
+                raise OSError("No space left on device")
+            return image[top:bottom]
+
+        with pytest.raises(OSError):
+            hsv_wizard.export_pyramid(str(tmp_path / name), read_strip, (300, 700), tile_size=128)
+        assert os.listdir(tmp_path) == []